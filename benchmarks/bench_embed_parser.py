@@ -0,0 +1,46 @@
+"""Micro-benchmark of the parsing of the roll embeds by the crawler"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embed_parser import parse_embed, emoji_to_db_value
+from roll_render import parse_roll_details, build_roll_data
+from tests.fixtures import random_rolls, FORMULA_ELEMENTS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the parsing of the roll embeds by the crawler')
+    parser.add_argument('--embeds', type=int, default=100000, help='The number of embeds to parse')
+    return parser.parse_args()
+
+
+def report(label, count, elapsed):
+    print(f"{label:<30} {elapsed / count * 1e6:8.1f} us/embed {count / elapsed:10.0f} embeds/s")
+
+
+def main():
+    args = parse_args()
+    emojis = {name: f'<:{name}:{i}>' for i, name in enumerate(FORMULA_ELEMENTS + list(emoji_to_db_value))}
+    embeds = [build_roll_data(parse_roll_details(roll['name'], roll), 'embed', emojis)
+              for roll in random_rolls(args.embeds)]
+    dicts = [embed.to_dict() for embed in embeds]
+
+    for label, items in (("parse_embed (Embed)", embeds), ("parse_embed (dict)", dicts)):
+        start = time.perf_counter()
+        for item in items:
+            parse_embed(item)
+        report(label, len(items), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for item in embeds:
+        roll = parse_embed(item)
+        if roll is not None:
+            roll.post_data("now")
+    report("parse_embed + post_data", len(embeds), time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
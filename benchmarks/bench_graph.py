@@ -0,0 +1,50 @@
+"""Micro-benchmark of the cdfs of the distribution graphs"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph import cdf_data_by_group
+from tests.test_graph import reference_cdf_data
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the cdfs of the distribution graphs')
+    parser.add_argument('--samples', type=int, default=1000000, help='The number of samples, split among the players')
+    parser.add_argument('--players', type=int, default=8, help='The number of players')
+    return parser.parse_args()
+
+
+def report(label, count, elapsed):
+    print(f"{label:<30} {elapsed * 1e3:8.1f} ms {count / elapsed:12.0f} samples/s")
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(0)
+    # Margins of 2d6 rolls under thresholds
+    samples = rng.integers(1, 7, args.samples) + rng.integers(1, 7, args.samples) - rng.integers(5, 20, args.samples)
+    data = {f"Player {i}": values.tolist() for i, values in enumerate(np.array_split(samples, args.players))}
+    shadow_points = np.unique(samples).tolist()
+
+    start = time.perf_counter()
+    for values in data.values():
+        reference_cdf_data(values, shadow_points_from=shadow_points, origin=False)
+    report("cdf_data (loops)", args.samples, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    cdf_data_by_group(data, shadow_points_from=shadow_points, origin=False)
+    report("cdf_data_by_group", args.samples, time.perf_counter() - start)
+
+    arrays = dict(zip(data, np.array_split(samples, args.players)))
+    start = time.perf_counter()
+    cdf_data_by_group(arrays, shadow_points_from=shadow_points, origin=False)
+    report("cdf_data_by_group (arrays)", args.samples, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Micro-benchmark of the cost of saving one roll in the database"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import create_db, init_db_connection, insert_roll, parse_roll
+from tests.fixtures import random_rolls
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the cost of parsing and inserting a roll')
+    parser.add_argument('--rolls', type=int, default=20000, help='The number of rolls to insert')
+    parser.add_argument('--commits', type=int, default=1000,
+                        help='The number of rolls inserted with a commit after each of them')
+    return parser.parse_args()
+
+
+def report(label, count, elapsed):
+    print(f"{label:<40} {elapsed / count * 1e6:8.1f} us/roll {count / elapsed:10.0f} rolls/s")
+
+
+def main():
+    args = parse_args()
+    rolls = random_rolls(args.rolls)
+
+    start = time.perf_counter()
+    for roll in rolls:
+        parse_roll("bench", roll)
+    report("parse_roll", len(rolls), time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bench.sqlite3")
+        create_db(path)
+        db = init_db_connection(path, journal_mode="wal", synchronous="normal")
+
+        start = time.perf_counter()
+        with db:
+            for roll in rolls:
+                insert_roll(db, "bench", roll)
+        report("insert_roll (single transaction)", len(rolls), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with db:
+            for roll in rolls:
+                insert_roll(db, "bench", roll)
+        report("insert_roll updating a roll", len(rolls), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for roll in rolls[:args.commits]:
+            with db:
+                insert_roll(db, "other-bench", roll)
+        report("insert_roll + commit (WAL, normal)", args.commits, time.perf_counter() - start)
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
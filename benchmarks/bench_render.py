@@ -0,0 +1,41 @@
+"""Micro-benchmark of the rendering of the rolls as Discord messages"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from roll_render import parse_roll_details, build_roll_data
+from tests.fixtures import random_rolls, FORMULA_ELEMENTS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the rendering of the rolls as Discord messages')
+    parser.add_argument('--rolls', type=int, default=20000, help='The number of rolls to render')
+    return parser.parse_args()
+
+
+def report(label, count, elapsed):
+    print(f"{label:<30} {elapsed / count * 1e6:8.1f} us/roll {count / elapsed:10.0f} rolls/s")
+
+
+def main():
+    args = parse_args()
+    rolls = random_rolls(args.rolls)
+    emojis = {name: f'<:{name}:{i}>' for i, name in enumerate(FORMULA_ELEMENTS + ['one', 'two', 'three', 'four',
+                                                                                  'five', 'six'])}
+
+    start = time.perf_counter()
+    parsed = [parse_roll_details(roll['name'], roll) for roll in rolls]
+    report("parse_roll_details", len(rolls), time.perf_counter() - start)
+
+    for msg_type in (None, 'embed'):
+        start = time.perf_counter()
+        for roll in parsed:
+            build_roll_data(roll, msg_type, emojis)
+        report(f"build_roll_data ({msg_type or 'text'})", len(rolls), time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
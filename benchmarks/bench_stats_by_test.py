@@ -0,0 +1,79 @@
+"""Micro-benchmark of the statistics by test on a large synthetic campaign"""
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import create_db, init_db_connection, get_stats_by_test
+from tests.fixtures import PLAYERS, REASONS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure get_stats_by_test on a synthetic campaign')
+    parser.add_argument('--rolls', type=int, default=1000000, help='The number of rolls of the campaign')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs of each query, the best is kept')
+    return parser.parse_args()
+
+
+def report(label, elapsed, rolls):
+    print(f"{label:<45} {elapsed * 1e3:8.1f} ms {rolls / elapsed:12.0f} rolls/s")
+
+
+def previous_stats_by_test(db, campaign, filter_player=None, filter_test=None):
+    """The self-join of get_stats_by_test before its single scan, whose mean ignores the player filter"""
+    params = [campaign, campaign] + [value for value in (filter_player, filter_test) if value]
+    rows = db.execute('select R.reason, count(rowid) as c, s.a, avg((R.margin - s.a) * (R.margin - s.a)) as var'
+                      ' from rolls R inner join'
+                      ' (select reason, avg(margin) AS a FROM rolls where campaign=? and threshold > 0'
+                      ' group by reason) s on R.reason=s.reason'
+                      ' where campaign=? and threshold > 0'
+                      + (' and name=?' if filter_player else '')
+                      + (' and R.reason=?' if filter_test else '')
+                      + ' group by R.reason order by c desc', params).fetchall()
+    return [(row[0], row[1], row[2], math.sqrt(row[3])) for row in rows]
+
+
+def best_time(repeat, func, *args, **kw):
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kw)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bench.sqlite3")
+        create_db(path)
+        db = init_db_connection(path, journal_mode="wal", synchronous="normal")
+        # Only the columns read by the statistics, the roll aggregates are not needed
+        rows = ((rng.choice(PLAYERS), rng.choice(REASONS[:-1] + [None]), threshold,
+                 threshold - rng.randint(1, 6) - rng.randint(1, 6))
+                for threshold in (rng.randint(0, 14) for _ in range(args.rolls)))
+        with db:
+            db.executemany("insert into rolls(campaign, name, reason, threshold, margin) values ('bench', ?, ?, ?, ?)",
+                           rows)
+        db.execute("analyze")
+
+        for label, filters in (("", ()), (" (player)", (PLAYERS[0],))):
+            report("previous self-join" + label, best_time(args.repeat, previous_stats_by_test, db, "bench", *filters),
+                   args.rolls)
+            report("get_stats_by_test" + label, best_time(args.repeat, get_stats_by_test, db, "bench", *filters),
+                   args.rolls)
+            report("get_stats_by_test + percentiles" + label,
+                   best_time(args.repeat, get_stats_by_test, db, "bench", *filters, percentiles=[5, 50, 95]),
+                   args.rolls)
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
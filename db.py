@@ -1,7 +1,16 @@
+import json
 import math
 import os
-from sqlite3 import DatabaseError, Connection, connect
-from typing import Union, List, Dict, Tuple, Optional
+import queue
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice, count
+from sqlite3 import DatabaseError, Connection, Cursor, connect
+from typing import Union, List, Dict, Tuple, Optional, Iterator, NamedTuple, Iterable, Callable, Sequence
+
+import numpy as np
+
+from streaks import Streaks, compute_streaks
 
 integer_fields = ["number", "type", "max_value", "threshold", "margin", "margin_throttle", "talent_level",
                   "base_energy_cost", "critical_increase", "precision", "optional_precision", "power", "optional_power",
@@ -18,68 +27,494 @@ formula_field = "formula_elements"
 invested_energies = "invested_energies"
 
 
+# Add the rolls R matching a condition to their aggregates (see migration 6), or remove them with a sign of -1
+aggregate_update_cmds = (
+    "insert into roll_aggregates(campaign, name, reason, tests, successes, critical_successes, critical_failures)"
+    " select R.campaign, R.name, coalesce(R.reason, ''), {sign} * count(*),"
+    " {sign} * count(case when (R.margin > 0 or R.critical_success) and not R.critical_failure then 1 end),"
+    " {sign} * count(case when R.critical_success then 1 end), {sign} * count(case when R.critical_failure then 1 end)"
+    " from rolls R where R.threshold > 0 and {condition} group by 1, 2, 3"
+    " on conflict (campaign, name, reason) do update set tests = tests + excluded.tests,"
+    " successes = successes + excluded.successes,"
+    " critical_successes = critical_successes + excluded.critical_successes,"
+    " critical_failures = critical_failures + excluded.critical_failures",
+    "insert into formula_aggregates(campaign, name, reason, element, uses)"
+    " select R.campaign, R.name, coalesce(R.reason, ''), F.element, {sign} * count(*)"
+    " from formula_elements F inner join rolls R on F.roll = R.rowid where {condition} group by 1, 2, 3, 4"
+    " on conflict (campaign, name, reason, element) do update set uses = uses + excluded.uses",
+    "insert into energy_aggregates(campaign, name, reason, energy, uses)"
+    " select R.campaign, R.name, coalesce(R.reason, ''), E.energy, {sign} * count(*)"
+    " from invested_energies E inner join rolls R on E.roll = R.rowid where {condition} group by 1, 2, 3, 4"
+    " on conflict (campaign, name, reason, energy) do update set uses = uses + excluded.uses",
+)
+rebuild_aggregates_script = \
+    "delete from roll_aggregates;\ndelete from formula_aggregates;\ndelete from energy_aggregates;\n" \
+    + "".join(cmd.format(sign=1, condition="1") + ";\n" for cmd in aggregate_update_cmds)
+# The streaks of every player are replayed from the rolls (see refresh_streaks) when they are read or written next
+reset_streaks_script = \
+    "delete from streaks;\ninsert into streaks(campaign, name, success, length, completed_successes," \
+    " completed_failures, dirty) select distinct campaign, name, 0, 0, 0, 0, 1 from rolls;\n"
+
+
+# Schema changes applied on top of db.sql, in order.
+# The number of applied migrations is stored in the "user_version" pragma of the database.
+migrations = [
+    # 1: Covering indexes for the statistics queries (filters on campaign, name, reason and threshold)
+    #    and for the removal of an updated roll (campaign, name and timestamp)
+    """
+    CREATE INDEX IF NOT EXISTS rolls_campaign_name ON rolls (campaign, name, reason, threshold, margin,
+                                                             critical_success, critical_failure, number, type);
+    CREATE INDEX IF NOT EXISTS rolls_campaign_reason ON rolls (campaign, reason, threshold, name, margin,
+                                                               critical_success, critical_failure, number, type);
+    CREATE INDEX IF NOT EXISTS rolls_campaign_timestamp ON rolls (campaign, name, timestamp);
+    """,
+    # 2: Messages sent by the Discord bot, to edit them when their roll is updated (see discord_messages.py)
+    """
+    CREATE TABLE IF NOT EXISTS discord_messages (
+        server TEXT NOT NULL,
+        key TEXT NOT NULL,
+        channel_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        last_used INTEGER NOT NULL,
+        PRIMARY KEY (server, key)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS discord_messages_last_used ON discord_messages (server, last_used);
+    """,
+    # 3: Rolls waiting to be sent by the Discord bot, which runs in its own process (see discord_bot.py)
+    """
+    CREATE TABLE IF NOT EXISTS discord_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server TEXT NOT NULL,
+        key TEXT NOT NULL,
+        payload TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS discord_outbox_key ON discord_outbox (server, key);
+    """,
+    # 4: Progress of the crawl of the Discord channels (see discord_crawl.py)
+    """
+    CREATE TABLE IF NOT EXISTS crawl_checkpoints (
+        channel_id INTEGER PRIMARY KEY,
+        campaign TEXT NOT NULL,
+        oldest_message_id INTEGER,
+        newest_message_id INTEGER,
+        complete BOOLEAN NOT NULL DEFAULT 0
+    );
+    """,
+    # 5: Version of the rolls of each campaign, bumped by each write, to know when cached graphs are stale
+    """
+    CREATE TABLE IF NOT EXISTS campaign_versions (
+        campaign VARCHAR PRIMARY KEY,
+        version INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    """,
+    # 6: Aggregates of the rolls by (campaign, name, reason), the reason of the rolls without reason being '',
+    #    kept up to date by insert_roll and bulk_insert_rolls (see update_aggregates)
+    """
+    CREATE TABLE IF NOT EXISTS roll_aggregates (
+        campaign VARCHAR NOT NULL,
+        name VARCHAR NOT NULL,
+        reason VARCHAR NOT NULL,
+        tests INTEGER NOT NULL,  -- Rolls with a threshold
+        successes INTEGER NOT NULL,
+        critical_successes INTEGER NOT NULL,
+        critical_failures INTEGER NOT NULL,
+        PRIMARY KEY (campaign, name, reason)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS formula_aggregates (
+        campaign VARCHAR NOT NULL,
+        name VARCHAR NOT NULL,
+        reason VARCHAR NOT NULL,
+        element VARCHAR NOT NULL,
+        uses INTEGER NOT NULL,
+        PRIMARY KEY (campaign, name, reason, element)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS energy_aggregates (
+        campaign VARCHAR NOT NULL,
+        name VARCHAR NOT NULL,
+        reason VARCHAR NOT NULL,
+        energy VARCHAR NOT NULL,
+        uses INTEGER NOT NULL,
+        PRIMARY KEY (campaign, name, reason, energy)
+    ) WITHOUT ROWID;
+    """ + rebuild_aggregates_script,
+    # 7: Streaks of successes and failures of each player, extended by each new test (see add_streak_cmd), the
+    #    streaks before the current one being summed up by their longest ones. The streaks of a player are "dirty"
+    #    when a test was removed from the middle of their history: they are replayed from the rolls by the getter,
+    #    until insert_roll, bulk_insert_rolls or rebuild_aggregates stores them again (see refresh_streaks).
+    """
+    CREATE TABLE IF NOT EXISTS streaks (
+        campaign VARCHAR NOT NULL,
+        name VARCHAR NOT NULL,
+        success BOOLEAN NOT NULL,  -- Result of the current streak
+        length INTEGER NOT NULL,  -- Length of the current streak
+        completed_successes INTEGER NOT NULL,  -- Longest streak of successes before the current streak
+        completed_failures INTEGER NOT NULL,
+        last_roll INTEGER,  -- The last roll of the current streak, NULL when unknown
+        dirty BOOLEAN NOT NULL,
+        PRIMARY KEY (campaign, name)
+    ) WITHOUT ROWID;
+    """ + reset_streaks_script,
+    # 8: Events of the live feeds, stored by the process receiving the roll or sheet and relayed to the feeds
+    #    of every process (see store_event and events.EventRelay). AUTOINCREMENT: the ids of the pruned events
+    #    are never reused, the clients resume their feed from them.
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        campaign VARCHAR NOT NULL,
+        type VARCHAR NOT NULL,
+        data VARCHAR NOT NULL  -- JSON
+    );
+    """,
+]
+
+
 def create_db(path: str) -> None:
+    """Create the database if it does not exist yet and bring its schema up to date"""
     with init_db_connection(path) as db:
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "db.sql")) as file_obj:
-            db.executescript(file_obj.read())
+        cur = db.execute("select count(*) from sqlite_master where type='table' and name='rolls'")
+        if cur.fetchone()[0] == 0:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "db.sql")) as file_obj:
+                db.executescript(file_obj.read())
+        migrate_db(db)
+
+
+def migrate_db(db: Connection) -> None:
+    """Apply the migrations that were not applied yet to the database"""
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for i, migration in enumerate(migrations[version:], start=version + 1):
+        db.executescript(f"BEGIN TRANSACTION;\n{migration}\nPRAGMA user_version = {i};\nCOMMIT TRANSACTION;")
 
 
-def init_db_connection(path: str) -> Connection:
-    db = connect(path)
+# Every campaign with rolls, or with rolls before, may show other statistics
+bump_all_campaign_versions_script = \
+    "insert or ignore into campaign_versions(campaign, version) select distinct campaign, 0 from rolls;\n" \
+    "update campaign_versions set version = version + 1;\n"
+
+
+def rebuild_aggregates(db: Connection) -> None:
+    """
+    Recompute the aggregates and the streaks of the rolls, after the rolls were changed without insert_roll
+
+    The versions of the campaigns are bumped in the same transaction, so that their cached graphs are rendered again.
+    """
+    with db:
+        # The transaction is left open by the script
+        db.executescript(f"BEGIN TRANSACTION;\n{rebuild_aggregates_script}\n{reset_streaks_script}\n"
+                         f"{bump_all_campaign_versions_script}")
+        refresh_streaks(db)
+
+
+def init_db_connection(path: str, busy_timeout: int = 5000, check_same_thread: bool = True,
+                       **pragmas: Union[int, str]) -> Connection:
+    """Open a connection to the database, waiting up to busy_timeout ms for locks, and set the given pragmas"""
+    db = connect(path, timeout=busy_timeout / 1000, check_same_thread=check_same_thread)
     # Activate foreign keys
     db.execute("PRAGMA foreign_keys = 1")
+    for pragma, value in pragmas.items():
+        db.execute(f"PRAGMA {pragma} = {value}")
     return db
 
 
-def insert_roll(db: Connection, campaign: str, post_data: Dict[str, Union[List, int, float, str]]) -> None:
-    insert_data = [("campaign", campaign)]
+class ConnectionPool:
+    """
+    Connections to the database kept open and reused across the requests of a (gunicorn) worker
+
+    Connections use the WAL journal by default so that readers never block the writer (and vice versa) and
+    concurrent writers wait for the lock up to busy_timeout ms instead of failing with "database is locked".
+    At most `size` idle connections are kept, extra connections are closed when released.
+    The pool is emptied when used from a forked process as SQLite connections must not cross a fork.
+    """
+
+    def __init__(self, path: str, size: int = 4, busy_timeout: int = 5000, journal_mode: str = "wal",
+                 synchronous: str = "normal", cache_size: int = -16000, mmap_size: int = 268435456):
+        self.path = path
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.pragmas = {"journal_mode": journal_mode, "synchronous": synchronous, "cache_size": cache_size,
+                        "mmap_size": mmap_size}
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+
+    def _check_fork(self) -> None:
+        if self._pid != os.getpid():
+            # Forget (without closing) the connections inherited from the parent process
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue()
+
+    def acquire(self) -> Connection:
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return init_db_connection(self.path, busy_timeout=self.busy_timeout, check_same_thread=False,
+                                      **self.pragmas)
+
+    def release(self, db: Connection) -> None:
+        if db.in_transaction:
+            db.rollback()
+        if self._pid == os.getpid() and self._idle.qsize() < self.size:
+            self._idle.put(db)
+        else:
+            db.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        """Borrow a connection, the transaction is committed on success and rolled back on error"""
+        db = self.acquire()
+        try:
+            with db:
+                yield db
+        finally:
+            self.release(db)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# Kind of each field of the POST data of a roll
+field_kinds = {
+    **{field: "integer" for field in integer_fields},
+    **{field: "boolean" for field in boolean_fields},
+    **{field: "text" for field in text_fields},
+    **{field: "dices" for field in dice_fields},
+    **{field: "ignored" for field in ignored_fields},
+    formula_field: "formula",
+    invested_energies: "energies",
+}
+
+insert_dice_cmd = 'insert into dices(roll, "type", dice_index, dice) values (?, ?, ?, ?)'
+insert_formula_cmd = 'insert into formula_elements(roll, element) values (?, ?)'
+insert_energy_cmd = 'insert into invested_energies(roll, energy) values (?, ?)'
+
+
+class ParsedRoll(NamedTuple):
+    """Roll POST data converted to the rows to insert in the database"""
+    columns: Tuple[str, ...]
+    values: List[Union[int, bool, str, None]]
+    dices: List[Tuple[str, int, int]]
+    formula: List[str]
+    energies: List[str]
+    name: Optional[str]
+    timestamp: Optional[str]
+
+
+def parse_roll(campaign: str, post_data: Dict[str, Union[List, int, float, str]]) -> ParsedRoll:
+    columns = ["campaign"]
+    values = [campaign]
     dices = []
     formula = []
     energies = []
     name = None
     timestamp = None
     for key, value in post_data.items():
-        if key in integer_fields:
-            insert_data.append((key, int(value) if value != "NaN" else None))
-        elif key in boolean_fields:
-            insert_data.append((key, value == "true"))
-        elif key in text_fields:
+        kind = field_kinds.get(key)
+        if kind == "integer":
+            columns.append(key)
+            values.append(int(value) if value != "NaN" else None)
+        elif kind == "boolean":
+            columns.append(key)
+            values.append(value == "true")
+        elif kind == "text":
             if key == "name":
                 name = value
             elif key == "timestamp":
                 timestamp = value
-            insert_data.append((key, value if value is not None and len(value) > 0 else None))
-        elif key in dice_fields:
+            columns.append(key)
+            values.append(value if value is not None and len(value) > 0 else None)
+        elif kind == "dices":
             dices.extend([(key, i, int(dice)) for i, dice in enumerate(value.split(",") if len(value) > 0 else [])])
-        elif key == formula_field:
+        elif kind == "formula":
             formula.extend([v for v in (value.split(",") if len(value) > 0 else [])])
-        elif key == invested_energies:
+        elif kind == "energies":
             energies.extend([v for v in (value.split(",") if len(value) > 0 else [])])
-        elif key not in ignored_fields:
+        elif kind is None:
             print(f"Cannot insert '{key}: {value}' into database")
+    return ParsedRoll(tuple(columns), values, dices, formula, energies, name, timestamp)
+
+
+@lru_cache(maxsize=256)
+def roll_insert_cmd(columns: Tuple[str, ...]) -> str:
+    """
+    Return the insert statement of a roll with these columns
+
+    The same text is returned for the same columns, so that sqlite3 reuses its prepared statement.
+    """
+    quoted_columns = ','.join(['"' + k + '"' for k in columns])
+    return f"insert into rolls({quoted_columns}) values ({','.join(['?' for _ in columns])})"
+
+
+@lru_cache(maxsize=16)
+def _aggregate_update_cmds(condition: str, sign: int) -> Tuple[str, ...]:
+    return tuple(cmd.format(condition=condition, sign=sign) for cmd in aggregate_update_cmds)
+
+
+def update_aggregates(db: Connection, condition: str, params: Iterable, sign: int = 1) -> None:
+    """
+    Add the rolls matching the condition on the rolls R to their aggregates, or remove them with sign=-1
+
+    Rolls must be added once inserted along with their formula elements and energies, and removed before their
+    (cascading) delete. The aggregates are only read by the getters: they are not checked against the rolls.
+    """
+    params = list(params)
+    for cmd in _aggregate_update_cmds(condition, sign):
+        db.execute(cmd, params)
+
+
+add_roll_aggregate_cmd = \
+    "insert into roll_aggregates(campaign, name, reason, tests, successes, critical_successes, critical_failures)" \
+    " values (?, ?, ?, 1, ?, ?, ?) on conflict (campaign, name, reason) do update set tests = tests + 1," \
+    " successes = successes + excluded.successes," \
+    " critical_successes = critical_successes + excluded.critical_successes," \
+    " critical_failures = critical_failures + excluded.critical_failures"
+add_formula_aggregate_cmd = "insert into formula_aggregates(campaign, name, reason, element, uses)" \
+    " values (?, ?, ?, ?, 1) on conflict (campaign, name, reason, element) do update set uses = uses + 1"
+add_energy_aggregate_cmd = "insert into energy_aggregates(campaign, name, reason, energy, uses)" \
+    " values (?, ?, ?, ?, 1) on conflict (campaign, name, reason, energy) do update set uses = uses + 1"
+
+
+def _test_result(values: Dict[str, Union[int, bool, str, None]]) -> Optional[Tuple[bool, bool, bool]]:
+    """The (success, critical_success, critical_failure) of a roll from its parsed values, None if not a test"""
+    if (values.get("threshold") or 0) <= 0:
+        return None
+    critical_success = bool(values.get("critical_success", False))
+    critical_failure = bool(values.get("critical_failure", False))
+    return ((values.get("margin") or 0) > 0 or critical_success) and not critical_failure, \
+        critical_success, critical_failure
+
+
+def _add_to_aggregates(cur: Cursor, campaign: str, roll: ParsedRoll) -> None:
+    """Add an inserted roll to its aggregates, from its parsed values (the defaults of the table otherwise)"""
+    values = dict(zip(roll.columns, roll.values))
+    group = (campaign, roll.name, values.get("reason") or "")
+    result = _test_result(values)
+    if result is not None:
+        cur.execute(add_roll_aggregate_cmd, group + result)
+    if len(roll.formula) > 0:
+        cur.executemany(add_formula_aggregate_cmd, [group + (element,) for element in roll.formula])
+    if len(roll.energies) > 0:
+        cur.executemany(add_energy_aggregate_cmd, [group + (energy,) for energy in roll.energies])
+
+
+# Append a test to the streaks of its player, unless they have to be replayed: when the result changes, the current
+# streak becomes completed (the right-hand sides of the update read the values before the update)
+add_streak_cmd = \
+    "insert into streaks(campaign, name, success, length, completed_successes, completed_failures, last_roll, dirty)" \
+    " values (?, ?, ?, 1, 0, 0, ?, 0) on conflict (campaign, name) do update set" \
+    " completed_successes = case when success and not excluded.success and length > completed_successes" \
+    " then length else completed_successes end," \
+    " completed_failures = case when not success and excluded.success and length > completed_failures" \
+    " then length else completed_failures end," \
+    " length = case when success = excluded.success then length + 1 else 1 end," \
+    " success = excluded.success, last_roll = excluded.last_roll where not dirty"
+success_expression = "((R.margin > 0 or R.critical_success) and not R.critical_failure)"
+
+
+def _remove_from_streaks(cur: Cursor, campaign: str, name: str, roll_id: int,
+                         replaced_by: Optional[bool] = None) -> bool:
+    """
+    Remove a test of a player from their streaks, before its delete, and return whether they became dirty
 
-    if len(insert_data) > 0 and len(dices) > 0:
+    Only the last test of a streak can be removed from the state, if the streak is longer than 1 or if the test is
+    replaced by a test of the same result (replaced_by being its success). Otherwise, the streaks of the player
+    are marked dirty and they will be replayed from the rolls by refresh_streaks.
+    """
+    cur.execute("update streaks set length = length - 1, last_roll = NULL where campaign=? and name=? and not dirty"
+                " and last_roll=? and (length > 1 or success = ?)", [campaign, name, roll_id, replaced_by])
+    if cur.rowcount == 0:
+        cur.execute("update streaks set dirty = 1 where campaign=? and name=?", [campaign, name])
+        return True
+    return False
+
+
+def _replay_streaks(db: Connection, campaign: str, condition: str, params: Iterable) \
+        -> Tuple[List[str], Streaks, np.ndarray]:
+    """
+    Compute the streaks of the tests of the players matching the condition on the rolls R
+
+    Return the players (in the order of their first test), their streaks and the id of their last test.
+    """
+    rows = db.execute(f"select R.name, {success_expression}, R.rowid from rolls R"
+                      f" where R.campaign=? and R.threshold > 0 and {condition} order by R.rowid asc",
+                      [campaign] + list(params)).fetchall()
+    if len(rows) == 0:
+        return [], compute_streaks(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), 0), np.zeros(0, np.int64)
+    names, successes, roll_ids = zip(*rows)
+    index = {}  # Faster than numpy.unique on strings
+    codes = np.array([index.setdefault(name, len(index)) for name in names], dtype=np.int64)
+    last_rolls = np.zeros(len(index), dtype=np.int64)
+    np.maximum.at(last_rolls, codes, np.array(roll_ids, dtype=np.int64))
+    return list(index), compute_streaks(codes, np.array(successes, dtype=bool), len(index)), last_rolls
+
+
+def refresh_streaks(db: Connection, campaign: Optional[str] = None, name: Optional[str] = None) -> None:
+    """Replay the dirty streaks (of the campaign, of the player) from the rolls, in the transaction of the caller"""
+    campaigns = [campaign] if campaign is not None else \
+        [row[0] for row in db.execute("select distinct campaign from streaks where dirty")]
+    player_params = [name] if name is not None else []
+    for campaign in campaigns:
+        names, streaks, last_rolls = _replay_streaks(
+            db, campaign, "R.name in (select S.name from streaks S where S.campaign=R.campaign and S.dirty"
+                          + (" and S.name=?)" if name is not None else ")"), player_params)
+        db.executemany("update streaks set success=?, length=?, completed_successes=?, completed_failures=?,"
+                       " last_roll=?, dirty=0 where campaign=? and name=?",
+                       [(bool(streaks.current_success[i]), int(streaks.current_length[i]),
+                         int(streaks.completed[i, 0]), int(streaks.completed[i, 1]), int(last_rolls[i]), campaign,
+                         name) for i, name in enumerate(names)])
+        # The players without any test left
+        db.execute("update streaks set success=0, length=0, completed_successes=0, completed_failures=0,"
+                   " last_roll=NULL, dirty=0 where campaign=? and dirty" + (" and name=?" if name is not None else ""),
+                   [campaign] + player_params)
+
+
+def bump_campaign_version(db: Connection, campaign: str) -> None:
+    """Record that the rolls of the campaign changed, in the transaction changing them"""
+    db.execute("insert into campaign_versions(campaign, version) values (?, 1)"
+               " on conflict(campaign) do update set version = version + 1", (campaign,))
+
+
+def get_campaign_version(db: Connection, campaign: str) -> int:
+    """Return the version of the rolls of the campaign, 0 if they never changed"""
+    row = db.execute("select version from campaign_versions where campaign = ?", (campaign,)).fetchone()
+    return 0 if row is None else row[0]
+
+
+def insert_roll(db: Connection, campaign: str, post_data: Dict[str, Union[List, int, float, str]]) -> None:
+    roll = parse_roll(campaign, post_data)
+    result = _test_result(dict(zip(roll.columns, roll.values)))
+
+    if len(roll.dices) > 0:
         cur = db.cursor()
         try:
             # Remove old data if any to update
-            if name and timestamp:
-                cur.execute(f"delete from rolls where campaign=? and name=? and timestamp=?",
-                            [campaign, name, timestamp])
-
-            columns = ','.join(['"' + k + '"' for k, _ in insert_data])
-            cmd = f"insert into rolls({columns}) values ({','.join(['?' for _ in insert_data])})"
-            cur.execute(cmd, [v for k, v in insert_data])
-            cur.execute("select max(rowid) from rolls")
-            roll_id = cur.fetchone()[0]
-            cmd = f'insert into dices(roll, "type", dice_index, dice) values (:roll, :type, :dice_index, :dice)'
-            cur.executemany(cmd, [{"roll": roll_id, "type": dice_type, "dice_index": dice_index, "dice": dice}
-                                  for dice_type, dice_index, dice in dices])
-            if len(formula) > 0:
-                cmd = f'insert into formula_elements(roll, element) values (:roll, :element)'
-                cur.executemany(cmd, [{"roll": roll_id, "element": element} for element in formula])
-            if len(energies) > 0:
-                cmd = f'insert into invested_energies(roll, energy) values (:roll, :energy)'
-                cur.executemany(cmd, [{"roll": roll_id, "energy": energy} for energy in energies])
+            dirty = False
+            if roll.name and roll.timestamp:
+                cur.execute("select rowid, threshold > 0 from rolls where campaign=? and name=? and timestamp=?",
+                            [campaign, roll.name, roll.timestamp])
+                for old_id, is_test in cur.fetchall():
+                    update_aggregates(db, "R.rowid=?", [old_id], sign=-1)
+                    if is_test:
+                        dirty |= _remove_from_streaks(cur, campaign, roll.name, old_id, result and result[0])
+                    cur.execute("delete from rolls where rowid=?", [old_id])
+
+            cur.execute(roll_insert_cmd(roll.columns), roll.values)
+            roll_id = cur.lastrowid
+            cur.executemany(insert_dice_cmd, [(roll_id, dice_type, dice_index, dice)
+                                              for dice_type, dice_index, dice in roll.dices])
+            if len(roll.formula) > 0:
+                cur.executemany(insert_formula_cmd, [(roll_id, element) for element in roll.formula])
+            if len(roll.energies) > 0:
+                cur.executemany(insert_energy_cmd, [(roll_id, energy) for energy in roll.energies])
+            _add_to_aggregates(cur, campaign, roll)
+            if result is not None:
+                cur.execute(add_streak_cmd, [campaign, roll.name, result[0], roll_id])
+                dirty |= cur.rowcount == 0  # Not added to dirty streaks
+            if dirty:  # Replayed now rather than by every read of the streaks
+                refresh_streaks(db, campaign, roll.name)
+            bump_campaign_version(db, campaign)
         except DatabaseError as e:
             print(f"Cannot insert roll {post_data} in database: {e}")
             raise e
@@ -89,6 +524,147 @@ def insert_roll(db: Connection, campaign: str, post_data: Dict[str, Union[List,
         print(f"The roll data {post_data} does not contain actual roll")
 
 
+def queue_discord_roll(db: Connection, server: str, key: str, roll: Dict[str, Optional[str]]) -> None:
+    """Queue a roll (its POST data along with its Discord settings) for the Discord bot"""
+    db.execute("insert into discord_outbox(server, key, payload) values (?, ?, ?)", (server, key, json.dumps(roll)))
+
+
+def get_queued_discord_rolls(db: Connection, after_id: int = 0,
+                             limit: int = 1000) -> List[Tuple[int, str, str, Dict[str, Optional[str]]]]:
+    """Return the queued rolls after the given outbox id, as (id, server, key, roll), oldest first"""
+    return [(outbox_id, server, key, json.loads(payload)) for outbox_id, server, key, payload in db.execute(
+        "select id, server, key, payload from discord_outbox where id > ? order by id limit ?", (after_id, limit))]
+
+
+def remove_queued_discord_rolls(db: Connection, server: str, key: str, up_to_id: int) -> None:
+    """Remove the versions of a roll sent by the bot, the last of them being the given outbox id"""
+    db.execute("delete from discord_outbox where server = ? and key = ? and id <= ?", (server, key, up_to_id))
+
+
+def store_event(db: Connection, campaign: str, event_type: str, data: Dict, keep: int = 4096) -> None:
+    """Store an event for the live feeds of every process, only the last `keep` events are kept"""
+    event_id = db.execute("insert into events(campaign, type, data) values (?, ?, ?)",
+                          (campaign, event_type, json.dumps(data))).lastrowid
+    db.execute("delete from events where id <= ?", (event_id - keep,))
+
+
+def get_events(db: Connection, after_id: int = 0, limit: int = 1000) -> List[Tuple[int, str, str, Dict]]:
+    """Return the stored events after the given id, as (id, campaign, type, data), oldest first"""
+    return [(event_id, campaign, event_type, json.loads(data)) for event_id, campaign, event_type, data in db.execute(
+        "select id, campaign, type, data from events where id > ? order by id limit ?", (after_id, limit))]
+
+
+class CrawlCheckpoint(NamedTuple):
+    oldest_message_id: Optional[int]  # The history before it is still to crawl, unless complete
+    newest_message_id: Optional[int]  # The messages after it were posted since the last crawl
+    complete: bool
+
+
+def get_crawl_checkpoint(db: Connection, channel_id: int) -> CrawlCheckpoint:
+    row = db.execute("select oldest_message_id, newest_message_id, complete from crawl_checkpoints"
+                     " where channel_id = ?", (channel_id,)).fetchone()
+    if row is None:
+        return CrawlCheckpoint(None, None, False)
+    return CrawlCheckpoint(row[0], row[1], bool(row[2]))
+
+
+def save_crawl_checkpoint(db: Connection, channel_id: int, campaign: str, checkpoint: CrawlCheckpoint) -> None:
+    db.execute("insert or replace into crawl_checkpoints(channel_id, campaign, oldest_message_id, newest_message_id,"
+               " complete) values (?, ?, ?, ?, ?)", (channel_id, campaign) + tuple(checkpoint))
+
+
+def _next_roll_id(cur: Cursor) -> int:
+    cur.execute("select max(coalesce((select seq from sqlite_sequence where name='rolls'), 0),"
+                " coalesce((select max(rowid) from rolls), 0))")
+    return cur.fetchone()[0] + 1
+
+
+def bulk_insert_rolls(db: Connection, campaign: str, rolls: Iterable[Dict[str, Union[List, int, float, str]]],
+                      batch_size: int = 10000, progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Insert many rolls, batch_size rolls per transaction, and return the number of inserted rolls
+
+    Rolls are read lazily from the iterable. Like insert_roll, a roll replaces the previous roll of the same
+    character with the same timestamp, but the old rolls of a batch are removed with a single statement and the
+    rows are inserted with executemany. The connection must not be in a transaction: each batch is committed.
+    progress is called with the total number of inserted rolls after each batch.
+    """
+    total = 0
+    rolls = iter(rolls)
+    unnamed = count()
+    cur = db.cursor()
+    try:
+        cur.execute("create temp table if not exists bulk_roll_keys (name VARCHAR NOT NULL,"
+                    " timestamp DATETIME NOT NULL)")
+        while True:
+            batch = {}
+            for post_data in islice(rolls, batch_size):
+                roll = parse_roll(campaign, post_data)
+                if len(roll.dices) == 0:
+                    print(f"The roll data {post_data} does not contain actual roll")
+                elif roll.name and roll.timestamp:
+                    # The last version of a roll wins
+                    batch.pop((roll.name, roll.timestamp), None)
+                    batch[(roll.name, roll.timestamp)] = roll
+                else:
+                    batch[next(unnamed), None] = roll
+            if len(batch) == 0:
+                break
+
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                # Remove old data if any to update
+                cur.execute("delete from temp.bulk_roll_keys")
+                cur.executemany("insert into temp.bulk_roll_keys(name, timestamp) values (?, ?)",
+                                [key for key in batch.keys() if key[1] is not None])
+                # "cross join" makes SQLite look up each key in the index instead of scanning the campaign
+                old_rolls = ("rowid in (select O.rowid from temp.bulk_roll_keys K cross join rolls O"
+                             " on O.campaign=? and O.name=K.name and O.timestamp=K.timestamp)")
+                update_aggregates(db, "R." + old_rolls, [campaign], sign=-1)
+                # Removing tests from the middle of the streaks needs a replay
+                cur.execute("update streaks set dirty = 1 where campaign=? and name in (select name from rolls"
+                            " where " + old_rolls + " and threshold > 0)", [campaign, campaign])
+                cur.execute("delete from rolls where " + old_rolls, [campaign])
+
+                # The write lock is held, so the ids of the new rolls can be chosen beforehand
+                first_roll_id = roll_id = _next_roll_id(cur)
+                by_columns = {}
+                dices = []
+                formula = []
+                energies = []
+                streaks = []
+                for roll in batch.values():
+                    by_columns.setdefault(roll.columns, []).append([roll_id] + roll.values)
+                    dices.extend([(roll_id, dice_type, dice_index, dice) for dice_type, dice_index, dice in roll.dices])
+                    formula.extend([(roll_id, element) for element in roll.formula])
+                    energies.extend([(roll_id, energy) for energy in roll.energies])
+                    result = _test_result(dict(zip(roll.columns, roll.values)))
+                    if result is not None:
+                        streaks.append((campaign, roll.name, result[0], roll_id))
+                    roll_id += 1
+                for columns, rows in by_columns.items():
+                    cur.executemany(roll_insert_cmd(("rowid",) + columns), rows)
+                cur.executemany(insert_dice_cmd, dices)
+                cur.executemany(insert_formula_cmd, formula)
+                cur.executemany(insert_energy_cmd, energies)
+                update_aggregates(db, "R.rowid >= ?", [first_roll_id])
+                cur.executemany(add_streak_cmd, streaks)  # In the order of the rolls
+                refresh_streaks(db, campaign)
+                bump_campaign_version(db, campaign)
+                db.commit()
+            except DatabaseError as e:
+                db.rollback()
+                print(f"Cannot insert a batch of rolls in database: {e}")
+                raise e
+
+            total += len(batch)
+            if progress is not None:
+                progress(total)
+    finally:
+        cur.close()
+    return total
+
+
 def get_players(db: Connection, campaign: str) -> List[str]:
     """Return the list of players"""
     cur = db.cursor()
@@ -111,12 +687,11 @@ def get_count_by_player(db: Connection, campaign: str, filter_player: Optional[s
     if filter_test:
         params.append(filter_test)
     try:
-        cur.execute('select "name",'
-                    ' count(rowid)'
-                    ' from rolls where campaign=? and threshold > 0'
+        cur.execute('select "name", sum(tests)'
+                    ' from roll_aggregates where campaign=?'
                     + (' and name=?' if filter_player else '')
                     + (' and reason=?' if filter_test else '')
-                    + ' group by "name"', params)
+                    + ' group by "name" having sum(tests) > 0', params)
         for row in cur.fetchall():
             counts[row[0]] = row[1]
     finally:
@@ -137,13 +712,11 @@ def get_success_failure_by_player(db: Connection, campaign: str, filter_player:
     if filter_test:
         params.append(filter_test)
     try:
-        cur.execute('select "name",'
-                    ' count(case when ((margin > 0 or critical_success) and not critical_failure) then 1 end),'
-                    ' count(rowid)'
-                    ' from rolls where campaign=? and threshold > 0'
+        cur.execute('select "name", sum(successes), sum(tests)'
+                    ' from roll_aggregates where campaign=?'
                     + (' and name=?' if filter_player else '')
                     + (' and reason=?' if filter_test else '')
-                    + ' group by "name"', params)
+                    + ' group by "name" having sum(tests) > 0', params)
         for row in cur.fetchall():
             rates[row[0]] = (row[1] / row[2] * 100, (row[2] - row[1]) / row[2] * 100)
     finally:
@@ -164,12 +737,11 @@ def get_critical_by_player(db: Connection, campaign: str, filter_player: Optiona
     if filter_test:
         params.append(filter_test)
     try:
-        cur.execute('select "name",'
-                    ' count(case when critical_success then 1 end), count(case when critical_failure then 1 end)'
-                    ' from rolls where campaign=? and threshold > 0'
+        cur.execute('select "name", sum(critical_successes), sum(critical_failures)'
+                    ' from roll_aggregates where campaign=?'
                     + (' and name=?' if filter_player else '')
                     + (' and reason=?' if filter_test else '')
-                    + ' group by "name"', params)
+                    + ' group by "name" having sum(tests) > 0', params)
         for row in cur.fetchall():
             data[row[0]] = (row[1], row[2])
     finally:
@@ -181,41 +753,30 @@ def get_critical_by_player(db: Connection, campaign: str, filter_player: Optiona
 def get_nimdir_index_by_player(db: Connection, campaign: str, filter_player: Optional[str] = None,
                                filter_test: Optional[str] = None) -> Dict[str, Tuple[int, int]]:
     """Return by player a tuple containing the streak of successes and the streak of failures in order"""
-    failures = {}
-    successes = {}
-    streaks = {}
-
-    cur = db.cursor()
-    params = [campaign]
-    if filter_player:
-        params.append(filter_player)
     if filter_test:
-        params.append(filter_test)
-    try:
-        cur.execute('select "name", ((margin > 0 or critical_success) and not critical_failure)'
-                    ' from rolls where campaign=? and threshold > 0'
-                    + (' and name=?' if filter_player else '')
-                    + (' and reason=?' if filter_test else '')
-                    + ' order by rowid asc', params)
-        for row in cur.fetchall():
-            streak = streaks.setdefault(row[0], (True, 0))
-            if bool(row[1]) == streak[0]:
-                streaks[row[0]] = (streak[0], streak[1] + 1)
-            else:
-                data = successes if streak[0] else failures
-                if data.get(row[0], 0) < streak[1]:
-                    data[row[0]] = streak[1]
-                streaks[row[0]] = (bool(row[1]), 1)
-
-        for name, streak in streaks.items():
-            data = successes if streak[0] else failures
-            if data.get(name, 0) < streak[1]:
-                data[name] = streak[1]
-    finally:
-        cur.close()
+        # The streaks of a test are not stored: replay them
+        names, streaks, _ = _replay_streaks(db, campaign, "R.reason=?" + (" and R.name=?" if filter_player else ""),
+                                            [filter_test] + ([filter_player] if filter_player else []))
+        return dict(sorted((name, (int(streaks.longest[i, 0]), int(streaks.longest[i, 1])))
+                           for i, name in enumerate(names)))
 
-    return {name: (successes.get(name, 0), failures.get(name, 0))
-            for name in sorted(list(set(list(successes.keys()) + list(failures.keys()))))}
+    data = {}
+    dirty = False
+    for name, success, length, completed_successes, completed_failures, is_dirty in db.execute(
+            "select name, success, length, completed_successes, completed_failures, dirty from streaks"
+            " where campaign=?" + (" and name=?" if filter_player else ""),
+            [campaign] + ([filter_player] if filter_player else [])):
+        if is_dirty:
+            dirty = True
+        elif length > 0:  # Players without test have no streak
+            data[name] = (max(completed_successes, length if success else 0),
+                          max(completed_failures, 0 if success else length))
+    if dirty:
+        names, streaks, _ = _replay_streaks(
+            db, campaign, "R.name in (select S.name from streaks S where S.campaign=R.campaign and S.dirty"
+                          + (" and S.name=?)" if filter_player else ")"), [filter_player] if filter_player else [])
+        data.update((name, (int(streaks.longest[i, 0]), int(streaks.longest[i, 1]))) for i, name in enumerate(names))
+    return dict(sorted(data.items()))
 
 
 def get_thresholds_by_player(db: Connection, campaign: str, filter_player: Optional[str] = None,
@@ -304,11 +865,10 @@ def get_formula_usage(db: Connection, campaign: str, filter_player: Optional[str
     if filter_test:
         params.append(filter_test)
     try:
-        cur.execute('select F.element, count(*) from formula_elements F inner join rolls R on F.roll=R.rowid'
-                    ' where R.campaign=?'
+        cur.execute('select element, sum(uses) from formula_aggregates where campaign=?'
                     + (' and name=?' if filter_player else '')
                     + (' and reason=?' if filter_test else '')
-                    + ' group by F.element', params)
+                    + ' group by element having sum(uses) > 0', params)
         for row in cur.fetchall():
             data[row[0]] = row[1]
     finally:
@@ -327,11 +887,10 @@ def get_energy_usage(db: Connection, campaign: str, filter_player: Optional[str]
     if filter_test:
         params.append(filter_test)
     try:
-        cur.execute('select E.energy, count(*) from invested_energies E inner join rolls R on E.roll=R.rowid'
-                    ' where R.campaign=?'
+        cur.execute('select energy, sum(uses) from energy_aggregates where campaign=?'
                     + (' and name=?' if filter_player else '')
                     + (' and reason=?' if filter_test else '')
-                    + ' group by E.energy', params)
+                    + ' group by energy having sum(uses) > 0', params)
         for row in cur.fetchall():
             base_energy = row[0].split("-")[-1]
             data[base_energy] = data.get(base_energy, 0) + row[1]
@@ -340,27 +899,52 @@ def get_energy_usage(db: Connection, campaign: str, filter_player: Optional[str]
     return data
 
 
+def _histogram_percentiles(values: Sequence[int], counts: Sequence[int],
+                           percentiles: Sequence[float]) -> Tuple[float, ...]:
+    """The percentiles of the samples counted by value (sorted), interpolated linearly as numpy.percentile does"""
+    cumulative = np.cumsum(counts)
+    positions = np.asarray(percentiles, dtype=np.float64) / 100 * (cumulative[-1] - 1)
+    values = np.asarray(values)
+    # The k-th sample of the sorted samples has the first value counted beyond k samples
+    lower = values[np.searchsorted(cumulative, np.floor(positions), side="right")]
+    upper = values[np.searchsorted(cumulative, np.ceil(positions), side="right")]
+    return tuple((lower + (upper - lower) * (positions - np.floor(positions))).tolist())
+
+
 def get_stats_by_test(db: Connection, campaign: str, filter_player: Optional[str] = None,
-                      filter_test: Optional[str] = None) -> List[Tuple[str, int, float, float]]:
-    """Return, for each test, its frequency, its average margin and its margin stddev"""
-    data = []
-    cur = db.cursor()
-    params = [campaign, campaign]
+                      filter_test: Optional[str] = None, percentiles: Sequence[float] = ()) -> List[Tuple]:
+    """
+    Return, for each test, its frequency, its average margin and its margin stddev, the most frequent first
+
+    The given percentiles (from 0 to 100) of the margins of each test are added as a last tuple element if any.
+    The rolls are read once: the variance is computed from the exact integer sums of the margins and of their
+    squares (or from the counts of each margin, to get the percentiles).
+    """
+    params = [campaign]
     if filter_player:
         params.append(filter_player)
     if filter_test:
         params.append(filter_test)
-    try:
-        cur.execute('select R.reason, count(rowid) as c, s.a, avg((R.margin - s.a) * (R.margin - s.a)) as var'
-                    ' from rolls R inner join'
-                    ' (select reason, avg(margin) AS a FROM rolls where campaign=? and threshold > 0 group by reason) s'
-                    ' on R.reason=s.reason'
-                    ' where campaign=? and threshold > 0'
-                    + (' and name=?' if filter_player else '')
-                    + (' and R.reason=?' if filter_test else '')
-                    + ' group by R.reason order by c desc', params)
-        for row in cur.fetchall():
-            data.append((row[0], row[1], row[2], math.sqrt(row[3])))
-    finally:
-        cur.close()
-    return data
+    condition = ' from rolls where campaign=? and threshold > 0 and reason is not null' \
+        + (' and name=?' if filter_player else '') + (' and reason=?' if filter_test else '')
+
+    sums = []
+    if len(percentiles) == 0:
+        sums = db.execute('select reason, count(*), sum(margin), sum(margin * margin)' + condition
+                          + ' group by reason', params).fetchall()
+    else:
+        histograms = {}
+        for reason, margin, count in db.execute('select reason, margin, count(*)' + condition
+                                                + ' group by reason, margin order by reason, margin', params):
+            histograms.setdefault(reason, []).append((margin, count))
+        for reason, histogram in histograms.items():
+            margins, counts = zip(*histogram)
+            sums.append((reason, sum(counts), sum(margin * count for margin, count in histogram),
+                         sum(margin * margin * count for margin, count in histogram),
+                         _histogram_percentiles(margins, counts, percentiles)))
+
+    data = []
+    for reason, count, margin_sum, square_sum, *extra in sums:
+        variance = (count * square_sum - margin_sum * margin_sum) / (count * count)
+        data.append((reason, count, margin_sum / count, math.sqrt(variance), *extra))
+    return sorted(data, key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,61 @@
+"""Messages sent by the Discord bot for each roll, to edit them when the roll is updated"""
+from collections import OrderedDict
+from sqlite3 import Connection
+from typing import Dict, Optional, Tuple
+
+MessageIds = Tuple[int, int]  # (channel id, message id)
+
+
+class MessageCache:
+    """
+    Ids of the last max_messages messages sent on each server, by roll key
+
+    Each server keeps its most recently used messages in memory and in the discord_messages table, so that the
+    rolls sent before a restart can still be edited.
+    """
+
+    def __init__(self, db: Connection, max_messages: int = 100):
+        self.db = db
+        self.max_messages = max_messages
+        self._servers: Dict[str, OrderedDict] = {}
+        self._clock = db.execute("select coalesce(max(last_used), 0) from discord_messages").fetchone()[0]
+
+    def _messages(self, server: str) -> OrderedDict:
+        messages = self._servers.get(server)
+        if messages is None:
+            rows = self.db.execute("select key, channel_id, message_id from discord_messages where server = ? "
+                                   "order by last_used", (server,))
+            messages = self._servers[server] = OrderedDict(
+                (key, (channel_id, message_id)) for key, channel_id, message_id in rows)
+            with self.db:
+                self._evict(server, messages)  # In case max_messages was lowered
+        return messages
+
+    def _evict(self, server: str, messages: OrderedDict) -> None:
+        evicted = []
+        while len(messages) > self.max_messages:
+            evicted.append((server, messages.popitem(last=False)[0]))
+        if evicted:
+            self.db.executemany("delete from discord_messages where server = ? and key = ?", evicted)
+
+    def _touch(self, server: str, key: str, ids: MessageIds) -> None:
+        self._clock += 1
+        self.db.execute("insert or replace into discord_messages(server, key, channel_id, message_id, last_used) "
+                        "values (?, ?, ?, ?, ?)", (server, key, ids[0], ids[1], self._clock))
+
+    def get(self, server: str, key: str) -> Optional[MessageIds]:
+        messages = self._messages(server)
+        ids = messages.get(key)
+        if ids is not None:
+            messages.move_to_end(key)
+            with self.db:
+                self._touch(server, key, ids)
+        return ids
+
+    def put(self, server: str, key: str, channel_id: int, message_id: int) -> None:
+        messages = self._messages(server)
+        messages[key] = (channel_id, message_id)
+        messages.move_to_end(key)
+        with self.db:
+            self._touch(server, key, (channel_id, message_id))
+            self._evict(server, messages)
@@ -0,0 +1,109 @@
+"""Scheduling of the messages of the Discord bot within the rate limits of the channels"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+import aiohttp
+import discord
+
+logger = logging.getLogger(__name__)
+
+
+class RateBucket:
+    """Token bucket allowing `rate` operations every `per` seconds (Discord allows 5 messages per 5s by channel)"""
+
+    def __init__(self, rate: int = 5, per: float = 5.0):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def acquire(self) -> float:
+        """Take a token and return the number of seconds to wait before using it"""
+        now = time.monotonic()
+        self.tokens = min(float(self.rate), self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens * self.per / self.rate
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a request failed with an error worth retrying: rate limited, server or network error"""
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (ConnectionError, asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+class ChannelScheduler:
+    """
+    Process the items submitted for a channel in order, without exceeding its rate limit
+
+    Items are identified by a key (a roll of a character): an item submitted while another one with the same key
+    is still waiting replaces it in place, so a roll updated many times in a row costs a single request.
+    An item failing with a transient error is submitted again after retry_delay seconds, doubled after each
+    failure up to max_retry_delay, unless another item with the same key was submitted meanwhile.
+    An item failing with another error, or max_attempts times, is dropped: it is handed to `drop` (if any).
+    """
+
+    def __init__(self, process: Callable[[Hashable, Any], Awaitable], bucket: Optional[RateBucket] = None,
+                 retry_delay: float = 1.0, max_retry_delay: float = 300.0, max_attempts: int = 10,
+                 drop: Optional[Callable[[Hashable, Any], Awaitable]] = None,
+                 transient: Callable[[Exception], bool] = is_transient):
+        self.process = process
+        self.bucket = bucket if bucket is not None else RateBucket()
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.drop = drop
+        self.transient = transient
+        self._pending = OrderedDict()
+        self._failures = {}  # Number of consecutive failures of the last item of each key
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def submit(self, key: Hashable, item: Any) -> None:
+        self._failures.pop(key, None)  # Cancels the retry of the previous item
+        self._enqueue(key, item)
+
+    def _retry(self, key: Hashable, item: Any, failures: int) -> None:
+        if self._failures.get(key) == failures and key not in self._pending:
+            self._enqueue(key, item)
+
+    def _enqueue(self, key: Hashable, item: Any) -> None:
+        self._pending[key] = item  # An existing key keeps its place
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            delay = self.bucket.acquire()
+            if delay > 0:
+                await asyncio.sleep(delay)  # The updates received meanwhile are coalesced
+            key, item = self._pending.popitem(last=False)
+            try:
+                await self.process(key, item)
+            except Exception as e:
+                failures = self._failures[key] = self._failures.get(key, 0) + 1
+                if self.transient(e) and failures < self.max_attempts:
+                    delay = min(self.max_retry_delay, self.retry_delay * 2 ** (failures - 1))
+                    logger.exception("Processing of %s failed, retrying in %.1fs", key, delay)
+                    asyncio.get_event_loop().call_later(delay, self._retry, key, item, failures)
+                    continue
+                logger.exception("Processing of %s failed %d times, dropped", key, failures)
+                del self._failures[key]
+                if self.drop is not None:
+                    try:
+                        await self.drop(key, item)
+                    except Exception:
+                        logger.exception("Drop of %s failed", key)
+            else:
+                self._failures.pop(key, None)  # Cancels the retry of an older item
@@ -11,16 +11,19 @@ import sys
 import configparser
 import collections as col
 import string
-from pathlib import Path
+from datetime import datetime, timezone
 
-from flask import Flask, current_app, request, Response, render_template, abort
+from flask import Flask, current_app, request, Response, render_template, abort, jsonify, stream_with_context
 from markupsafe import escape
 
-from db import init_db_connection, insert_roll, create_db, get_stats_by_test, get_players
-from discord_bot import roll_queue, init_bot, close_bot
+from db import ConnectionPool, create_db, get_campaign_version, store_event
+from ingest import RollWriter
+from events import EventHub, EventRelay
+from sheets import SheetCache, load_sheet, store_sheet, record_version, get_changes, sheet_lock, release_blob, \
+    sheet_delta
 
-from graph import success_failure_by_player, critical_by_player, nimdir_index_by_player, base_dice_distributions, \
-    formula_usage, energy_usage, roll_count, magins_distributions, thresholds_distributions
+from graph import GraphCache, render_graphs
+from stats import CampaignStats
 
 ## config meta data ##
 default_section = 'Common'
@@ -34,6 +37,10 @@ bind_ip = ConfigField('bind_ip', 'str', False, '127.0.0.1')
 port = ConfigField('port', 'int', False, '8080')
 root_dir = ConfigField('root_directory', 'str', True, None)
 campaign_dir = ConfigField('campaign_directory', 'str', False, 'campaigns')
+objects_dir = ConfigField('objects_directory', 'str', False, 'objects')
+sheet_cache_size = ConfigField('sheet_cache_size', 'int', False, 67108864)
+sheet_history_length = ConfigField('sheet_history_length', 'int', False, 50)
+sheet_history_size = ConfigField('sheet_history_size', 'int', False, 1048576)
 empty_campaign_msg = ConfigField('empty_campaign_msg', 'str', False,
                                  'This campaign is empty.')
 no_such_campaign_msg = ConfigField('no_such_campaign_msg', 'str', False,
@@ -48,6 +55,18 @@ max_discord_messages_by_server = ConfigField('max_discord_messages_by_server', '
 discord_channel_id = ConfigField('discord_channel_id', 'str', False, None)
 discord_msg_type = ConfigField('discord_msg_type', 'str', False, None)
 database_path = ConfigField('database_path', 'str', False, "roll.sqlite3")
+db_pool_size = ConfigField('db_pool_size', 'int', False, 4)
+db_busy_timeout = ConfigField('db_busy_timeout', 'int', False, 5000)
+db_journal_mode = ConfigField('db_journal_mode', 'str', False, 'wal')
+db_synchronous = ConfigField('db_synchronous', 'str', False, 'normal')
+db_cache_size = ConfigField('db_cache_size', 'int', False, -16000)
+db_mmap_size = ConfigField('db_mmap_size', 'int', False, 268435456)
+roll_batch_size = ConfigField('roll_batch_size', 'int', False, 64)
+roll_batch_delay = ConfigField('roll_batch_delay', 'int', False, 5)
+event_history = ConfigField('event_history', 'int', False, 256)
+event_heartbeat = ConfigField('event_heartbeat', 'int', False, 15)
+event_poll_interval = ConfigField('event_poll_interval', 'int', False, 50)
+graph_cache_size = ConfigField('graph_cache_size', 'int', False, 64)
 
 config_meta = {
                 default_section: [
@@ -55,6 +74,10 @@ config_meta = {
                     port,
                     root_dir,
                     campaign_dir,
+                    objects_dir,
+                    sheet_cache_size,
+                    sheet_history_length,
+                    sheet_history_size,
                     empty_campaign_msg,
                     no_such_campaign_msg,
                     no_such_sheet_msg,
@@ -62,7 +85,19 @@ config_meta = {
                     form_page,
                     discord_bot_token,
                     max_discord_messages_by_server,
-                    database_path
+                    database_path,
+                    db_pool_size,
+                    db_busy_timeout,
+                    db_journal_mode,
+                    db_synchronous,
+                    db_cache_size,
+                    db_mmap_size,
+                    roll_batch_size,
+                    roll_batch_delay,
+                    event_history,
+                    event_heartbeat,
+                    event_poll_interval,
+                    graph_cache_size,
                 ],
 
                 campaign_section : [
@@ -95,7 +130,8 @@ def setup(app, config=None):
     try:
         root_path = config[default_section][root_dir.name]
         campaign_path = os.path.join(root_path, config[default_section][campaign_dir.name])
-        for path in [root_path, campaign_path]:
+        objects_path = get_objects_path(config[default_section])
+        for path in [root_path, campaign_path, objects_path]:
             if not os.path.isdir(path):
                 os.mkdir(path)
         campaign_configs = dict(config)
@@ -105,24 +141,42 @@ def setup(app, config=None):
         raise
     app.local_config = config[default_section]
     app.campaign_configs = campaign_configs
-    token = app.local_config.get(discord_bot_token.name)
-    max_messages = int(app.local_config.get(max_discord_messages_by_server.name,
-                                            max_discord_messages_by_server.default_value))
+    app.sheet_cache = SheetCache(int(app.local_config.get(sheet_cache_size.name, sheet_cache_size.default_value)))
+    app.graph_cache = GraphCache(int(app.local_config.get(graph_cache_size.name, graph_cache_size.default_value)))
     # Setup database
     db_path = app.local_config.get(database_path.name, database_path.default_value)
-    if not os.path.exists(db_path):
-        create_db(db_path)
-    if token is not None:
-        init_bot(token, max_messages)
+    create_db(db_path)
+    if getattr(app, 'db_pool', None) is not None:
+        app.db_pool.close()
+    app.db_pool = ConnectionPool(
+        db_path,
+        size=int(app.local_config.get(db_pool_size.name, db_pool_size.default_value)),
+        busy_timeout=int(app.local_config.get(db_busy_timeout.name, db_busy_timeout.default_value)),
+        journal_mode=app.local_config.get(db_journal_mode.name, db_journal_mode.default_value),
+        synchronous=app.local_config.get(db_synchronous.name, db_synchronous.default_value),
+        cache_size=int(app.local_config.get(db_cache_size.name, db_cache_size.default_value)),
+        mmap_size=int(app.local_config.get(db_mmap_size.name, db_mmap_size.default_value)))
+    if getattr(app, 'roll_writer', None) is not None:
+        app.roll_writer.close()
+    app.roll_writer = RollWriter(
+        app.db_pool,
+        max_batch=int(app.local_config.get(roll_batch_size.name, roll_batch_size.default_value)),
+        max_delay=int(app.local_config.get(roll_batch_delay.name, roll_batch_delay.default_value)) / 1000)
+    # The events are stored in the database by the process receiving them and relayed to the feeds of every worker
+    if getattr(app, 'event_relay', None) is not None:
+        app.event_relay.close()
+    app.event_hub = EventHub(int(app.local_config.get(event_history.name, event_history.default_value)),
+                             relayed=True)
+    app.event_relay = EventRelay(
+        app.event_hub,
+        app.db_pool,
+        poll_interval=int(app.local_config.get(event_poll_interval.name, event_poll_interval.default_value)) / 1000)
     return app
 
 def run(app):
     app.run(host=app.local_config[bind_ip.name],
             port=app.local_config[port.name],
             debug=True)
-    token = app.local_config.get(discord_bot_token.name)
-    if token is not None:
-        close_bot()
 
 def sanitize(data):
     """
@@ -140,23 +194,39 @@ def get_campaign_path(campaign_id, config):
                                config[campaign_dir.name],
                                campaign_id)
 
+def get_objects_path(config):
+    """
+        Return the path to the directory of the (compressed) sheet contents
+    """
+    return os.path.join(config[root_dir.name],
+                        config.get(objects_dir.name, objects_dir.default_value))
+
 def get_campaign(path):
     """
         Returns the list of sheet in the campaign or None if the campaign does
         not exist
     """
     if os.path.isdir(path):
-        return os.listdir(path)
+        return [sheet for sheet in os.listdir(path) if not sheet.startswith('.')]
     return None
 
+def campaign_exists(campaign_id):
+    """
+        Returns whether the campaign has sheets (or had), rolls or a
+        configuration
+    """
+    campaign_id = sanitize(campaign_id)
+    if campaign_id in app.campaign_configs \
+            or os.path.isdir(get_campaign_path(campaign_id, app.local_config)):
+        return True
+    with app.db_pool.connection() as db:
+        return get_campaign_version(db, campaign_id) > 0
+
 def get_sheet_path(campaign_id, sheet_id, config):
     campaign_id = sanitize(campaign_id)
     sheet_id = sanitize(sheet_id)
     return os.path.join(get_campaign_path(campaign_id, config), sheet_id)
 
-def get_file_content(path):
-    return Path(path).read_text()
-
 def create_campaign(path):
     """
         For now, just create the directory
@@ -164,6 +234,8 @@ def create_campaign(path):
     if not os.path.isdir(path):
         try:
             os.mkdir(path)
+        except FileExistsError:  # Created by a concurrent push
+            pass
         except:
             print('ERROR: problem during campaign setup!', file=sys.stderr)
             raise
@@ -194,14 +266,47 @@ def view_sheet(campaign_id, sheet_id):
     if san_sheet_id != sheet_id:
         return app.local_config[no_such_sheet_msg.name] + ' ' + campaign_id
     campaign_path = get_campaign_path(campaign_id, app.local_config)
-    campaign_list = get_campaign(campaign_path)
-    if campaign_list is None:
+    if not os.path.isdir(campaign_path):
         return app.local_config[no_such_campaign_msg.name] + ' ' + campaign_id
-    if sheet_id in campaign_list:
-        return get_file_content(
-                    get_sheet_path(campaign_id, sheet_id, app.local_config))
+    sheet_path = get_sheet_path(campaign_id, sheet_id, app.local_config)
+    try:
+        modified = os.lstat(sheet_path).st_mtime
+    except FileNotFoundError:
+        modified = None
+    sheet = load_sheet(sheet_path, app.sheet_cache) if modified is not None else None
+    if sheet is not None:
+        gzipped = sheet.compressed and request.accept_encodings['gzip'] > 0
+        if gzipped:
+            # Serve the stored bytes as is
+            resp = Response(sheet.data, content_type='text/html; charset=utf-8')
+            resp.headers['Content-Encoding'] = 'gzip'
+        else:
+            resp = Response(sheet.text(), content_type='text/html; charset=utf-8')
+        resp.vary.add('Accept-Encoding')
+        # Each encoding of the content is a different representation, with its own strong ETag
+        resp.set_etag(sheet.digest + ('-gzip' if gzipped else ''))
+        resp.last_modified = datetime.fromtimestamp(modified, timezone.utc)
+        resp.cache_control.no_cache = True
+        return resp.make_conditional(request)
     return app.local_config[no_such_sheet_msg.name] + ' ' + sheet_id + ' ' + campaign_id
 
+@app.route('/diff/<campaign_id>/<sheet_id>')
+def view_sheet_changes(campaign_id, sheet_id):
+    """
+        Returns in JSON the changes of a sheet since the version given by
+        the "since" parameter (see sheets.get_changes)
+    """
+    campaign_id = sanitize(campaign_id)
+    if sanitize(sheet_id) != sheet_id:
+        return app.local_config[no_such_sheet_msg.name] + ' ' + campaign_id
+    if not os.path.isdir(get_campaign_path(campaign_id, app.local_config)):
+        return app.local_config[no_such_campaign_msg.name] + ' ' + campaign_id
+    changes = get_changes(get_sheet_path(campaign_id, sheet_id, app.local_config),
+                          request.args.get('since', 0, type=int), app.sheet_cache)
+    if changes is None:
+        return app.local_config[no_such_sheet_msg.name] + ' ' + sheet_id + ' ' + campaign_id
+    return jsonify(changes)
+
 @app.route('/push/<campaign_id>/<sheet_id>', methods=['POST'])
 def push_sheet(campaign_id, sheet_id):
     campaign_path = get_campaign_path(campaign_id, app.local_config)
@@ -210,19 +315,38 @@ def push_sheet(campaign_id, sheet_id):
     sheet_path = get_sheet_path(campaign_id, sheet_id, app.local_config)
     f_name = app.local_config[form_name.name]
     f_page = app.local_config[form_page.name]
-    Path(sheet_path).write_text(request.form[f_page])
+    content = request.form[f_page]
+    # The delta is computed before taking the lock, so that the pushes of the sheet do not wait for it
+    base_sheet = load_sheet(sheet_path, app.sheet_cache)
+    delta = sheet_delta(base_sheet.text(), content) if base_sheet is not None else None
+    # The history records the delta from the sheet replaced by this push, not by a concurrent one
+    with sheet_lock(sheet_path):
+        old_sheet = load_sheet(sheet_path, app.sheet_cache)
+        if old_sheet is not None and (base_sheet is None or old_sheet.digest != base_sheet.digest):
+            delta = sheet_delta(old_sheet.text(), content)  # Replaced by a concurrent push meanwhile
+        sheet = store_sheet(sheet_path, get_objects_path(app.local_config), content)
+        version = record_version(
+            sheet_path, old_sheet, sheet, delta,
+            max_deltas=int(app.local_config.get(sheet_history_length.name, sheet_history_length.default_value)),
+            max_size=int(app.local_config.get(sheet_history_size.name, sheet_history_size.default_value)))
+        if old_sheet is not None and old_sheet.compressed and old_sheet.digest != sheet.digest:
+            release_blob(get_objects_path(app.local_config), os.path.dirname(campaign_path), old_sheet.digest)
+    if old_sheet is not None and old_sheet.digest != sheet.digest:
+        app.sheet_cache.discard(old_sheet.digest)
+    app.sheet_cache.put(sheet)
+    if old_sheet is None or old_sheet.digest != sheet.digest:
+        with app.db_pool.connection() as db:
+            store_event(db, sanitize(campaign_id), 'sheet',
+                        {"sheet": sanitize(sheet_id), "version": version, "digest": sheet.digest})
     resp = Response("OK")
     resp.headers['Access-Control-Allow-Origin'] = '*'
     return resp
 
 @app.route('/roll/<campaign_id>', methods=['POST'])
 def push_roll(campaign_id):
-    # Save the roll in database
-    with init_db_connection(app.local_config.get(database_path.name, database_path.default_value)) as db:
-        insert_roll(db, campaign_id, dict(request.form))
     # Get discord server, if any, matching the campaign
     server_id = app.campaign_configs.get(campaign_id, {}).get(discord_server_id.name)
-    print(f"SERVER OK: {server_id}")
+    discord_roll = None
     if server_id is not None:
         channel_id = app.campaign_configs.get(campaign_id, {}).get(discord_channel_id.name)
         msg_type = app.campaign_configs.get(campaign_id, {}).get(discord_msg_type.name)
@@ -230,32 +354,72 @@ def push_roll(campaign_id):
         item[discord_server_id.name] = server_id
         item[discord_channel_id.name] = channel_id
         item[discord_msg_type.name] = msg_type
-        roll_queue.put(item)
+        # Sent by the bot process (discord_bot.py), the updates of a roll edit its first message
+        discord_roll = (server_id, f'{item.get("name")}-{item.get("timestamp")}', item)
+    # Save the roll in database (along with the rolls received meanwhile by the other threads)
+    # and queue it for the bot and the live feeds in the same transaction
+    app.roll_writer.submit(campaign_id, dict(request.form), discord_roll,
+                           event=(sanitize(campaign_id), 'roll', dict(request.form)))
     resp = Response("OK")
     resp.headers['Access-Control-Allow-Origin'] = '*'
     return resp
 
+@app.route('/events/<campaign_id>')
+def campaign_events(campaign_id):
+    """
+        Server-Sent Events feed of the new rolls ("roll" events, with the
+        roll data) and sheets ("sheet" events, with the sheet id, version and
+        digest) of a campaign
+    """
+    if not campaign_exists(campaign_id):
+        return app.local_config[no_such_campaign_msg.name] + ' ' + campaign_id
+    app.event_relay.start()
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    heartbeat = int(app.local_config.get(event_heartbeat.name, event_heartbeat.default_value))
+    resp = Response(stream_with_context(app.event_hub.stream(sanitize(campaign_id), last_id, heartbeat)),
+                    mimetype='text/event-stream')
+    resp.cache_control.no_cache = True
+    resp.headers['X-Accel-Buffering'] = 'no'
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+@app.route('/events/<campaign_id>/poll')
+def poll_campaign_events(campaign_id):
+    """
+        Long-polling alternative to the events feed: returns in JSON the
+        events after the one with the id "since", waiting for one up to
+        "timeout" seconds
+    """
+    app.event_relay.start()
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify(last_id=app.event_hub.last_id(), events=[])
+    heartbeat = int(app.local_config.get(event_heartbeat.name, event_heartbeat.default_value))
+    timeout = min(request.args.get('timeout', heartbeat, type=float), heartbeat)
+    if not campaign_exists(campaign_id):
+        return app.local_config[no_such_campaign_msg.name] + ' ' + campaign_id
+    events = app.event_hub.wait(sanitize(campaign_id), since, timeout)
+    resp = jsonify(last_id=events[-1][0] if events else since,
+                   events=[{"id": event_id, "type": event_type, "data": data}
+                           for event_id, event_type, data in events])
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
 @app.route('/graphs/<campaign>', methods=['GET'])
 def view_graph_page(campaign):
     player = request.args.get("player")
     test = request.args.get("test")
-    with init_db_connection(app.local_config.get(database_path.name, database_path.default_value)) as db:
-        players = get_players(db, campaign)
-        return render_template("graphs.html", campaign=campaign, filter_player=player, filter_test=test,
-                               players=get_players(db, campaign),
-                               test_stats=get_stats_by_test(db, campaign, filter_player=player, filter_test=test),
-                               success_failure_by_player=success_failure_by_player(db, campaign, player=player,
-                                                                                   test=test),
-                               critical_by_player=critical_by_player(db, campaign, player=player, test=test),
-                               nimdir_index_by_player=nimdir_index_by_player(db, campaign, player=player, test=test),
-                               base_dice_distributions=base_dice_distributions(db, campaign, player=player, test=test),
-                               formula_usage=formula_usage(db, campaign, player=player, test=test),
-                               energy_usage=energy_usage(db, campaign, player=player, test=test),
-                               roll_count=roll_count(db, campaign, player=player, test=test),
-                               thresholds_distributions=thresholds_distributions(db, campaign, player=player,
-                                                                                 test=test) if players else {},
-                               magins_distributions=magins_distributions(db, campaign, player=player,
-                                                                         test=test) if players else {})
+    key = (campaign, player, test)
+    with app.db_pool.connection() as db:
+        # Read before the rolls: the page is at least as recent as its version
+        version = get_campaign_version(db, campaign)
+        graphs = app.graph_cache.get(key, version)
+        if graphs is None:
+            stats = CampaignStats(db, campaign, filter_player=player, filter_test=test)
+    if graphs is None:
+        graphs = render_graphs(stats)
+        app.graph_cache.put(key, version, graphs)
+    return render_template("graphs.html", campaign=campaign, filter_player=player, filter_test=test, **graphs)
 
 
 if __name__ == '__main__':
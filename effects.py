@@ -0,0 +1,131 @@
+"""Effect tables of Simulacres: the effect of a throw (MR + effect dices) in each column, from A to K"""
+import logging
+import re
+from functools import lru_cache
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+letters = 'ABCDEFGHIJK'
+letter_indexes = {letter: i for i, letter in enumerate(letters)}
+base_table = (
+#    0  1  2  3  4  5  6  7  8  9  10 11 12 13 14 15 16 17 18 19 20 21 22 23 24 25 26
+    (0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3),   # A
+    (0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 4, 4, 4, 4),   # B
+    (0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5),   # C
+    (0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 2, 2, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5, 6, 6, 6, 6),   # D
+    (0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 3, 3, 3, 3, 3, 4, 4, 4, 4, 6, 6, 6, 6, 8, 8, 8, 8),   # E
+    (0, 0, 0, 1, 2, 2, 2, 2, 2, 2, 3, 3, 4, 4, 4, 4, 4, 4, 4, 6, 6, 6, 6, 8, 8, 8, 8),   # F
+    (0, 0, 0, 1, 2, 2, 2, 3, 3, 3, 3, 3, 4, 4, 4, 5, 5, 5, 5, 7, 7, 7, 7, 9, 9, 9, 9),   # G
+    (0, 0, 0, 1, 2, 2, 2, 3, 3, 3, 4, 4, 5, 5, 5, 6, 6, 6, 6, 8, 8, 8, 8, 9, 9, 9, 9),   # H
+    (0, 0, 0, 1, 2, 2, 2, 4, 4, 4, 4, 4, 5, 5, 5, 6, 6, 6, 6, 8, 8, 8, 8, 10,10,10,10),  # I
+    (0, 0, 0, 1, 3, 3, 3, 4, 4, 4, 5, 5, 6, 6, 6, 8, 8, 8, 8, 10,10,10,10,12,12,12,12),  # J
+    (0, 0, 0, 1, 3, 3, 3, 5, 5, 5, 5, 5, 6, 6, 6, 8, 8, 8, 8, 10,10,10,10,12,12,12,12),  # K
+)
+# Beyond the table, the effect increases by this step every 4 points
+increments = (1, 1, 2, 2, 2, 2, 3, 3, 4, 4, 6)
+max_throw = 255
+
+
+def _overflow_effects(indexes: np.ndarray, throws: np.ndarray) -> np.ndarray:
+    last = len(base_table[0]) - 1
+    last_values = np.array([row[-1] for row in base_table])[indexes]
+    return last_values + -((last - throws) // 4) * np.array(increments)[indexes]
+
+
+def _compile_table() -> np.ndarray:
+    throws = np.arange(max_throw + 1)
+    indexes = np.arange(len(letters))[:, np.newaxis]
+    table = _overflow_effects(indexes, throws[np.newaxis, :])
+    table[:, :len(base_table[0])] = base_table
+    table.setflags(write=False)
+    return table
+
+
+effect_array = _compile_table()  # effect_array[letter index, throw] for the throws 0 to max_throw
+_effect_rows = tuple(tuple(row) for row in effect_array.tolist())  # Faster than numpy for a single value
+
+
+def effect_values(indexes: Union[int, np.ndarray], throws: Union[int, np.ndarray]) -> np.ndarray:
+    """Return the effects of the throws in the columns of the given letter indexes (broadcast together)"""
+    indexes, throws = np.broadcast_arrays(np.asarray(indexes), np.asarray(throws))
+    values = effect_array[indexes, np.clip(throws, 0, max_throw)]
+    over = throws > max_throw
+    if over.any():
+        values = np.where(over, _overflow_effects(indexes, throws), values)
+    return np.where(throws < 0, 0, values)
+
+
+def get_effect(letter: str, throw: int, modif: Optional[int] = None) -> int:
+    if modif is not None:
+        throw += modif
+    index = letter_indexes.get(letter)
+    if index is None or throw < 0:
+        return 0
+    if throw <= max_throw:
+        return _effect_rows[index][throw]
+    return int(_overflow_effects(np.array(index), np.array(throw)))
+
+
+pat_effect = re.compile(r'\[\s?([ABCDEFGHIJK])\s?([+-]\s?[1-9])?\s?\]')
+
+
+class EffectTemplate(NamedTuple):
+    """An effect description, split around its "MR" and its [letter +modifier] references to the tables"""
+    literals: Tuple[Tuple[str, ...], ...]  # The text around each reference, split on "MR"
+    references: Tuple[Tuple[int, int], ...]  # (letter index, modifier)
+
+    def render(self, mr: int, effect_dices: int) -> str:
+        throw = mr + effect_dices
+        mr_text = str(mr)
+        parts = [mr_text.join(self.literals[0])]
+        for (index, modif), literal in zip(self.references, self.literals[1:]):
+            value = throw + modif
+            parts.append(str(_effect_rows[index][value] if 0 <= value <= max_throw
+                             else get_effect(letters[index], value)))
+            parts.append(mr_text.join(literal))
+        return ''.join(parts)
+
+    def values(self, margins: np.ndarray, effect_dices: np.ndarray) -> np.ndarray:
+        """Return the value of each reference for each roll, as an array of shape (rolls, references)"""
+        throws = np.asarray(margins) + np.asarray(effect_dices)
+        if not self.references:
+            return np.zeros((len(throws), 0), dtype=effect_array.dtype)
+        indexes, modifs = (np.array(column) for column in zip(*self.references))
+        return effect_values(indexes[np.newaxis, :], throws[:, np.newaxis] + modifs[np.newaxis, :])
+
+
+@lru_cache(maxsize=1024)
+def compile_effect(effect_desc: str) -> EffectTemplate:
+    literals = []
+    references = []
+    start = 0
+    for match in pat_effect.finditer(effect_desc):
+        literals.append(tuple(effect_desc[start:match.start()].split('MR')))
+        modif = match.group(2)
+        references.append((letter_indexes[match.group(1)], 0 if modif is None else int(modif.replace(' ', ''))))
+        start = match.end()
+    literals.append(tuple(effect_desc[start:].split('MR')))
+    return EffectTemplate(tuple(literals), tuple(references))
+
+
+def build_effect(effect_desc: str, mr: int, effect_dices: int) -> str:
+    """Return the effect description with its MR and table references replaced by their values"""
+    result = compile_effect(effect_desc).render(mr, effect_dices)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("build_effect(%r, %s, %s) = %r", effect_desc, mr, effect_dices, result)
+    return result
+
+
+def effect_distribution(letter: str, margin: int, modif: int = 0, dices: int = 1,
+                        sides: int = 6) -> Dict[int, float]:
+    """Return the probability of each effect in the column of the letter for a margin, over the effect dices"""
+    sums = np.ones(1)
+    for _ in range(dices):
+        sums = np.convolve(sums, np.full(sides, 1 / sides))
+    throws = margin + modif + dices + np.arange(len(sums))
+    values = effect_values(letter_indexes[letter], throws)
+    probabilities = np.bincount(values, weights=sums)
+    return {int(value): float(probabilities[value]) for value in np.flatnonzero(probabilities)}
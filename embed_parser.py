@@ -0,0 +1,191 @@
+"""Parsing of the roll embeds posted by the Discord bot (see roll_render.py) back into rolls"""
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from discord import Embed
+
+color_critical_mapping = {
+    # color_code: (is_success, is_critical_success, is_critical_failure)
+    0xff0000: (False, False, True),
+    0xa70101: (False, False, False),
+    0x01890a: (True, False, False),
+    0x00ff11: (True, True, False),
+    0x0066cc: (True, False, False)
+}
+
+emoji_to_db_value = {
+    "one": 1,
+    "two": 2,
+    "three": 3,
+    "four": 4,
+    "five": 5,
+    "six": 6
+}
+
+emoji_pattern = re.compile(r"<:(\w+):\d+>")
+# A dice: its emoji, the name of the emoji if the bot did not see it, or its value without emoji
+dice_pattern = re.compile(r"<:(\w+):\d+>|(\w+)")
+no_dices = ("", "-")  # The field of the dices when there are none
+title_pattern = re.compile(r"(.*?) \(niveau (-?\d+)\)")
+max_value_pattern = re.compile(r"\((-?\d+)\)[^(]*$")
+result_pattern = re.compile(r".* sous (-?\d+)\nMR : (-?\d+)$", re.DOTALL)
+
+Dices = Tuple[int, ...]
+
+
+class EmbedRoll(NamedTuple):
+    """A roll read from its embed, the optional fields are None when the embed does not show them"""
+    name: str
+    critical_success: bool
+    critical_failure: bool
+    reason: Optional[str]  # None for a roll without talent
+    talent_level: int
+    formula: Tuple[str, ...]
+    max_value: int
+    base_dices: Optional[Dices] = None
+    threshold: Optional[int] = None
+    margin: Optional[int] = None
+    effect_dices: Optional[Dices] = None
+    power_dices: Optional[Dices] = None
+    critical_dices: Optional[Dices] = None
+    effect_modifier: Optional[int] = None
+    effect: Optional[str] = None  # MR and columns are already replaced
+
+    def post_data(self, timestamp: str) -> Dict[str, Union[int, str, None]]:
+        """Return the roll as the POST data of the dynamic sheet, for insert_roll"""
+        data = {"name": self.name, "timestamp": timestamp, "recording": "false",
+                "critical_success": "true" if self.critical_success else "false",
+                "critical_failure": "true" if self.critical_failure else "false",
+                "reason": self.reason, "talent_level": self.talent_level,
+                "formula_elements": ",".join(self.formula), "max_value": self.max_value}
+        if self.base_dices is not None:
+            data["base_dices"] = _join(self.base_dices)
+            data["number"] = len(self.base_dices)
+            data["type"] = 6  # XXX Cannot spot focus rolls
+        if self.effect_dices is not None:
+            data["effect_dices"] = _join(self.effect_dices)
+        if self.power_dices is not None:
+            data["power_dices"] = _join(self.power_dices)
+            # Add 1 power as invested energy by number of power_dices
+            data["optional_power"] = len(self.power_dices)
+            data["invested_energies"] = "optional-power"
+        if self.critical_dices is not None:
+            data["critical_dices"] = _join(self.critical_dices)
+        if self.effect_modifier is not None:
+            data["effect_modifier"] = self.effect_modifier
+        if self.threshold is not None:
+            data["threshold"] = self.threshold
+            data["margin"] = self.margin
+        if self.effect is not None:
+            data["effect"] = self.effect
+        return data
+
+
+def _join(dices: Dices) -> str:
+    return ",".join(map(str, dices))
+
+
+def _dice(token: str) -> int:
+    match = dice_pattern.fullmatch(token)
+    if match is None:
+        raise ValueError(f"Invalid dice {token!r}")
+    name = match.group(1) or match.group(2)
+    if name in emoji_to_db_value:
+        return emoji_to_db_value[name]
+    if name.isdigit():
+        return int(name)
+    raise ValueError(f"Invalid dice {token!r}")
+
+
+@lru_cache(maxsize=4096)
+def _dices(value: str) -> Dices:
+    """The dices of a field, as the bot shows them with the emojis of the server, their names or their values"""
+    if value.strip() in no_dices:
+        return ()
+    return tuple(_dice(token) for token in value.split())
+
+
+@lru_cache(maxsize=1024)
+def _title(title: str) -> Tuple[Optional[str], int]:
+    match = title_pattern.match(title)
+    return (match.group(1), int(match.group(2))) if match else (None, 0)
+
+
+@lru_cache(maxsize=1024)
+def _description(description: str) -> Tuple[Tuple[str, ...], int]:
+    """The formula and the maximum value of the roll"""
+    match = max_value_pattern.search(description)
+    if match is None:
+        raise ValueError(f"Invalid description {description!r}")
+    return tuple(emoji_pattern.findall(description.partition("(")[0])), int(match.group(1))
+
+
+def _result(values: Dict, value: str):
+    if "sous" not in value:  # A simple roll
+        values["threshold"] = values["margin"] = 0
+        return
+    match = result_pattern.match(value)
+    if match is None:
+        raise ValueError(f"Invalid result {value!r}")
+    values["threshold"], values["margin"] = int(match.group(1)), int(match.group(2))
+
+
+def _field(attribute: str, parse: Callable[[str], Any]) -> Callable[[Dict, str], None]:
+    def parse_field(values: Dict, value: str):
+        values[attribute] = parse(value)
+    return parse_field
+
+
+# The name of the field of the embed to its parsing into the attributes of the roll
+field_parsers = {
+    "Lancer": _field("base_dices", _dices),
+    "Dés d'Effet": _field("effect_dices", _dices),
+    "Dés de Puissance": _field("power_dices", _dices),
+    "Dés Critiques": _field("critical_dices", _dices),
+    "Modif. effet": _field("effect_modifier", int),
+    "Résultat": _result,
+    "Effet": _field("effect", str),
+}
+
+
+def _embed_dict(embed: Union[Embed, Dict]) -> Tuple[Dict, Optional[int], Optional[str], Optional[str], List[Dict]]:
+    """The author, color, title, description and fields of the embed in the format of Embed.to_dict"""
+    if isinstance(embed, dict):
+        return (embed.get("author") or {}, embed.get("color"), embed.get("title"), embed.get("description"),
+                embed.get("fields", ()))
+    # The data of the Embed as to_dict reads it, without the copies of the public EmbedProxy attributes
+    return (getattr(embed, "_author", None) or {}, getattr(getattr(embed, "_colour", None), "value", None), embed.title,
+            embed.description, getattr(embed, "_fields", ()))
+
+
+def parse_embed(embed: Union[Embed, Dict]) -> Optional[EmbedRoll]:
+    """Return the roll of an embed posted by the bot (or of its dict form) or None if it is not a valid roll"""
+    author, color, title, description, fields = _embed_dict(embed)
+    criticals = color_critical_mapping.get(color)
+    name = (author.get("name") or "")[1:]
+    if criticals is None or not name:
+        return None  # Not a parsable embed
+    _, critical_success, critical_failure = criticals
+
+    try:
+        # The titles, descriptions and dices repeat a lot in a channel, their parsing is cached
+        reason, talent_level = _title(title) if title else (None, 0)
+        formula, max_value = _description(description) if description else ((), 0)
+
+        values = {}
+        for field in fields:
+            parse_field = field_parsers.get(field["name"])
+            if parse_field is not None:
+                parse_field(values, field["value"])
+    except ValueError:
+        return None
+
+    # Check the consistency of the data
+    if "base_dices" not in values:  # Required for any roll
+        return None  # Discard because no roll was made
+    if values.get("threshold", 0) != 0 \
+            and ("effect_dices" not in values
+                 or critical_success != ("critical_dices" in values)):
+        return None  # Discard because invalid
+    return EmbedRoll(name, critical_success, critical_failure, reason, talent_level, formula, max_value, **values)
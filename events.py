@@ -0,0 +1,179 @@
+"""Publication of the new rolls and sheets of the campaigns to their live feeds"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple, Iterator
+
+from db import ConnectionPool, init_db_connection, get_events
+
+logger = logging.getLogger(__name__)
+
+Event = Tuple[int, str, Dict]
+
+
+class _Channel:
+
+    def __init__(self, history: int):
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=history)
+        self.waiters = 0
+        self.active = time.monotonic()  # Last event or last waiter leaving
+
+
+class EventHub:
+    """
+    Fan-out of the events of each campaign to its subscribers
+
+    Subscribers hold no queue: they only remember the id of the last event they received and wait on the
+    condition of their campaign, so publishing costs the same with one or hundreds of idle subscribers.
+    The last `history` events of each campaign are kept so that a subscriber can catch up after a reconnection,
+    the channels without subscriber nor event for idle_timeout seconds are dropped.
+    The events of every process are published by an EventRelay with their id in the database (relayed=True).
+    Otherwise event ids start from the boot time of the process (in microseconds), so that they keep increasing
+    across restarts: an id above the last published one comes from another process, and the kept events are
+    replayed. Waiting blocks the calling thread: serve the live feeds with gevent or eventlet gunicorn workers,
+    where each subscriber is a cheap greenlet instead of a thread.
+    """
+
+    def __init__(self, history: int = 256, idle_timeout: float = 300.0, relayed: bool = False):
+        self.history = history
+        self.idle_timeout = idle_timeout
+        self.relayed = relayed
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._last_id = 0 if relayed else time.time_ns() // 1000
+        self._swept = time.monotonic()
+
+    def _channel(self, campaign: str, waiter: bool = False) -> _Channel:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._swept > self.idle_timeout:
+                self._swept = now
+                self._channels = {key: channel for key, channel in self._channels.items()
+                                  if channel.waiters > 0 or now - channel.active <= self.idle_timeout}
+            channel = self._channels.get(campaign)
+            if channel is None:
+                channel = self._channels[campaign] = _Channel(self.history)
+            if waiter:  # Counted under the lock, so that the channel is not dropped meanwhile
+                channel.waiters += 1
+            return channel
+
+    def last_id(self) -> int:
+        return self._last_id
+
+    def publish(self, campaign: str, event_type: str, data: Dict, event_id: Optional[int] = None) -> int:
+        """Publish an event, with the next id or the given one (which must be above the previous ones)"""
+        channel = self._channel(campaign)
+        with channel.condition:
+            # The id is taken while holding the channel, so that its events are appended in the order of their ids
+            with self._lock:
+                self._last_id = self._last_id + 1 if event_id is None else event_id
+                event_id = self._last_id
+            channel.events.append((event_id, event_type, data))
+            channel.active = time.monotonic()
+            channel.condition.notify_all()
+        return event_id
+
+    def wait(self, campaign: str, last_id: int, timeout: Optional[float] = None) -> List[Event]:
+        """Return the events published after last_id, waiting up to timeout seconds for one if there is none"""
+        if last_id > self._last_id and not self.relayed:
+            last_id = 0  # Received from another process
+        channel = self._channel(campaign, waiter=True)
+        try:
+            with channel.condition:
+                if not channel.events or channel.events[-1][0] <= last_id:
+                    channel.condition.wait(timeout)
+                return [event for event in channel.events if event[0] > last_id]
+        finally:
+            with self._lock:
+                channel.waiters -= 1
+                channel.active = time.monotonic()
+
+    def stream(self, campaign: str, last_id: Optional[int] = None, heartbeat: float = 15) -> Iterator[str]:
+        """Yield the events of the campaign in the Server-Sent Events format, forever"""
+        if last_id is None:
+            last_id = self.last_id()
+        yield 'retry: 3000\n\n'
+        while True:
+            events = self.wait(campaign, last_id, heartbeat)
+            if not events:
+                yield ': keep-alive\n\n'  # Detects closed connections and keeps proxies from timing out
+            for event_id, event_type, data in events:
+                yield f'id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n'
+                last_id = event_id
+
+
+class EventRelay:
+    """
+    Background thread publishing to a (relayed) hub the events stored in the database by every process
+
+    The events table is only read when another connection committed to the database ("data_version" pragma), so
+    polling it every poll_interval seconds costs nothing while no event comes. The stored events are published
+    when the relay starts, to fill the history of the channels.
+    """
+
+    def __init__(self, hub: EventHub, pool: ConnectionPool, poll_interval: float = 0.05):
+        self.hub = hub
+        self.pool = pool
+        self.poll_interval = poll_interval
+        self._pid = None
+        self._closed: Optional[threading.Event] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start the relay in this process if not started yet, once the stored events are published"""
+        if self._pid == os.getpid():
+            return
+        # The thread is started lazily, in the worker process serving the live feeds
+        with self._lock:
+            if self._pid != os.getpid():
+                self._closed = threading.Event()
+                ready = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._closed, ready), daemon=True)
+                self._thread.start()
+                ready.wait()
+                self._pid = os.getpid()
+
+    def close(self) -> None:
+        if self._thread is not None and self._pid == os.getpid():
+            self._closed.set()
+            self._thread.join()
+        self._pid = None
+        self._thread = None
+
+    def _run(self, closed: threading.Event, ready: threading.Event) -> None:
+        db = None
+        last_id = self.hub.last_id()
+        data_version = None
+        try:
+            while True:
+                try:
+                    if db is None:
+                        db = init_db_connection(self.pool.path, busy_timeout=self.pool.busy_timeout,
+                                                **self.pool.pragmas)
+                    version = db.execute("PRAGMA data_version").fetchone()[0]
+                    if version != data_version:
+                        data_version = version
+                        events = get_events(db, last_id)
+                        for event_id, campaign, event_type, data in events:
+                            self.hub.publish(campaign, event_type, data, event_id)
+                            last_id = event_id
+                        if events:
+                            data_version = None  # Read the events again until they are all published
+                            continue
+                except Exception:
+                    logger.exception("Cannot relay the events")
+                    if db is not None:
+                        db.close()
+                        db = None
+                ready.set()
+                if closed.wait(self.poll_interval):
+                    break
+        finally:
+            ready.set()
+            if db is not None:
+                db.close()
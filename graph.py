@@ -1,126 +1,151 @@
 import json
 import math
-from sqlite3 import Connection
-from typing import Union, List, Tuple, Dict, Optional
+import threading
+from collections import OrderedDict
+from typing import Union, List, Tuple, Dict, Sequence, Optional, Any
 
 import numpy as np
-import pandas as pd
-import plotly
-import plotly.express as px
 
-from db import get_success_failure_by_player, get_critical_by_player, get_nimdir_index_by_player, get_formula_usage, \
-    get_energy_usage, get_base_dices, get_count_by_player, get_thresholds_by_player, get_margins_by_player
+from stats import CampaignStats
 
 
-def _histogram_data(bounded_data: List[Union[float, int]]) -> Tuple[List[int], List[Union[float, int]]]:
-    counts = []
-    bin_edges = []
-    bounded_data = sorted(bounded_data)
-    for i in range(len(bounded_data)):
-        if len(bin_edges) != 0 and bin_edges[-1] == bounded_data[i]:
-            counts[-1] += 1
+def _histogram_data(bounded_data: Sequence[Union[float, int]]) -> Tuple[List[int], List[Union[float, int]]]:
+    bin_edges, counts = np.unique(np.asarray(bounded_data), return_counts=True)
+    return counts.tolist(), bin_edges.tolist()
+
+
+def cdf_data_by_group(data: Dict[str, Sequence[Union[float, int]]],
+                      shadow_points_from: Sequence[Union[int, float]] = (), origin: bool = True) \
+        -> Dict[str, Tuple[List[Union[float, int]], List[float]]]:
+    """
+    Returns the cdf of the values of each group as (bin_edges, cdf), computed for all the groups at once
+
+    The unsolved values (math.inf) lower the cdf. With shadow_points_from, the cdf is given at these points instead
+    of at the values of the group: they have to be sorted and to contain every value, as the union of the values
+    of the groups does.
+    """
+    names = list(data)
+    samples = [np.asarray(data[name]) for name in names]
+    lengths = np.array([len(values) for values in samples], dtype=np.int64)
+    values = np.concatenate(samples) if samples else np.zeros(0)
+    groups = np.repeat(np.arange(len(names)), lengths)
+
+    # Filter math.inf
+    bounded = values != math.inf
+    bin_edges, indexes = np.unique(values[bounded], return_inverse=True)
+    counts = np.bincount(groups[bounded] * len(bin_edges) + indexes, minlength=len(names) * len(bin_edges)) \
+        .reshape(len(names), len(bin_edges))
+    cdf = np.cumsum(counts, axis=1)
+    totals = cdf[:, -1] if len(bin_edges) else np.zeros(len(names), dtype=np.int64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cdf = (cdf / totals[:, None]) * (totals / lengths)[:, None]  # Unsolved instances hurts the cdf
+
+    if len(shadow_points_from):
+        # The cdf is a step function, constant up to the next bin edge
+        columns = np.searchsorted(bin_edges, np.asarray(shadow_points_from), side="right") - 1
+        shadow_cdf = cdf[:, columns]
+        before = int(np.count_nonzero(columns < 0))  # The points before the first bin edge
+
+    cdfs = {}
+    for i, name in enumerate(names):
+        if totals[i] == 0:  # Every demand file was failed
+            cdfs[name] = [], []
+        elif len(shadow_points_from):
+            cdfs[name] = list(shadow_points_from), [0] * before + shadow_cdf[i, before:].tolist()
         else:
-            counts.append(1)
-            bin_edges.append(bounded_data[i])
-    return counts, bin_edges
+            present = counts[i] > 0
+            cdfs[name] = bin_edges[present].tolist(), cdf[i, present].tolist()
+            if origin:
+                cdfs[name][0].insert(0, 0)
+                cdfs[name][1].insert(0, 0)
+    return cdfs
 
 
-def cdf_data(cdf_values: List[Union[float, int]], shadow_points_from: List[Union[int, float]] = (),
+def cdf_data(cdf_values: Sequence[Union[float, int]], shadow_points_from: Sequence[Union[int, float]] = (),
              origin: bool = True) \
         -> Tuple[List[Union[float, int]], List[float]]:
-    data = sorted(cdf_values)
-
-    # Count and filter math.inf
-    bounded_data = [value for value in data if value != math.inf]
-    if len(bounded_data) == 0:  # Every demand file was failed
-        return [], []
-
-    counts, bin_edges = _histogram_data(bounded_data)
-    cdf = np.cumsum(counts)
-
-    cdf = (cdf / cdf[-1]) * (len(bounded_data) / len(data))  # Unsolved instances hurts the cdf
-    bin_edges = list(bin_edges)
-    cdf = list(cdf)
-    if origin:
-        bin_edges.insert(0, 0)
-        cdf.insert(0, 0)
-
-    new_bin_edges = []
-    new_cdf = []
-    current_bin_idx = 0
-    for to_add in shadow_points_from:
-        for i in range(current_bin_idx, len(bin_edges)):
-            if to_add == bin_edges[i]:
-                # Everything ok up to to_add
-                new_bin_edges.append(to_add)
-                new_cdf.append(cdf[i])
-                current_bin_idx = i + 1
-                break
-            elif to_add < bin_edges[i]:
-                # Create new point
-                new_bin_edges.append(to_add)
-                new_cdf.append(new_cdf[-1] if new_cdf else 0)
-                break
-            else:
-                # Use old point
-                new_bin_edges.append(bin_edges[i])
-                new_cdf.append(cdf[i])
-        if current_bin_idx == len(bin_edges) and new_bin_edges[-1] != to_add:
-            # to_add is beyond the current range of bins
-            new_bin_edges.append(to_add)
-            new_cdf.append(new_cdf[-1] if new_cdf else 0)
-
-    return (bin_edges, cdf) if len(shadow_points_from) == 0 else (new_bin_edges, new_cdf)
+    return cdf_data_by_group({None: cdf_values}, shadow_points_from, origin)[None]
+
+
+def _all_values(data: Dict[str, Sequence[Union[float, int]]]) -> List[Union[float, int]]:
+    """The sorted distinct values of all the groups"""
+    return np.unique(np.concatenate([np.asarray(values) for values in data.values()] or [np.zeros(0)])).tolist()
+
+
+# The colors of the players in the distribution charts (the Alphabet sequence of Plotly)
+player_colors = ["#AA0DFE", "#3283FE", "#85660D", "#782AB6", "#565656", "#1C8356", "#16FF32", "#F7E1A0", "#E2E2E2",
+                 "#1CBE4F", "#C4451C", "#DEA0FD", "#FE00FA", "#325A9B", "#FEAF16", "#F8A19F", "#90AD1C", "#F6222E",
+                 "#1CFFCE", "#2ED9FF", "#B10DA1", "#C075A6", "#FC1CBF", "#B00068", "#FBE426", "#FA0087"]
+
+
+def trace(x: Sequence, y: Sequence, color: str, name: Optional[str] = None) -> Dict[str, Any]:
+    """Returns a trace of a chart, without legend if it has no name"""
+    data = {"x": list(x), "y": list(y), "color": color}
+    if name is not None:
+        data["name"] = name
+    return data
+
+
+def chart(chart_type: str, x_title: str, y_title: str, traces: List[Dict[str, Any]],
+          legend_title: Optional[str] = None, **layout) -> str:
+    """
+    Returns a bar or line chart in a compact json string
+
+    Only the traces, the titles and the layout specific to the chart are sent: graphs.html builds the Plotly figure
+    with the layout shared by the charts.
+    """
+    data = {"type": chart_type, "x_title": x_title, "y_title": y_title, "traces": traces}
+    if legend_title is not None:
+        data["legend_title"] = legend_title
+    if layout:
+        data["layout"] = layout
+    return json.dumps(data, separators=(",", ":"))
 
 
 def grouped_chart(data: Dict[str, Tuple[float, float]], categories: List[str], colors: List[str],
                   group_title: str, y_label: str) -> str:
     """Returns a group chart from data of the form {'player1': (data1, data2)} in a json string"""
 
-    df_source = {"Players": [], categories[0]: [], categories[1]: []}
-    for player, value in data.items():
-        df_source["Players"].append(player.split(" ")[0])
-        df_source[categories[0]].append(value[0])
-        df_source[categories[1]].append(value[1])
-    df = pd.DataFrame.from_dict(df_source)
-    df = pd.melt(df, id_vars=["Players"], var_name=group_title, value_name=y_label)
+    players = [player.split(" ")[0] for player in data]
+    traces = [trace(players, [value[i] for value in data.values()], colors[i], categories[i]) for i in range(2)]
+    return chart("bar", "Players", y_label, traces, legend_title=group_title)
 
-    plot = px.bar(df, x="Players", color=group_title, y=y_label, barmode="group", color_discrete_sequence=colors)
-    return json.dumps(plot, cls=plotly.utils.PlotlyJSONEncoder)
 
-
-def success_failure_by_player(db: Connection, campaign: str, player: Optional[str] = None,
-                              test: Optional[str] = None) -> str:
+def success_failure_by_player(stats: CampaignStats) -> str:
     """Returns a bar plot showing success and failures percentage by player in a json string"""
 
-    data = get_success_failure_by_player(db, campaign, player, test)
+    data = stats.success_failure_by_player()
     return grouped_chart(data, ["Success Rate", "Failure Rate"], ["darkgreen", "tomato"], "Rate", "%")
 
 
-def critical_by_player(db: Connection, campaign: str, player: Optional[str] = None, test: Optional[str] = None) -> str:
+def critical_by_player(stats: CampaignStats) -> str:
     """Returns a bar plot showing critical success and failures by player in a json string"""
 
-    data = get_critical_by_player(db, campaign, player, test)
+    data = stats.critical_by_player()
     return grouped_chart(data, ["Critical Successes", "Critical Failures"], ["darkgreen", "tomato"], "Type", "Count")
 
 
-def nimdir_index_by_player(db: Connection, campaign: str, player: Optional[str] = None,
-                           test: Optional[str] = None) -> str:
+def nimdir_index_by_player(stats: CampaignStats) -> str:
     """
     Returns a bar plot showing the maximum length of streaks of successes and failures by player in a json string
     """
 
-    data = get_nimdir_index_by_player(db, campaign, player, test)
+    data = stats.nimdir_index_by_player()
     return grouped_chart(data, ["Success Streak", "Failure Streak"], ["darkgreen", "tomato"], "Type", "Streak")
 
 
-def base_dice_distributions(db: Connection, campaign: str, player: Optional[str] = None,
-                            test: Optional[str] = None) -> str:
+def cdf_traces(cdfs: Dict[str, Tuple[List[Union[float, int]], List[float]]]) -> List[Dict[str, Any]]:
+    """Returns a line by player (sorted by name) of their cdfs"""
+    return [trace(x, cdf, player_colors[i % len(player_colors)], name.split(" ")[0])
+            for i, (name, (x, cdf)) in enumerate(sorted(cdfs.items()))]
+
+
+def base_dice_distributions(stats: CampaignStats) -> str:
     """
     Returns a cdf of the distribution of the 2 base dices for each player
     (as well as the theoretical distribution)
     """
-    data = get_base_dices(db, campaign, player, test)
+    data = stats.base_dices()
     reference = "Reference"
 
     # Regular distribution
@@ -128,116 +153,108 @@ def base_dice_distributions(db: Connection, campaign: str, player: Optional[str]
         for j in range(1, 7):
             data.setdefault(reference, []).append(i + j)
 
-    # Produce DataFrame
-    df_source: Dict[str, List[Union[int, float]]] = {"Sum of 2d6": [i for i in range(2, 13)]}
-    df_source["Sum of 2d6"].insert(0, 0)
-    reference_cdf = []
-    for name, sums in sorted(list(data.items())):
-        x, cdf = cdf_data(sums, shadow_points_from=df_source["Sum of 2d6"])
-        if name == reference:
-            reference_cdf = cdf
-        df_source.setdefault(name.split(" ")[0], []).extend(cdf)
-    df = pd.DataFrame.from_dict(df_source)
-    df = pd.melt(df, id_vars=["Sum of 2d6"], var_name="Players", value_name="CDF")
-
-    plot = px.line(df, x="Sum of 2d6", color="Players", y="CDF", line_shape="hv", range_x=[2, 12], range_y=[0, 1],
-                   color_discrete_sequence=px.colors.qualitative.Alphabet)
-    plot.update_layout(xaxis=dict(tickmode='linear', tick0=0, dtick=1),
-                       yaxis=dict(tickmode='array', tickvals=reference_cdf,
-                                  ticktext=[f"{tick:.2f}" for tick in reference_cdf]))
-    return json.dumps(plot, cls=plotly.utils.PlotlyJSONEncoder)
-
-
-def thresholds_distributions(db: Connection, campaign: str, player: Optional[str] = None,
-                             test: Optional[str] = None) -> str:
+    points = [0] + [i for i in range(2, 13)]
+    cdfs = cdf_data_by_group(data, shadow_points_from=points)
+    reference_cdf = cdfs[reference][1]
+    return chart("line", "Sum of 2d6", "CDF", cdf_traces(cdfs), legend_title="Players",
+                 xaxis=dict(tickmode="linear", tick0=0, dtick=1, range=[2, 12]),
+                 yaxis=dict(tickmode="array", tickvals=reference_cdf,
+                            ticktext=[f"{tick:.2f}" for tick in reference_cdf], range=[0, 1]))
+
+
+def thresholds_distributions(stats: CampaignStats) -> str:
     """
     Returns a cdf of the distribution of the thresholds for each player (or the "courage" of each player)
     """
-    data = get_thresholds_by_player(db, campaign, player, test)
-
-    # Produce DataFrame
-    df_source: Dict[str, List[Union[int, float]]] = {
-        "Threshold": sorted(list({threshold for _, thresholds in list(data.items())
-                                  for threshold in thresholds}))
-    }
-    for name, thresholds in sorted(list(data.items())):
-        x, cdf = cdf_data(thresholds, shadow_points_from=df_source["Threshold"], origin=False)
-        df_source.setdefault(name.split(" ")[0], []).extend(cdf)
-    df = pd.DataFrame.from_dict(df_source)
-    df = pd.melt(df, id_vars=["Threshold"], var_name="Players", value_name="CDF")
+    data = stats.thresholds_by_player()
 
-    plot = px.line(df, x="Threshold", color="Players", y="CDF", line_shape="hv",
-                   color_discrete_sequence=px.colors.qualitative.Alphabet)
-    plot.update_layout(xaxis=dict(tickmode='linear', tick0=0, dtick=1))
-    return json.dumps(plot, cls=plotly.utils.PlotlyJSONEncoder)
+    cdfs = cdf_data_by_group(data, shadow_points_from=_all_values(data), origin=False)
+    return chart("line", "Threshold", "CDF", cdf_traces(cdfs), legend_title="Players",
+                 xaxis=dict(tickmode="linear", tick0=0, dtick=1))
 
 
-def magins_distributions(db: Connection, campaign: str, player: Optional[str] = None,
-                         test: Optional[str] = None) -> str:
+def magins_distributions(stats: CampaignStats) -> str:
     """
     Returns a cdf of the distribution of the margins for each player
     """
-    data = get_margins_by_player(db, campaign, player, test)
+    data = stats.margins_by_player()
 
-    # Produce DataFrame
-    df_source: Dict[str, List[Union[int, float]]] = {
-        "Margin": sorted(list({margin for _, margins in sorted(list(data.items())) for margin in margins}))
-    }
-    for name, margins in sorted(list(data.items())):
-        x, cdf = cdf_data(margins, shadow_points_from=df_source["Margin"], origin=False)
-        df_source.setdefault(name.split(" ")[0], []).extend(cdf)
-    df = pd.DataFrame.from_dict(df_source)
-    df = pd.melt(df, id_vars=["Margin"], var_name="Players", value_name="CDF")
+    cdfs = cdf_data_by_group(data, shadow_points_from=_all_values(data), origin=False)
+    return chart("line", "Margin", "CDF", cdf_traces(cdfs), legend_title="Players",
+                 xaxis=dict(tickmode="linear", tick0=0, dtick=1))
 
-    plot = px.line(df, x="Margin", color="Players", y="CDF", line_shape="hv",
-                   color_discrete_sequence=px.colors.qualitative.Alphabet)
-    plot.update_layout(xaxis=dict(tickmode='linear', tick0=0, dtick=1))
-    return json.dumps(plot, cls=plotly.utils.PlotlyJSONEncoder)
 
-
-def formula_usage(db: Connection, campaign: str, player: Optional[str] = None, test: Optional[str] = None) -> str:
+def formula_usage(stats: CampaignStats) -> str:
     """
     Returns a bar plot showing the usage of each formula element
     """
 
-    data = get_formula_usage(db, campaign, player, test)
-
-    df_source = {"Formula element": [], "Usage Count": []}
-    for key, value in data.items():
-        df_source["Formula element"].append(key)
-        df_source["Usage Count"].append(value)
-    df = pd.DataFrame.from_dict(df_source)
-    plot = px.bar(df, x="Formula element", y="Usage Count", color_discrete_sequence=["black"])
-    return json.dumps(plot, cls=plotly.utils.PlotlyJSONEncoder)
+    data = stats.formula_usage()
+    return chart("bar", "Formula element", "Usage Count", [trace(data.keys(), data.values(), "black")])
 
 
-def energy_usage(db: Connection, campaign: str, player: Optional[str] = None, test: Optional[str] = None) -> str:
+def energy_usage(stats: CampaignStats) -> str:
     """
     Returns a bar plot showing the usage of each energy
     """
 
-    data = get_energy_usage(db, campaign, player, test)
+    data = stats.energy_usage()
+    return chart("bar", "Energies", "Usage Count", [trace(data.keys(), data.values(), "black")])
 
-    df_source = {"Energies": [], "Usage Count": []}
-    for key, value in data.items():
-        df_source["Energies"].append(key)
-        df_source["Usage Count"].append(value)
-    df = pd.DataFrame.from_dict(df_source)
-    plot = px.bar(df, x="Energies", y="Usage Count", color_discrete_sequence=["black"])
-    return json.dumps(plot, cls=plotly.utils.PlotlyJSONEncoder)
 
-
-def roll_count(db: Connection, campaign: str, player: Optional[str] = None, test: Optional[str] = None) -> str:
+def roll_count(stats: CampaignStats) -> str:
     """
     Returns a bar plot showing the usage of each energy
     """
 
-    data = get_count_by_player(db, campaign, player, test)
+    data = stats.count_by_player()
+    return chart("bar", "Players", "Number of rolls",
+                 [trace([player.split(" ")[0] for player in data], data.values(), "black")])
+
+
+def render_graphs(stats: CampaignStats) -> Dict[str, Any]:
+    """Returns the statistics and the graphs (in json strings) of the graph page"""
+    players = stats.players
+    return dict(players=players,
+                test_stats=stats.stats_by_test(),
+                success_failure_by_player=success_failure_by_player(stats),
+                critical_by_player=critical_by_player(stats),
+                nimdir_index_by_player=nimdir_index_by_player(stats),
+                base_dice_distributions=base_dice_distributions(stats),
+                formula_usage=formula_usage(stats),
+                energy_usage=energy_usage(stats),
+                roll_count=roll_count(stats),
+                thresholds_distributions=thresholds_distributions(stats),
+                magins_distributions=magins_distributions(stats))
+
+
+class GraphCache:
+    """
+    Least recently used rendered graph pages, up to max_entries
+
+    Pages are indexed by (campaign, player filter, test filter) and stored with the version of the rolls of the
+    campaign they were rendered from (see db.get_campaign_version): a page is only returned for this version.
+    """
 
-    df_source = {"Players": [], "Number of rolls": []}
-    for key, value in data.items():
-        df_source["Players"].append(key.split(" ")[0])
-        df_source["Number of rolls"].append(value)
-    df = pd.DataFrame.from_dict(df_source)
-    plot = px.bar(df, x="Players", y="Number of rolls", color_discrete_sequence=["black"])
-    return json.dumps(plot, cls=plotly.utils.PlotlyJSONEncoder)
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, Optional[str], Optional[str]], version: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._graphs.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._graphs.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Tuple[str, Optional[str], Optional[str]], version: int, graphs: Dict[str, Any]) -> None:
+        with self._lock:
+            entry = self._graphs.get(key)
+            if entry is not None and entry[0] > version:
+                return  # Rendered from older rolls than the cached page
+            self._graphs[key] = (version, graphs)
+            self._graphs.move_to_end(key)
+            while len(self._graphs) > self.max_entries:
+                self._graphs.popitem(last=False)
@@ -0,0 +1,10 @@
+# Gunicorn settings, read by "gunicorn dmview:app" from this directory.
+# The live feeds (/events) block the greenlet serving them until the client leaves: with gevent workers, each feed
+# is a cheap greenlet instead of a whole worker. The events are relayed to the feeds of every worker through the
+# database, so the number of workers (the WEB_CONCURRENCY environment variable or --workers) is free: several
+# workers keep the feeds served while one of them queries SQLite or renders graphs.
+import multiprocessing
+import os
+
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() + 1))
@@ -0,0 +1,154 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from sqlite3 import Connection
+from typing import Union, List, Dict, Tuple, Optional
+
+from db import ConnectionPool, init_db_connection, insert_roll, queue_discord_roll, store_event
+
+DiscordRoll = Tuple[str, str, Dict[str, Optional[str]]]  # (server, key, roll), see queue_discord_roll
+StoredEvent = Tuple[str, str, Dict]  # (campaign, type, data), see store_event
+RollItem = Tuple[str, Dict[str, Union[List, int, float, str]], Optional[DiscordRoll], Optional[StoredEvent], Future]
+
+
+class RollWriter:
+    """
+    Background thread saving the rolls received by many requests in a single transaction
+
+    A batch is written as soon as max_batch rolls are waiting or max_delay seconds after its first roll, so a burst
+    of rolls costs one commit (and one fsync) instead of one per roll. Each roll is inserted in its own savepoint:
+    an invalid roll fails alone. submit() only returns once the transaction holding the roll is committed.
+    If the thread stops (on close or on an unexpected error), the waiting rolls fail, and so do the later submits
+    until close().
+    """
+
+    def __init__(self, pool: ConnectionPool, max_batch: int = 64, max_delay: float = 0.005):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pid = None
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None  # Why the thread stopped
+        self._lock = threading.Lock()
+
+    def _start(self) -> None:
+        # The thread is started lazily, in the worker process which receives the rolls
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._error = None
+                self._thread = threading.Thread(target=self._run, args=(self._queue,), daemon=True)
+                self._thread.start()
+
+    def submit(self, campaign: str, post_data: Dict[str, Union[List, int, float, str]],
+               discord_roll: Optional[DiscordRoll] = None, timeout: Optional[float] = None,
+               event: Optional[StoredEvent] = None) -> None:
+        """
+        Save the roll in the database, raising the error of its insertion if any
+
+        discord_roll is queued for the Discord bot and event stored for the live feeds in the same transaction
+        as the roll.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        future = Future()
+        with self._lock:
+            if self._error is not None:
+                raise RuntimeError("The roll writer stopped") from self._error
+            self._queue.put((campaign, post_data, discord_roll, event, future))
+        future.result(timeout)
+
+    def close(self) -> None:
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+        self._pid = None
+        self._thread = None
+
+    def _run(self, items: queue.Queue) -> None:
+        batch = []
+        error = RuntimeError("The roll writer is closed")
+        try:
+            # Synchronous commits, the acknowledgement of a roll means it is on disk
+            db = init_db_connection(self.pool.path, busy_timeout=self.pool.busy_timeout,
+                                    **dict(self.pool.pragmas, synchronous="full"))
+            try:
+                self._write_batches(db, items, batch)
+            finally:
+                db.close()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._stop(items, batch, error)
+
+    def _stop(self, items: queue.Queue, batch: List[RollItem], error: BaseException) -> None:
+        """Fail the rolls which will not be written, and the later submits"""
+        with self._lock:
+            if items is self._queue:
+                self._error = error
+            pending = list(batch)
+            while True:
+                try:
+                    pending.append(items.get_nowait())
+                except queue.Empty:
+                    break
+        for item in pending:
+            if item is not None and not item[-1].done():
+                item[-1].set_exception(error)
+
+    def _write_batches(self, db: Connection, items: queue.Queue, batch: List[RollItem]) -> None:
+        """Write the batches of rolls until close(), batch holding the rolls being written"""
+        stop = False
+        while not stop:
+            item = items.get()
+            if item is None:
+                break
+            batch[:] = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = items.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(db, batch)
+            batch.clear()
+
+    @staticmethod
+    def _write(db: Connection, batch: List[RollItem]) -> None:
+        errors = {}
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for i, (campaign, post_data, discord_roll, event, _) in enumerate(batch):
+                db.execute("SAVEPOINT roll")
+                try:
+                    insert_roll(db, campaign, post_data)
+                    if discord_roll is not None:
+                        queue_discord_roll(db, *discord_roll)
+                    if event is not None:
+                        store_event(db, *event)
+                except Exception as e:
+                    db.execute("ROLLBACK TO roll")
+                    errors[i] = e
+                db.execute("RELEASE roll")
+            db.commit()
+        except Exception as e:
+            if db.in_transaction:
+                db.rollback()
+            for *_, future in batch:
+                future.set_exception(e)
+            return
+
+        for i, (*_, future) in enumerate(batch):
+            if i in errors:
+                future.set_exception(errors[i])
+            else:
+                future.set_result(None)
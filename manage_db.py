@@ -0,0 +1,78 @@
+"""Script to maintain the roll database: import archives of rolls, rebuild the aggregates of the rolls"""
+import argparse
+import csv
+import json
+import time
+from typing import Dict, Iterator, Union
+
+from db import init_db_connection, create_db, bulk_insert_rolls, rebuild_aggregates
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Maintenance of the roll database')
+    parser.add_argument('database_path', help='The path to the database of the rolls')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='Import rolls exported as JSON Lines (.jsonl) or CSV (.csv)'
+                                                         ' files of roll POST data')
+    import_parser.add_argument('campaign_id', help='The campaign ID of the rolls')
+    import_parser.add_argument('files', nargs='+', help='The files to import')
+    import_parser.add_argument('--batch-size', type=int, default=10000,
+                               help='The number of rolls inserted by transaction')
+
+    subparsers.add_parser('rebuild', help='Recompute the aggregates of the rolls used by the statistics, after the'
+                                          ' rolls were changed by hand')
+    return parser.parse_args()
+
+
+def post_value(value: Union[bool, int, float, str]) -> str:
+    """Return the value as it would be in the POST data of the roll"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def read_roll_file(path: str) -> Iterator[Dict[str, str]]:
+    """Yield the rolls of a JSON Lines or CSV file, one at a time"""
+    with open(path, newline='', encoding='utf-8') as file_obj:
+        if path.endswith('.csv'):
+            rows = csv.DictReader(file_obj)
+        else:
+            rows = (json.loads(line) for line in file_obj if line.strip())
+        for row in rows:
+            # Missing values are left to the database defaults
+            yield {key: value if type(value) is str else post_value(value) for key, value in row.items()
+                   if value is not None and value != ''}
+
+
+def import_rolls(database_path: str, campaign_id: str, files, batch_size: int) -> None:
+    start = time.perf_counter()
+
+    def progress(count):
+        elapsed = time.perf_counter() - start
+        print(f"{count} rolls imported in {elapsed:.1f}s ({count / elapsed:.0f} rolls/s)")
+
+    with init_db_connection(database_path, journal_mode="wal") as db:
+        total = 0
+        for path in files:
+            print(f"Importing {path}")
+            imported = total
+            total += bulk_insert_rolls(db, campaign_id, read_roll_file(path), batch_size=batch_size,
+                                       progress=lambda count: progress(imported + count))
+    progress(total)
+
+
+def rebuild(database_path: str) -> None:
+    start = time.perf_counter()
+    with init_db_connection(database_path, journal_mode="wal") as db:
+        rebuild_aggregates(db)
+    print(f"Aggregates rebuilt in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    create_db(args.database_path)
+    if args.command == 'import':
+        import_rolls(args.database_path, args.campaign_id, args.files, args.batch_size)
+    elif args.command == 'rebuild':
+        rebuild(args.database_path)
@@ -0,0 +1,244 @@
+"""Rendering of the rolls as Discord messages (text or embed)"""
+import random
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple, Union
+
+import discord
+
+from effects import build_effect
+
+
+class ResultStyle(NamedTuple):
+    color: int
+    name: str
+    emojis: Tuple[str, ...]
+    code: str  # Language of the code block, for its colors
+    grotz: Tuple[str, ...]
+
+
+result_styles = MappingProxyType({
+    'crit_fail': ResultStyle(
+        0xff0000,  # brigth red
+        '- Echec Critique -',
+        ('dizzy_face', 'scream', 'sob', 'rage', 'face_with_symbols_over_mouth', 'exploding_head', 'skull', 'fire',
+         'skull_crossbones'),
+        'diff',
+        ('tU V€uX §U ThÉ ?',
+         'Tu vŒufs Du tHÉ Tw@ 0u Kw4 ??'
+         'BwA In P-œufs D3 ThÉ !',
+         'Sss@ SsÈ Biijin R4thé Sss@ !',
+         'bIn Ssà sSÈ KomþLÈt3m@N nU££ !')),
+    'fail': ResultStyle(
+        0xa70101,  # dark red
+        'Echec',
+        ('pensive', 'worried', 'confused', 'persevere', 'disappointed', 'unamused', 'poop'),
+        'fix',
+        ("T'@s Ra-Thé !",
+         'Maître ! Maître ! iLle @ R4tHÉe !',
+         'Pr4n Un pEu d€ tHè, sS@ yRà mj-œufs',
+         'p4 gR@afF r3K0maNSs, $0f sSi Tè M0oOrTt !')),
+    'success': ResultStyle(
+        0x01890a,  # green
+        '"Succès"',
+        ('smiley', 'grinning', 'blush', 'stuck_out_tongue', 'upside_down', 'kissing_smiling_eyes', '+1', 'clap'),
+        'CPP',
+        ('Enk0r uN3 þ3Titt Tàs$E ?',
+         'bR@vAu ! bW4 dU Thé MinTNàn !',
+         '0n dIRè k€ s$è rÉUSssi, M0n tHÉ osSI !',
+         '@vèK uN€ t4Sse d3 tHÉ ¢@ OrÈ @nK0r éthé Mi-œufs')),
+    'crit_succ': ResultStyle(
+        0x00ff11,  # brigth green
+        '+ Succès Critique +',
+        ('star_struck', 'partying_face', 'heart_eyes', 'muscle', 'fireworks', 'tada', 'trophy', 'champagne',
+         'clinking_glass'),
+        'diff',
+        ('tU B0!s Du tHé Tw@ !',
+         'Maître ! Maître ! iLle @ R€u¢I Lu! !',
+         'Ssa pR0Uvf k€ mON Thé m4RCh bi3n',
+         '@tR4Pp pA La GroO0Ss tÈTt, pRàn pLUtô dU Thé')),
+    'simple_roll': ResultStyle(
+        0x0066cc,  # blue
+        "[𝅘𝅥𝅮 Take a chance, roll the dice! 𝅘𝅥𝅯 ]",
+        ('smiley', 'grinning', 'blush', 'stuck_out_tongue', 'upside_down', 'kissing_smiling_eyes', '+1', 'clap',
+         'pensive', 'worried', 'confused', 'persevere', 'disappointed', 'unamused', 'poop'),
+        'ini',
+        ('tU B0!s Du tHé Tw@ !',
+         'tU V€uX §U ThÉ ?',
+         'Tu vŒufs Du tHÉ Tw@ 0u Kw4 ??',
+         'BwA In P-œufs D3 ThÉ !',
+         '@vèK uN€ t4Sse d3 tHÉ ¢@ OrÈ @nK0r éthé Mi-œufs')),
+})
+
+emoji_counts = (1, 2, 2, 3, 3, 3, 4)
+simple_effect_values = (
+    "*...without description,\nI can't say much*",
+    "*It's a simple roll*",
+    "You took a chance *and* rolled the dices!",
+    "Well, *something* should have happened right ?",
+    "Try again ?",
+    "Are you happy ?",
+)
+dice_emojis = MappingProxyType({1: 'one', 2: 'two', 3: 'three', 4: 'four', 5: 'five', 6: 'six'})
+true_values = frozenset(('y', 'yes', 't', 'true', 'on', '1'))
+
+Dices = Tuple[int, ...]
+
+
+class RollDetails(NamedTuple):
+    """A roll as sent by the dynamic sheet, parsed once for its rendering"""
+    character: str
+    base_dices: Dices
+    number: str
+    type: str
+    critical_success: bool
+    critical_failure: bool
+    margin: Optional[int] = None  # None for a simple roll
+    threshold: str = ''
+    max_value: str = ''
+    reason: str = ''
+    talent_level: str = ''
+    formula: Tuple[str, ...] = ()
+    critical_dices: Dices = ()
+    power_dices: Dices = ()
+    effect_dices: Dices = ()
+    effect_modifier: int = 0
+    effect: str = ''
+
+
+def _dices(value: Optional[str]) -> Dices:
+    return tuple(int(dice) for dice in value.split(',')) if value else ()
+
+
+def parse_roll_details(character: str, roll_details: Dict[str, Optional[str]]) -> RollDetails:
+    """Parse the POST data of a roll, raising ValueError if it is invalid"""
+    d = roll_details
+    common = dict(character=character,
+                  base_dices=_dices(d.get('base_dices')),
+                  number=d.get('number') or '',
+                  type=d.get('type') or '',
+                  critical_success=(d.get('critical_success') or '').lower() in true_values,
+                  critical_failure=(d.get('critical_failure') or '').lower() in true_values)
+    if 'margin' not in d:
+        return RollDetails(**common)
+    return RollDetails(margin=int(d['margin']),
+                       threshold=d.get('threshold') or '',
+                       max_value=d.get('max_value') or '',
+                       reason=d.get('reason') or '',
+                       talent_level=d.get('talent_level') or '',
+                       formula=tuple(d['formula_elements'].split(',')) if d.get('formula_elements') else (),
+                       critical_dices=_dices(d.get('critical_dices')),
+                       power_dices=_dices(d.get('power_dices')),
+                       effect_dices=_dices(d.get('effect_dices')),
+                       effect_modifier=int(d.get('effect_modifier') or 0),
+                       effect=d.get('effect') or '',
+                       **common)
+
+
+def get_result(roll: RollDetails) -> ResultStyle:
+    if roll.critical_success:
+        return result_styles['crit_succ']
+    if roll.critical_failure:
+        return result_styles['crit_fail']
+    if roll.margin is None:
+        return result_styles['simple_roll']
+    if roll.margin >= 1:
+        return result_styles['success']
+    return result_styles['fail']
+
+
+def format_dices(dices: Dices, emojis: Mapping[str, str]) -> str:
+    """Return the emojis of the dices (the name of the emoji if the bot does not see it)"""
+    names = (dice_emojis.get(dice) for dice in dices)
+    return ' '.join(emojis.get(name, name) if name is not None else str(dice) for name, dice in zip(names, dices))
+
+
+def build_roll_data(roll: RollDetails, msg_type: Optional[str] = None,
+                    emojis: Mapping[str, str] = MappingProxyType({})) -> Union[str, discord.Embed, None]:
+    """Return the content of the message of the roll, emojis being the rendered custom emojis by name"""
+    if msg_type is None:
+        return build_roll_text(roll)
+    if msg_type == 'embed':
+        return build_roll_embed(roll, emojis)
+    return None
+
+
+def build_roll_embed(roll: RollDetails, emojis: Mapping[str, str]) -> discord.Embed:
+    if roll.margin is not None:
+        return build_roll_embed_normal(roll, emojis)
+    return build_roll_embed_simple(roll, emojis)
+
+
+def _result_emojis(result: ResultStyle, extra: Tuple[str, ...] = ()) -> str:
+    return ' '.join(f':{name}:' for name in random.sample(result.emojis, random.choice(emoji_counts)) + list(extra))
+
+
+def build_roll_embed_simple(roll: RollDetails, emojis: Mapping[str, str]) -> discord.Embed:
+    result = get_result(roll)
+    embed = discord.Embed(title="Un simple lancer", url="", description="", color=result.color)
+    embed.set_author(name=f'@{roll.character}', url="", icon_url="")
+    embed.add_field(name="Lancer", value=format_dices(roll.base_dices, emojis), inline=True)
+    embed.add_field(name="Résultat", value=str(sum(roll.base_dices)), inline=True)
+    embed.add_field(value=f'```{result.code}\n{result.name}```', name=_result_emojis(result, ('interrobang',)),
+                    inline=False)
+    embed.set_footer(text=f"« {random.choice(result.grotz)} »")
+    return embed
+
+
+def build_roll_embed_normal(roll: RollDetails, emojis: Mapping[str, str]) -> discord.Embed:
+    result = get_result(roll)
+
+    formula = ' + '.join(emojis.get(element, element) for element in roll.formula)
+    title = "Let' Roll!"
+    description = f'Test sous {formula}'
+    if roll.reason:
+        title = f"{roll.reason} (niveau {roll.talent_level})"
+        description += f" + {roll.reason}"
+    description += f" ({roll.max_value})"
+
+    embed = discord.Embed(title=title, url="", description=description, color=result.color)
+    embed.set_author(name=f'@{roll.character}', url="", icon_url="")
+    embed.add_field(name="Lancer", value=format_dices(roll.base_dices, emojis), inline=True)
+    embed.add_field(name="Résultat", value=f"{sum(roll.base_dices)} sous {roll.threshold}\nMR : {roll.margin}",
+                    inline=True)
+    embed.add_field(value=f'```{result.code}\n{result.name}```', name=_result_emojis(result), inline=True)
+    if roll.critical_dices:
+        embed.add_field(name="Dés Critiques", value=format_dices(roll.critical_dices, emojis), inline=True)
+    if roll.power_dices:
+        embed.add_field(name="Dés de Puissance", value=format_dices(roll.power_dices, emojis), inline=True)
+    embed.add_field(name="Dés d'Effet", value=format_dices(roll.effect_dices, emojis) or '-', inline=True)
+    if roll.effect_modifier != 0:
+        embed.add_field(name="Modif. effet", value=str(roll.effect_modifier), inline=True)
+
+    if roll.effect:
+        embed.add_field(name='Effet', inline=True,
+                        value=build_effect(roll.effect, roll.margin, sum(roll.effect_dices) + roll.effect_modifier))
+    else:
+        embed.add_field(name='Alea Jacta Est!', value=random.choice(simple_effect_values), inline=True)
+
+    embed.set_footer(text=f"« {random.choice(result.grotz)} »")
+    return embed
+
+
+def build_roll_text(roll: RollDetails) -> str:
+    nl = "\n"
+    critical = (f'{nl + "Succès critique !" if roll.critical_success else ""}'
+                f'{nl + "Échec critique..." if roll.critical_failure else ""}')
+    if roll.margin is None:
+        return (f'**@{roll.character}** a lancé {roll.number}d{roll.type}:'
+                f'{", ".join(map(str, roll.base_dices))}'
+                f'{critical}')
+
+    reason = roll.reason
+    if len(reason) > 0:
+        reason += ": "
+    reason += ", ".join(roll.formula)
+    effect_modifier = ""
+    if roll.effect_modifier != 0:
+        effect_modifier = f'\nModificateur d\'effet: {roll.effect_modifier}'
+    return (f'**@{roll.character}** ({reason}):'
+            f'\nMarge de {roll.margin}'
+            f' pour une valeur seuil de {roll.threshold}'
+            f'{critical}'
+            f'\nDés d\'effet: {", ".join(map(str, roll.effect_dices))}'
+            f'{effect_modifier}'
+            f'{nl + "Effet: " + roll.effect if roll.effect else ""}')
@@ -0,0 +1,303 @@
+"""Storage of the character sheets, compressed and deduplicated by content"""
+import difflib
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import NamedTuple, Optional, List, Tuple, Dict, Iterator
+
+compressed_suffix = '.gz'
+
+
+class StoredSheet(NamedTuple):
+    digest: str  # SHA-256 of the content
+    data: bytes  # gzip compressed content (or the plain content for sheets stored by older versions)
+    compressed: bool
+
+    def text(self) -> str:
+        return (gzip.decompress(self.data) if self.compressed else self.data).decode('utf-8')
+
+
+def blob_path(objects_path: str, digest: str) -> str:
+    """Return the path of the compressed content with this digest"""
+    return os.path.join(objects_path, digest[:2], digest + compressed_suffix)
+
+
+def _atomic_write(path: str, data: bytes, sync: bool = True) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as file_obj:
+            file_obj.write(data)
+            if sync:
+                file_obj.flush()
+                os.fsync(file_obj.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def _objects_lock(objects_path: str) -> Iterator[None]:
+    """Hold the lock of the objects directory, so that no blob is deleted while a sheet is linked to it"""
+    with open(objects_path.rstrip(os.sep) + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def store_sheet(sheet_path: str, objects_path: str, content: str) -> StoredSheet:
+    """
+    Save the content of a sheet
+
+    The content is compressed once in the objects directory under its SHA-256 and the sheet path becomes a
+    symbolic link to it. The link is swapped atomically, so readers see either the old or the new sheet.
+    """
+    data = content.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    # mtime=0 so that the same content always gives the same bytes
+    compressed_data = gzip.compress(data, mtime=0)
+    blob = blob_path(objects_path, digest)
+    with _objects_lock(objects_path):
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            _atomic_write(blob, compressed_data)
+
+        # A unique name: threads and processes may push the same content at the same time
+        tmp_link = tempfile.mktemp(dir=os.path.dirname(sheet_path), prefix='.tmp-')
+        os.symlink(os.path.relpath(blob, os.path.dirname(sheet_path)), tmp_link)
+        try:
+            os.replace(tmp_link, sheet_path)
+        except BaseException:
+            os.unlink(tmp_link)
+            raise
+    return StoredSheet(digest, compressed_data, True)
+
+
+def release_blob(objects_path: str, campaigns_path: str, digest: str) -> bool:
+    """
+    Delete the blob with this digest if no sheet of the campaigns links to it any more, return whether it was
+
+    Called with the digest of a replaced sheet, it keeps the objects directory to the contents in use.
+    """
+    blob_name = digest + compressed_suffix
+    with _objects_lock(objects_path):
+        for campaign in os.scandir(campaigns_path):
+            if not campaign.is_dir(follow_symlinks=False):
+                continue
+            for sheet in os.scandir(campaign.path):
+                if sheet.is_symlink() and os.path.basename(os.readlink(sheet.path)) == blob_name:
+                    return False
+        blob = blob_path(objects_path, digest)
+        try:
+            os.unlink(blob)
+        except FileNotFoundError:
+            return False
+        try:
+            os.rmdir(os.path.dirname(blob))
+        except OSError:  # Other blobs share the directory
+            pass
+    return True
+
+
+def load_sheet(sheet_path: str, cache: Optional['SheetCache'] = None) -> Optional[StoredSheet]:
+    """Return the stored sheet or None if it does not exist"""
+    try:
+        target = os.readlink(sheet_path)
+    except FileNotFoundError:
+        return None
+    except OSError:  # Not a link, a sheet saved in plain text
+        try:
+            with open(sheet_path, 'rb') as file_obj:
+                data = file_obj.read()
+        except FileNotFoundError:
+            return None
+        return StoredSheet(hashlib.sha256(data).hexdigest(), data, False)
+
+    digest = os.path.basename(target)[:-len(compressed_suffix)]
+    if cache is not None:
+        sheet = cache.get(digest)
+        if sheet is not None:
+            return sheet
+    try:
+        with open(os.path.join(os.path.dirname(sheet_path), target), 'rb') as file_obj:
+            sheet = StoredSheet(digest, file_obj.read(), True)
+    except FileNotFoundError:
+        # The blob of a sheet replaced since the link was read is released, read the new link
+        try:
+            replaced = os.readlink(sheet_path) != target
+        except OSError:
+            return None
+        return load_sheet(sheet_path, cache) if replaced else None
+    if cache is not None:
+        cache.put(sheet)
+    return sheet
+
+
+class SheetCache:
+    """
+    Least recently used compressed sheets, kept in memory up to max_size bytes
+
+    Sheets are indexed by the digest of their content, so an entry can never be stale: a pushed sheet simply
+    gets a new digest. discard() frees the memory of the replaced version.
+    """
+
+    def __init__(self, max_size: int = 64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self._sheets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest: str) -> Optional[StoredSheet]:
+        with self._lock:
+            sheet = self._sheets.get(digest)
+            if sheet is not None:
+                self._sheets.move_to_end(digest)
+            return sheet
+
+    def put(self, sheet: StoredSheet) -> None:
+        if len(sheet.data) > self.max_size:
+            return
+        with self._lock:
+            if sheet.digest in self._sheets:
+                self._sheets.move_to_end(sheet.digest)
+                return
+            self._sheets[sheet.digest] = sheet
+            self.size += len(sheet.data)
+            while self.size > self.max_size:
+                _, evicted = self._sheets.popitem(last=False)
+                self.size -= len(evicted.data)
+
+    def discard(self, digest: str) -> None:
+        with self._lock:
+            sheet = self._sheets.pop(digest, None)
+            if sheet is not None:
+                self.size -= len(sheet.data)
+
+
+def _history_path(sheet_path: str) -> str:
+    return os.path.join(os.path.dirname(sheet_path), '.' + os.path.basename(sheet_path) + '.history')
+
+
+@contextmanager
+def sheet_lock(sheet_path: str) -> Iterator[None]:
+    """Hold the lock of a sheet, across the processes, while its new version is stored and recorded"""
+    with open(_history_path(sheet_path) + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _lines(text: str) -> List[str]:
+    """The lines of the text with their end, split on "\n" only (other line breaks are part of the lines)"""
+    lines = text.split('\n')
+    return [line + '\n' for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+
+
+def compute_delta(old: str, new: str) -> List[Tuple[int, int, str]]:
+    """
+    Return the changes turning old into new, as a list of (start, end, text) operations
+
+    Each operation replaces the lines start to end (excluded) of old by text. Operations do not overlap and are
+    sorted, they must be applied from the last one to keep the line numbers valid (see apply_delta).
+    Lines end with "\n".
+    """
+    old_lines = _lines(old)
+    new_lines = _lines(new)
+    # Only the lines between the unchanged beginning and end are diffed: a push usually changes a few lines
+    start = 0
+    common = min(len(old_lines), len(new_lines))
+    while start < common and old_lines[start] == new_lines[start]:
+        start += 1
+    old_end, new_end = len(old_lines), len(new_lines)
+    while old_end > start and new_end > start and old_lines[old_end - 1] == new_lines[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    matcher = difflib.SequenceMatcher(None, old_lines[start:old_end], new_lines[start:new_end])
+    return [(start + i1, start + i2, ''.join(new_lines[start + j1:start + j2]))
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def apply_delta(content: str, delta: List[Tuple[int, int, str]]) -> str:
+    lines = _lines(content)
+    for start, end, text in reversed(delta):
+        lines[start:end] = _lines(text)
+    return ''.join(lines)
+
+
+def sheet_delta(old: str, new: str, max_ratio: float = 0.5) -> Optional[List[Tuple[int, int, str]]]:
+    """
+    Return the delta from old to new, or None if its text is larger than max_ratio times new: the clients had
+    better fetch the whole page then
+    """
+    delta = compute_delta(old, new)
+    if sum(len(text) for _, _, text in delta) > max_ratio * len(new):
+        return None
+    return delta
+
+
+def record_version(sheet_path: str, old: Optional[StoredSheet], new: StoredSheet,
+                   delta: Optional[List[Tuple[int, int, str]]], max_deltas: int = 50,
+                   max_size: int = 1024 * 1024) -> int:
+    """
+    Record a new version of a sheet along with its delta from the previous version and return its number
+
+    delta is the delta from old to new (see sheet_delta, computed before taking the lock), None if too large.
+    The history (".<sheet>.history" next to the sheet) keeps the deltas of the last max_deltas versions, up to
+    max_size bytes of JSON. It is not synced to disk: a history lost on a crash no longer matches the sheet and
+    restarts. The sheet_lock of the sheet must be held since old was loaded, so that the history matches the
+    stored sheet.
+    """
+    history = load_history(sheet_path)
+    if history is None:
+        history = {"version": 0, "digest": None, "deltas": []}
+        if old is not None:  # Sheet pushed before the history existed
+            history.update(version=1, digest=old.digest)
+    if history["digest"] == new.digest:
+        return history["version"]
+
+    if old is not None and old.digest == history["digest"] and delta is not None:
+        deltas = (history["deltas"] + [delta])[-max_deltas:]
+        sizes = [len(json.dumps(delta)) for delta in deltas]
+        first, total = 0, sum(sizes)
+        while total > max_size:  # The oldest deltas are dropped
+            total -= sizes[first]
+            first += 1
+        history["deltas"] = deltas[first:]
+    else:  # The previous version is unknown or the delta too large, the history restarts from this one
+        history["deltas"] = []
+    history["version"] += 1
+    history["digest"] = new.digest
+    _atomic_write(_history_path(sheet_path), json.dumps(history).encode('utf-8'), sync=False)
+    return history["version"]
+
+
+def load_history(sheet_path: str) -> Optional[Dict]:
+    try:
+        with open(_history_path(sheet_path), 'rb') as file_obj:
+            return json.loads(file_obj.read())
+    except (FileNotFoundError, ValueError):  # No history or lost on a crash
+        return None
+
+
+def get_changes(sheet_path: str, since: int, cache: Optional[SheetCache] = None) -> Optional[Dict]:
+    """
+    Return the changes of a sheet since the version `since`
+
+    The result holds the current "version" and either the "deltas" to apply in order to the version `since`
+    or, if these deltas are no longer known, the whole "page".
+    """
+    history = load_history(sheet_path)
+    sheet = load_sheet(sheet_path, cache)
+    if sheet is None:
+        return None
+    if history is None or history["digest"] != sheet.digest:
+        return {"version": history["version"] if history else 0, "page": sheet.text()}
+
+    first_known = history["version"] - len(history["deltas"])
+    if 0 < since <= history["version"] and since >= first_known:
+        return {"version": history["version"], "deltas": history["deltas"][since - first_known:]}
+    return {"version": history["version"], "page": sheet.text()}
@@ -0,0 +1,173 @@
+import math
+from sqlite3 import Connection
+from typing import List, Dict, Tuple, Optional, Iterable, Sequence
+
+import numpy as np
+
+from db import get_formula_usage, get_energy_usage, get_nimdir_index_by_player
+from streaks import compute_streaks
+
+
+def _encode(values: Iterable) -> Tuple[np.ndarray, List]:
+    """Return the integer code of each value and the list of distinct values indexed by code"""
+    index = {}
+    codes = np.fromiter((index.setdefault(value, len(index)) for value in values), dtype=np.int64)
+    return codes, list(index.keys())
+
+
+class CampaignStats:
+    """
+    Statistics of a campaign computed from a single load of its rolls
+
+    The rolls of the campaign are read once into columnar NumPy arrays (along with the sums of their base dices)
+    and every aggregate of the /graphs page is computed from these arrays. The filters on the player and the test
+    are applied as boolean masks. The usages of the formula elements and energies are read from their aggregates,
+    and the streaks of the players from their stored state unless the rolls are filtered by test.
+    """
+
+    def __init__(self, db: Connection, campaign: str, filter_player: Optional[str] = None,
+                 filter_test: Optional[str] = None):
+        self.campaign = campaign
+        self.filter_player = filter_player
+        self.filter_test = filter_test
+
+        cur = db.cursor()
+        try:
+            cur.execute('select rowid, "name", reason, "number", "type", threshold, margin,'
+                        ' critical_success, critical_failure'
+                        ' from rolls where campaign=? order by rowid asc', [campaign])
+            rolls = cur.fetchall()
+            cur.execute("select D.roll, sum(D.dice) from dices D inner join rolls R on D.roll=R.rowid"
+                        " where R.campaign=? and D.type='base_dices' group by D.roll", [campaign])
+            base_dices = cur.fetchall()
+        finally:
+            cur.close()
+        self._formula_usage = get_formula_usage(db, campaign, filter_player, filter_test)
+        self._energy_usage = get_energy_usage(db, campaign, filter_player, filter_test)
+        self._nimdir_index = None if filter_test else get_nimdir_index_by_player(db, campaign, filter_player)
+
+        columns = list(zip(*rolls)) if rolls else [()] * 9
+        self.rowids = np.array(columns[0], dtype=np.int64)
+        self.name_codes, self.names = _encode(columns[1])
+        self.reason_codes, self.reasons = _encode(columns[2])
+        self.numbers = np.array(columns[3], dtype=np.int64)
+        self.types = np.array(columns[4], dtype=np.int64)
+        self.thresholds = np.array(columns[5], dtype=np.int64)
+        self.margins = np.array(columns[6], dtype=np.int64)
+        self.critical_successes = np.array(columns[7], dtype=bool)
+        self.critical_failures = np.array(columns[8], dtype=bool)
+        self.successes = ((self.margins > 0) | self.critical_successes) & ~self.critical_failures
+
+        # Rolls matching the filters, with and without the "threshold > 0" condition
+        self.filter_mask = np.ones(len(rolls), dtype=bool)
+        if filter_player:
+            self.filter_mask &= self._code_mask(self.name_codes, self.names, filter_player)
+        if filter_test:
+            self.filter_mask &= self._code_mask(self.reason_codes, self.reasons, filter_test)
+        self.test_mask = self.thresholds > 0
+        self.mask = self.filter_mask & self.test_mask
+
+        # Sum of the base dices of each roll (-1 when the roll has no base dice)
+        self.base_dice_sums = np.full(len(rolls), -1, dtype=np.int64)
+        if base_dices:
+            roll_ids, sums = zip(*base_dices)
+            self.base_dice_sums[self._positions(roll_ids)] = sums
+
+    @staticmethod
+    def _code_mask(codes: np.ndarray, values: List, value: str) -> np.ndarray:
+        try:
+            return codes == values.index(value)
+        except ValueError:
+            return np.zeros(len(codes), dtype=bool)
+
+    def _positions(self, roll_ids: Iterable[int]) -> np.ndarray:
+        """Return the indexes in the roll arrays of the given roll ids"""
+        return np.searchsorted(self.rowids, np.array(roll_ids, dtype=np.int64))
+
+    def _sorted_names(self, mask: np.ndarray) -> List[Tuple[int, str]]:
+        """Return the (code, name) of the players having at least one roll in the mask, sorted by name"""
+        present = np.unique(self.name_codes[mask])
+        return sorted([(int(code), self.names[code]) for code in present], key=lambda item: item[1])
+
+    def _count_by_name(self, mask: np.ndarray) -> np.ndarray:
+        return np.bincount(self.name_codes[mask], minlength=len(self.names))
+
+    def _values_by_player(self, values: np.ndarray, mask: np.ndarray) -> Dict[str, List[int]]:
+        return {name: values[mask & (self.name_codes == code)].tolist() for code, name in self._sorted_names(mask)}
+
+    @property
+    def players(self) -> List[str]:
+        """Return the list of players"""
+        return sorted(self.names)
+
+    def count_by_player(self) -> Dict[str, int]:
+        """Return by player their total number of rolls"""
+        counts = self._count_by_name(self.mask)
+        return {name: int(counts[code]) for code, name in self._sorted_names(self.mask)}
+
+    def success_failure_by_player(self) -> Dict[str, Tuple[float, float]]:
+        """Return by player a tuple containing the success and the failure rate in order"""
+        counts = self._count_by_name(self.mask)
+        successes = self._count_by_name(self.mask & self.successes)
+        rates = {}
+        for code, name in self._sorted_names(self.mask):
+            count, success = int(counts[code]), int(successes[code])
+            rates[name] = (success / count * 100, (count - success) / count * 100)
+        return rates
+
+    def critical_by_player(self) -> Dict[str, Tuple[int, int]]:
+        """Return by player a tuple containing the number of critical successes and failures in order"""
+        successes = self._count_by_name(self.mask & self.critical_successes)
+        failures = self._count_by_name(self.mask & self.critical_failures)
+        return {name: (int(successes[code]), int(failures[code])) for code, name in self._sorted_names(self.mask)}
+
+    def nimdir_index_by_player(self) -> Dict[str, Tuple[int, int]]:
+        """Return by player a tuple containing the streak of successes and the streak of failures in order"""
+        if self._nimdir_index is not None:
+            return dict(self._nimdir_index)
+        streaks = compute_streaks(self.name_codes[self.mask], self.successes[self.mask], len(self.names)).longest
+        return {name: (int(streaks[code, 0]), int(streaks[code, 1])) for code, name in self._sorted_names(self.mask)}
+
+    def thresholds_by_player(self) -> Dict[str, List[int]]:
+        """Return by player a list of all the thresholds he/she attempted"""
+        return self._values_by_player(self.thresholds, self.mask)
+
+    def margins_by_player(self) -> Dict[str, List[int]]:
+        """Return by player a list of all the obtained margins"""
+        return self._values_by_player(self.margins, self.mask)
+
+    def base_dices(self) -> Dict[str, List[int]]:
+        """
+        Returns in a dictionary, the list of sums of 2 base dices obtained for each player
+        """
+        mask = self.mask & (self.types == 6) & (self.numbers == 2) & (self.base_dice_sums >= 0)
+        return self._values_by_player(self.base_dice_sums, mask)
+
+    def formula_usage(self) -> Dict[str, int]:
+        """Return the usage of each component, means and realm"""
+        return dict(self._formula_usage)
+
+    def energy_usage(self) -> Dict[str, int]:
+        """Return the usage of each energy"""
+        return dict(self._energy_usage)
+
+    def stats_by_test(self, percentiles: Sequence[float] = ()) -> List[Tuple]:
+        """
+        Return, for each test, its frequency, its average margin and its margin stddev, the most frequent first
+
+        The given percentiles (from 0 to 100) of the margins of each test are added as a last tuple element if any.
+        """
+        data = []
+        for code, reason in enumerate(self.reasons):
+            if reason is None:
+                continue
+            margins = self.margins[self.mask & (self.reason_codes == code)].astype(np.int64)
+            count = len(margins)
+            if count == 0:
+                continue
+            # Exact integer sums, as get_stats_by_test
+            margin_sum = int(margins.sum())
+            variance = (count * int((margins * margins).sum()) - margin_sum * margin_sum) / (count * count)
+            data.append((reason, count, margin_sum / count, math.sqrt(variance))
+                        + ((tuple(np.percentile(margins, percentiles).tolist()),) if len(percentiles) else ()))
+        return sorted(data, key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,41 @@
+"""Streaks of successes and failures (the "nimdir index") of the rolls of each player"""
+from typing import NamedTuple
+
+import numpy as np
+
+
+class Streaks(NamedTuple):
+    """Streaks by group, the columns of the (groups, 2) arrays being the successes and the failures"""
+    longest: np.ndarray  # Longest streaks
+    completed: np.ndarray  # Longest streaks before the current one
+    current_success: np.ndarray  # Whether the current streak is a streak of successes
+    current_length: np.ndarray  # Length of the current streak, 0 for a group without roll
+
+
+def compute_streaks(codes: np.ndarray, successes: np.ndarray, groups: int) -> Streaks:
+    """
+    Return the streaks of the rolls of each group, from the group code and the success of the rolls
+
+    The rolls are in chronological order, the streaks are found from the run lengths of the results of each group.
+    """
+    streaks = Streaks(np.zeros((groups, 2), dtype=np.int64), np.zeros((groups, 2), dtype=np.int64),
+                      np.zeros(groups, dtype=bool), np.zeros(groups, dtype=np.int64))
+    if len(codes) == 0:
+        return streaks
+    # Group the rolls while keeping them in chronological order
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    successes = successes[order]
+
+    # A streak starts on the first roll, on each new group and on each change of result
+    starts = np.flatnonzero(np.concatenate(([True], (codes[1:] != codes[:-1]) | (successes[1:] != successes[:-1]))))
+    lengths = np.diff(np.append(starts, len(codes)))
+    run_codes = codes[starts]
+    run_columns = (~successes[starts]).astype(np.int64)
+    np.maximum.at(streaks.longest, (run_codes, run_columns), lengths)
+
+    current = np.append(run_codes[1:] != run_codes[:-1], True)
+    np.maximum.at(streaks.completed, (run_codes[~current], run_columns[~current]), lengths[~current])
+    streaks.current_success[run_codes[current]] = successes[starts[current]]
+    streaks.current_length[run_codes[current]] = lengths[current]
+    return streaks
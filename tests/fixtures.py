@@ -0,0 +1,55 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import random
+
+PLAYERS = ['Aldo Tintinabulle', 'Berthe', 'Clovis le Gris', 'Dame Ermeline', 'Eudes']
+REASONS = ['Epée', 'Discrétion', 'Escalade', 'Premiers soins', 'Baratin', '']
+FORMULA_ELEMENTS = ['corps', 'instincts', 'coeur', 'esprit', 'perception', 'action', 'desir', 'resistance',
+                    'humain', 'animal', 'vegetal', 'mineral', 'mecanique', 'neant']
+ENERGIES = ['power', 'speed', 'precision', 'optional-power', 'optional-speed', 'optional-precision']
+
+
+def random_dices(rng, count):
+    return ','.join(str(rng.randint(1, 6)) for _ in range(count))
+
+
+def random_roll(rng=random, players=PLAYERS, reasons=REASONS, index=0):
+    """Return the POST data of a random roll, as sent by the export plugin of the dynamic sheet"""
+    roll = {
+        'name': rng.choice(players),
+        'timestamp': f'2021-06-26T17:{index // 3600 % 60:02d}:{index // 60 % 60:02d}.{index % 60:02d}',
+        'recording': 'true',
+        'base_dices': random_dices(rng, 2),
+        'number': '2',
+        'type': '6',
+        'critical_success': 'false',
+        'critical_failure': 'false',
+    }
+    if rng.random() < 0.1:  # A simple roll
+        return roll
+    base_sum = sum(int(dice) for dice in roll['base_dices'].split(','))
+    threshold = rng.randint(4, 14)
+    roll.update({
+        'reason': rng.choice(reasons),
+        'talent_level': str(rng.randint(-4, 2)),
+        'formula_elements': ','.join(rng.sample(FORMULA_ELEMENTS, rng.randint(1, 3))),
+        'invested_energies': ','.join(rng.sample(ENERGIES, rng.randint(0, 2))),
+        'max_value': str(threshold),
+        'threshold': str(threshold),
+        'margin': str(threshold - base_sum),
+        'critical_success': 'true' if base_sum == 2 else 'false',
+        'critical_failure': 'true' if base_sum == 12 else 'false',
+        'critical_dices': random_dices(rng, 1) if base_sum in (2, 12) else '',
+        'effect_dices': random_dices(rng, 1),
+        'effect_modifier': str(rng.choice([0, 0, 0, 1, -1])),
+        'effect': rng.choice(['', 'Dégâts [B] PV', 'Soigne MR + [C+1] PV']),
+    })
+    return roll
+
+
+def random_rolls(count, seed=0, **kw):
+    rng = random.Random(seed)
+    return [random_roll(rng, index=i, **kw) for i in range(count)]
@@ -8,13 +8,17 @@
 
 import unittest
 import tempfile
+import gzip
 import os
 import os.path
 import string
 import random
+import threading
 from pathlib import Path
 
 from dmview import app, get_config, setup as app_setup
+from sheets import apply_delta
+from tests.fixtures import random_rolls
 
 ENV_CONFIG = 'DMVIEW_CONFIGFILE'
 COMMON_SECTION = 'Common'
@@ -236,6 +240,175 @@ class RestTest(BaseTest):
         content = self.get_html('/view/' + self.campaign_id + '/' + sheet_id)
         assert content == sheet_content
 
+    def test_push_sheet_compressed(self):
+        sheet_id = random_string(25)
+        sheet_content = random_string(500) * 10
+        self.post_html(url='/push/' + self.campaign_id + '/' + sheet_id,
+                       data=dict(name=sheet_id, page=sheet_content))
+
+        resp = self.client.get('/view/' + self.campaign_id + '/' + sheet_id,
+                               headers={'Accept-Encoding': 'gzip, deflate'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert len(resp.data) < len(sheet_content)
+        assert gzip.decompress(resp.data).decode(ENCODING) == sheet_content
+
+    def test_push_same_sheet_deduplicated(self):
+        sheet_content = random_string(500)
+        for sheet_id in ('first', 'second'):
+            self.post_html(url='/push/' + self.campaign_id + '/' + sheet_id,
+                           data=dict(name=sheet_id, page=sheet_content))
+        objects = [f for _, _, files in os.walk(os.path.join(self.root_dir.name, 'objects')) for f in files]
+        assert len(objects) == 1
+        assert self.get_html('/view/' + self.campaign_id).count('<li>') == 2
+        for sheet_id in ('first', 'second'):
+            assert self.get_html('/view/' + self.campaign_id + '/' + sheet_id) == sheet_content
+
+    def test_replaced_sheet_released(self):
+        shared_content = random_string(500)
+        for sheet_id in ('first', 'second'):
+            self.post_html(url='/push/' + self.campaign_id + '/' + sheet_id,
+                           data=dict(name=sheet_id, page=shared_content))
+        # The content is still linked by the second sheet
+        self.post_html(url='/push/' + self.campaign_id + '/first', data=dict(name='first', page=random_string(500)))
+        objects = [f for _, _, files in os.walk(os.path.join(self.root_dir.name, 'objects')) for f in files]
+        assert len(objects) == 2
+        assert self.get_html('/view/' + self.campaign_id + '/second') == shared_content
+
+        sheet_content = random_string(500)
+        self.post_html(url='/push/' + self.campaign_id + '/second', data=dict(name='second', page=sheet_content))
+        objects = [f for _, _, files in os.walk(os.path.join(self.root_dir.name, 'objects')) for f in files]
+        assert len(objects) == 2
+        assert self.get_html('/view/' + self.campaign_id + '/second') == sheet_content
+
+    def test_concurrent_identical_pushes(self):
+        sheet_content = random_string(500)
+        statuses = []
+
+        def push(sheet_id):
+            statuses.append(app.test_client().post('/push/' + self.campaign_id + '/' + sheet_id,
+                                                   data=dict(name=sheet_id, page=sheet_content)).status_code)
+
+        threads = [threading.Thread(target=push, args=(sheet_id,)) for sheet_id in ('first', 'second') * 5]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert statuses == [200] * 10
+        for sheet_id in ('first', 'second'):
+            assert self.get_html('/view/' + self.campaign_id + '/' + sheet_id) == sheet_content
+
+    def test_view_sheet_not_modified(self):
+        sheet_id = random_string(25)
+        self.post_html(url='/push/' + self.campaign_id + '/' + sheet_id,
+                       data=dict(name=sheet_id, page=random_string(500)))
+        url = '/view/' + self.campaign_id + '/' + sheet_id
+        resp = self.client.get(url)
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.data == b''
+        resp = self.client.get(url, headers={'If-Modified-Since': last_modified})
+        assert resp.status_code == 304
+
+        sheet_content = random_string(500)
+        self.post_html(url='/push/' + self.campaign_id + '/' + sheet_id,
+                       data=dict(name=sheet_id, page=sheet_content))
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] != etag
+        assert resp.data.decode(ENCODING) == sheet_content
+
+    def test_sheet_changes(self):
+        sheet_id = random_string(25)
+        url = '/diff/' + self.campaign_id + '/' + sheet_id
+        assert self.no_such_campaign in self.get_html(url)
+        lines = [random_string(20) + '\n' for _ in range(100)]
+        versions = []
+        for i in range(3):
+            lines[i * 10] = random_string(20) + '\n'
+            versions.append(''.join(lines))
+            self.post_html(url='/push/' + self.campaign_id + '/' + sheet_id,
+                           data=dict(name=sheet_id, page=versions[-1]))
+
+        changes = self.client.get(url).get_json()
+        assert changes == {'version': 3, 'page': versions[-1]}
+        changes = self.client.get(url + '?since=3').get_json()
+        assert changes == {'version': 3, 'deltas': []}
+        changes = self.client.get(url + '?since=1').get_json()
+        assert changes['version'] == 3
+        content = versions[0]
+        for delta in changes['deltas']:
+            assert len(delta) == 1
+            content = apply_delta(content, delta)
+        assert content == versions[-1]
+
+    def test_concurrent_sheet_pushes(self):
+        sheet_id = random_string(25)
+        lines = [random_string(20) + '\n' for _ in range(100)]
+        versions = []
+        for i in range(20):
+            lines[i] = random_string(20) + '\n'
+            versions.append(''.join(lines))
+
+        def push(page):
+            app.test_client().post('/push/' + self.campaign_id + '/' + sheet_id, data=dict(name=sheet_id, page=page))
+
+        push(versions[0])
+        threads = [threading.Thread(target=push, args=(page,)) for page in versions[1:]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Every delta of the history leads to the stored sheet
+        changes = self.client.get('/diff/' + self.campaign_id + '/' + sheet_id + '?since=1').get_json()
+        assert changes['version'] == 20
+        page = self.client.get('/diff/' + self.campaign_id + '/' + sheet_id).get_json()['page']
+        content = versions[0]
+        for delta in changes['deltas']:
+            content = apply_delta(content, delta)
+        assert content == page
+
+    def test_events(self):
+        url = '/events/' + self.campaign_id + '/poll'
+        since = self.client.get(url).get_json()['last_id']
+        sheet_id = random_string(25)
+        self.post_html(url='/push/' + self.campaign_id + '/' + sheet_id,
+                       data=dict(name=sheet_id, page=random_string(500)))
+        events = self.client.get(url + f'?since={since}&timeout=5').get_json()
+        assert [event['type'] for event in events['events']] == ['sheet']
+        assert events['events'][0]['data']['sheet'] == sheet_id
+        assert events['events'][0]['data']['version'] == 1
+
+        resp = self.client.get('/events/' + self.campaign_id,
+                               headers={'Last-Event-ID': str(since)})
+        assert resp.mimetype == 'text/event-stream'
+        stream = iter(resp.response)
+        next(stream)
+        assert f'id: {events["last_id"]}\nevent: sheet\n' in next(stream).decode(ENCODING)
+        resp.close()
+
+    def test_events_unknown_campaign(self):
+        assert self.no_such_campaign in self.get_html('/events/' + self.campaign_id + '/poll?since=0&timeout=0')
+        assert self.no_such_campaign in self.get_html('/events/' + self.campaign_id)
+        assert self.campaign_id not in app.event_hub._channels
+
+    def test_graph_page_cache(self):
+        url = '/graphs/' + self.campaign_id
+        rolls = random_rolls(2)
+        self.client.post('/roll/' + self.campaign_id, data=rolls[0])
+        assert self.client.get(url).status_code == 200
+        key = (self.campaign_id, None, None)
+        graphs = app.graph_cache.get(key, 1)
+        assert graphs['players'] == [rolls[0]['name']]
+        assert self.client.get(url).status_code == 200
+        assert app.graph_cache.get(key, 1) is graphs  # Not rendered again
+
+        self.client.post('/roll/' + self.campaign_id, data=rolls[1])
+        assert self.client.get(url).status_code == 200
+        assert app.graph_cache.get(key, 2) is not graphs
+
 ##
 ##    def test_remove_sheet(self):
 ##        pass
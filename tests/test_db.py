@@ -0,0 +1,382 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import os.path
+import statistics
+import tempfile
+import unittest
+
+from db import ConnectionPool, create_db, init_db_connection, insert_roll, parse_roll, bulk_insert_rolls, migrations, \
+    get_players, get_count_by_player, get_success_failure_by_player, get_critical_by_player, get_nimdir_index_by_player, \
+    get_thresholds_by_player, get_margins_by_player, get_base_dices, get_formula_usage, get_energy_usage, \
+    get_stats_by_test, queue_discord_roll, get_queued_discord_rolls, remove_queued_discord_rolls, get_campaign_version, \
+    rebuild_aggregates
+from stats import CampaignStats
+from tests.fixtures import random_rolls, PLAYERS, REASONS
+
+CAMPAIGN = 'campaign'
+
+filtered_getters = [get_count_by_player, get_success_failure_by_player, get_critical_by_player,
+                    get_nimdir_index_by_player, get_thresholds_by_player, get_margins_by_player, get_base_dices,
+                    get_formula_usage, get_energy_usage, get_stats_by_test]
+
+
+class DbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.root_dir.name, 'roll.sqlite3')
+        create_db(self.db_path)
+        self.db = init_db_connection(self.db_path)
+
+    def tearDown(self):
+        self.db.close()
+        self.root_dir.cleanup()
+
+    def insert_rolls(self, rolls, campaign=CAMPAIGN):
+        with self.db:
+            for roll in rolls:
+                insert_roll(self.db, campaign, roll)
+
+
+class MigrationTest(DbTest):
+
+    def test_create_db_is_versioned(self):
+        assert self.db.execute("PRAGMA user_version").fetchone()[0] == len(migrations)
+
+    def test_create_db_keeps_data(self):
+        self.insert_rolls(random_rolls(10))
+        create_db(self.db_path)
+        assert self.db.execute("select count(*) from rolls").fetchone()[0] == 10
+
+    def test_migrate_old_db(self):
+        self.db.executescript("DROP INDEX rolls_campaign_name; PRAGMA user_version = 0;")
+        self.insert_rolls(random_rolls(10))
+        create_db(self.db_path)
+        assert self.db.execute("PRAGMA user_version").fetchone()[0] == len(migrations)
+        assert self.db.execute("select count(*) from sqlite_master"
+                               " where type='index' and name='rolls_campaign_name'").fetchone()[0] == 1
+        assert self.db.execute("select count(*) from rolls").fetchone()[0] == 10
+
+
+class InsertRollTest(DbTest):
+
+    def test_parse_roll(self):
+        roll = parse_roll(CAMPAIGN, {'name': 'Berthe', 'timestamp': 'now', 'reason': '', 'margin': '3',
+                                     'threshold': 'NaN', 'critical_success': 'true', 'base_dices': '1,5',
+                                     'effect_dices': '', 'formula_elements': 'corps,action', 'labels': 'x'})
+        assert roll.columns == ('campaign', 'name', 'timestamp', 'reason', 'margin', 'threshold', 'critical_success')
+        assert roll.values == [CAMPAIGN, 'Berthe', 'now', None, 3, None, True]
+        assert roll.dices == [('base_dices', 0, 1), ('base_dices', 1, 5)]
+        assert roll.formula == ['corps', 'action']
+        assert roll.energies == []
+        assert (roll.name, roll.timestamp) == ('Berthe', 'now')
+
+    def test_update_roll(self):
+        roll = random_rolls(1)[0]
+        roll['base_dices'] = '1,2'
+        self.insert_rolls([roll, random_rolls(1, seed=1)[0]])
+        roll['base_dices'] = '3,4'
+        self.insert_rolls([roll])
+        assert self.db.execute("select count(*) from rolls").fetchone()[0] == 2
+        rowid = self.db.execute("select max(rowid) from rolls").fetchone()[0]
+        assert self.db.execute("select dice from dices where roll=? and type='base_dices' order by dice_index",
+                               [rowid]).fetchall() == [(3,), (4,)]
+
+
+class BulkInsertTest(DbTest):
+
+    def dump(self, db):
+        return (db.execute("select campaign, name, timestamp, reason, threshold, margin from rolls"
+                           " order by name, timestamp").fetchall(),
+                db.execute('select R.name, R.timestamp, D.type, D.dice_index, D.dice from dices D'
+                           ' inner join rolls R on D.roll=R.rowid order by 1, 2, 3, 4').fetchall(),
+                db.execute('select R.name, R.timestamp, F.element from formula_elements F'
+                           ' inner join rolls R on F.roll=R.rowid order by 1, 2, 3').fetchall(),
+                db.execute('select R.name, R.timestamp, E.energy from invested_energies E'
+                           ' inner join rolls R on E.roll=R.rowid order by 1, 2, 3').fetchall())
+
+    def test_same_as_insert_roll(self):
+        rolls = random_rolls(300)
+        # Updates of rolls in the same batch and in later batches
+        updates = random_rolls(300, seed=1)[:50] + random_rolls(300, seed=2)[250:]
+        self.insert_rolls(rolls + updates)
+
+        other_path = os.path.join(self.root_dir.name, 'other.sqlite3')
+        create_db(other_path)
+        other_db = init_db_connection(other_path)
+        counts = []
+        assert bulk_insert_rolls(other_db, CAMPAIGN, iter(rolls + updates), batch_size=70,
+                                 progress=counts.append) == 400
+        assert counts == [70, 140, 210, 280, 350, 400]
+        assert self.dump(other_db) == self.dump(self.db)
+        other_db.close()
+
+    def test_after_insert_roll(self):
+        rolls = random_rolls(20)
+        self.insert_rolls(rolls[:10])
+        assert bulk_insert_rolls(self.db, CAMPAIGN, rolls) == 20
+        assert self.db.execute("select count(*) from rolls").fetchone()[0] == 20
+        self.insert_rolls(random_rolls(5), campaign='other-campaign')
+        assert self.db.execute("select count(*) from rolls").fetchone()[0] == 25
+
+
+class AggregatesTest(DbTest):
+
+    def aggregates(self):
+        return (self.db.execute("select * from roll_aggregates where tests > 0 order by 1, 2, 3").fetchall(),
+                self.db.execute("select * from formula_aggregates where uses > 0 order by 1, 2, 3, 4").fetchall(),
+                self.db.execute("select * from energy_aggregates where uses > 0 order by 1, 2, 3, 4").fetchall())
+
+    def test_same_as_rebuild(self):
+        rolls = random_rolls(300)
+        self.insert_rolls(rolls[:200])
+        self.insert_rolls(random_rolls(50, seed=1), campaign='other-campaign')
+        # Updated rolls, one at a time then by batches
+        updates = random_rolls(300, seed=2)
+        for roll, update in zip(rolls[:200], updates):
+            update.update(name=roll['name'], timestamp=roll['timestamp'])
+        self.insert_rolls(updates[:100])
+        bulk_insert_rolls(self.db, CAMPAIGN, updates[100:200] + rolls[200:], batch_size=30)
+        aggregates = self.aggregates()
+        assert len(aggregates[0]) > 0 and len(aggregates[1]) > 0 and len(aggregates[2]) > 0
+
+        rebuild_aggregates(self.db)
+        assert self.aggregates() == aggregates
+
+    def test_getters_read_aggregates(self):
+        self.insert_rolls(random_rolls(100))
+        counts = get_count_by_player(self.db, CAMPAIGN)
+        with self.db:
+            self.db.execute("update roll_aggregates set tests = 0")
+        assert get_count_by_player(self.db, CAMPAIGN) == {}
+        rebuild_aggregates(self.db)
+        assert get_count_by_player(self.db, CAMPAIGN) == counts
+
+
+def replayed_nimdir_index(rolls):
+    """The streaks of the tests of each player, replayed one roll at a time"""
+    streaks = {}
+    longest = {}
+    for roll in rolls:
+        if int(roll.get('threshold', 0)) <= 0:
+            continue
+        success = (int(roll.get('margin', 0)) > 0 or roll.get('critical_success') == 'true') \
+            and roll.get('critical_failure') != 'true'
+        kind, length = streaks.get(roll['name'], (success, 0))
+        length = length + 1 if kind == success else 1
+        streaks[roll['name']] = (success, length)
+        best = longest.setdefault(roll['name'], [0, 0])
+        best[0 if success else 1] = max(best[0 if success else 1], length)
+    return {name: tuple(best) for name, best in sorted(longest.items())}
+
+
+class StreaksTest(DbTest):
+
+    def dirty_streaks(self):
+        return self.db.execute("select count(*) from streaks where dirty").fetchone()[0]
+
+    def test_incremental_streaks(self):
+        history = {}  # The rolls in the order of their ids: an updated roll gets a new id
+
+        def insert(rolls, bulk=False):
+            for roll in rolls:
+                history.pop((roll['name'], roll['timestamp']), None)
+                history[roll['name'], roll['timestamp']] = roll
+            if bulk:
+                bulk_insert_rolls(self.db, CAMPAIGN, rolls, batch_size=30)
+                assert self.dirty_streaks() == 0
+            else:
+                self.insert_rolls(rolls)
+            assert get_nimdir_index_by_player(self.db, CAMPAIGN) == replayed_nimdir_index(history.values())
+
+        rolls = random_rolls(300)
+        insert(rolls[:100])
+        # Updates of the last roll of a player, then of older rolls
+        last_roll = random_rolls(1, seed=1)[0]
+        last_roll.update(name=rolls[99]['name'], timestamp=rolls[99]['timestamp'])
+        insert([last_roll])
+        insert([last_roll])
+        assert self.dirty_streaks() == 0
+        updates = random_rolls(50, seed=2)
+        for roll, update in zip(rolls, updates):
+            update.update(name=roll['name'], timestamp=roll['timestamp'])
+        insert(updates[:25])
+        assert self.dirty_streaks() == 0  # Replayed by the insert which made them dirty
+        insert(updates[25:] + rolls[100:], bulk=True)
+
+        nimdir_index = get_nimdir_index_by_player(self.db, CAMPAIGN)
+        assert get_nimdir_index_by_player(self.db, CAMPAIGN, filter_player=PLAYERS[0]) \
+            == {PLAYERS[0]: nimdir_index[PLAYERS[0]]}
+        # Dirty streaks are replayed by the getter
+        with self.db:
+            self.db.execute("update streaks set length = 0, dirty = 1")
+        assert get_nimdir_index_by_player(self.db, CAMPAIGN) == nimdir_index
+        rebuild_aggregates(self.db)
+        assert self.dirty_streaks() == 0
+        assert get_nimdir_index_by_player(self.db, CAMPAIGN) == nimdir_index
+
+
+    def test_dirty_player_refreshed_by_insert(self):
+        tests = [roll for roll in random_rolls(200) if roll['name'] == PLAYERS[0] and int(roll.get('threshold', 0)) > 0]
+        self.insert_rolls(tests[:-1])
+        with self.db:  # Left dirty, for instance by a previous version
+            self.db.execute("update streaks set length = 0, dirty = 1")
+        assert get_nimdir_index_by_player(self.db, CAMPAIGN) == replayed_nimdir_index(tests[:-1])
+        self.insert_rolls(tests[-1:])
+        assert self.dirty_streaks() == 0
+        assert get_nimdir_index_by_player(self.db, CAMPAIGN) == replayed_nimdir_index(tests)
+
+
+class StatsByTestTest(DbTest):
+
+    def test_filtered_stats(self):
+        rolls = random_rolls(300)
+        self.insert_rolls(rolls)
+        self.insert_rolls(random_rolls(50, seed=1), campaign='other-campaign')
+        for player in [None, PLAYERS[0]]:
+            margins = {}
+            for roll in rolls:
+                if int(roll.get('threshold', 0)) > 0 and roll['reason'] and player in (None, roll['name']):
+                    margins.setdefault(roll['reason'], []).append(int(roll['margin']))
+            stats = get_stats_by_test(self.db, CAMPAIGN, player, percentiles=[25, 50, 75])
+            assert [count for _, count, *_ in stats] == sorted(map(len, margins.values()), reverse=True)
+            for test, count, mean, stddev, percentiles in stats:
+                self.assertAlmostEqual(mean, statistics.fmean(margins[test]))
+                self.assertAlmostEqual(stddev, statistics.pstdev(margins[test]))
+                quartiles = statistics.quantiles(margins[test], n=4, method='inclusive')
+                for percentile, quartile in zip(percentiles, quartiles):
+                    self.assertAlmostEqual(percentile, quartile)
+            assert [item[:4] for item in stats] == get_stats_by_test(self.db, CAMPAIGN, player)
+
+
+class CampaignVersionTest(DbTest):
+
+    def test_bumped_by_writes(self):
+        assert get_campaign_version(self.db, CAMPAIGN) == 0
+        self.insert_rolls(random_rolls(3))
+        assert get_campaign_version(self.db, CAMPAIGN) == 3
+        bulk_insert_rolls(self.db, CAMPAIGN, random_rolls(30), batch_size=10)
+        assert get_campaign_version(self.db, CAMPAIGN) == 6
+        assert get_campaign_version(self.db, 'other-campaign') == 0
+
+    def test_bumped_by_rebuild(self):
+        self.insert_rolls(random_rolls(3))
+        self.insert_rolls(random_rolls(2), campaign='other-campaign')
+        with self.db:
+            self.db.execute("delete from campaign_versions where campaign = 'other-campaign'")
+        rebuild_aggregates(self.db)
+        assert not self.db.in_transaction
+        assert get_campaign_version(self.db, CAMPAIGN) == 4
+        assert get_campaign_version(self.db, 'other-campaign') == 1
+
+
+class DiscordOutboxTest(DbTest):
+
+    def test_queue_and_remove(self):
+        with self.db:
+            queue_discord_roll(self.db, 'server', 'Berthe-1', {'name': 'Berthe', 'margin': '1'})
+            queue_discord_roll(self.db, 'server', 'Berthe-2', {'name': 'Berthe', 'margin': '2'})
+            queue_discord_roll(self.db, 'server', 'Berthe-1', {'name': 'Berthe', 'margin': '3'})
+        rolls = get_queued_discord_rolls(self.db)
+        assert [(server, key, roll['margin']) for _, server, key, roll in rolls] \
+            == [('server', 'Berthe-1', '1'), ('server', 'Berthe-2', '2'), ('server', 'Berthe-1', '3')]
+        assert get_queued_discord_rolls(self.db, rolls[1][0]) == rolls[2:]
+
+        # The last version of Berthe-1 is sent, which removes the previous one too
+        with self.db:
+            remove_queued_discord_rolls(self.db, 'server', 'Berthe-1', rolls[2][0])
+        assert get_queued_discord_rolls(self.db) == rolls[1:2]
+
+
+class ConnectionPoolTest(DbTest):
+
+    def test_pragmas(self):
+        pool = ConnectionPool(self.db_path, synchronous="normal", busy_timeout=1234)
+        with pool.connection() as db:
+            assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            assert db.execute("PRAGMA synchronous").fetchone()[0] == 1
+            assert db.execute("PRAGMA busy_timeout").fetchone()[0] == 1234
+            assert db.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+        pool.close()
+
+    def test_reuse(self):
+        pool = ConnectionPool(self.db_path, size=1)
+        with pool.connection() as db:
+            with pool.connection() as other_db:
+                assert db is not other_db
+        with pool.connection() as reused_db:
+            assert reused_db is other_db  # Only one idle connection is kept
+        with pool.connection() as reused_db:
+            assert reused_db is other_db
+        pool.close()
+
+    def test_commit_and_rollback(self):
+        pool = ConnectionPool(self.db_path)
+        rolls = random_rolls(2)
+        with pool.connection() as db:
+            insert_roll(db, CAMPAIGN, rolls[0])
+        with self.assertRaises(RuntimeError):
+            with pool.connection() as db:
+                insert_roll(db, CAMPAIGN, rolls[1])
+                raise RuntimeError()
+        assert self.db.execute("select count(*) from rolls").fetchone()[0] == 1
+        pool.close()
+
+
+class QueryPlanTest(DbTest):
+    """Check that the queries of the statistics never scan a whole table"""
+
+    def setUp(self):
+        super().setUp()
+        self.insert_rolls(random_rolls(100))
+        self.queries = []
+
+    def trace(self, func, *args, **kw):
+        self.db.set_trace_callback(self.queries.append)
+        try:
+            func(*args, **kw)
+        finally:
+            self.db.set_trace_callback(None)
+
+    def assert_no_table_scan(self):
+        assert len(self.queries) > 0
+        for query in self.queries:
+            for row in self.db.execute("EXPLAIN QUERY PLAN " + query):
+                assert not row[3].startswith("SCAN "), f"'{row[3]}' in the query plan of: {query}"
+
+    def test_get_players(self):
+        self.trace(get_players, self.db, CAMPAIGN)
+        self.assert_no_table_scan()
+
+    def test_getters(self):
+        for getter in filtered_getters:
+            self.trace(getter, self.db, CAMPAIGN)
+        self.assert_no_table_scan()
+
+    def test_getters_filter_player(self):
+        for getter in filtered_getters:
+            self.trace(getter, self.db, CAMPAIGN, PLAYERS[0])
+        self.assert_no_table_scan()
+
+    def test_getters_filter_test(self):
+        for getter in filtered_getters:
+            self.trace(getter, self.db, CAMPAIGN, None, REASONS[0])
+        self.assert_no_table_scan()
+
+    def test_getters_filter_player_and_test(self):
+        for getter in filtered_getters:
+            self.trace(getter, self.db, CAMPAIGN, PLAYERS[0], REASONS[0])
+        self.assert_no_table_scan()
+
+    def test_campaign_stats(self):
+        self.trace(CampaignStats, self.db, CAMPAIGN)
+        self.assert_no_table_scan()
+
+    def test_insert_roll(self):
+        roll = random_rolls(1, seed=42)[0]
+        self.trace(insert_roll, self.db, CAMPAIGN, roll)
+        self.trace(insert_roll, self.db, CAMPAIGN, roll)  # Update
+        self.assert_no_table_scan()
@@ -0,0 +1,92 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import discord_bot
+from roll_render import format_dices
+
+
+class Emoji(SimpleNamespace):
+
+    def __str__(self):
+        return f'<:{self.name}:{self.id}>'
+
+
+class Guild(SimpleNamespace):
+
+    def __init__(self, guild_id, channels, emojis=()):
+        super().__init__(id=guild_id, channels=list(channels), emojis=list(emojis))
+
+    @property
+    def text_channels(self):
+        return sorted(self.channels, key=lambda channel: channel.position)
+
+    def get_channel(self, channel_id):
+        return next((channel for channel in self.channels if channel.id == channel_id), None)
+
+
+def channel(guild_id, channel_id, position):
+    return SimpleNamespace(id=channel_id, position=position, guild=SimpleNamespace(id=guild_id))
+
+
+def roll_details(channel_id=None):
+    return {"discord_channel_id": None if channel_id is None else str(channel_id)}
+
+
+class IndexesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.guilds = [Guild(1, [channel(1, 10, 1), channel(1, 11, 0)], [Emoji(name='one', id=100)]),
+                       Guild(2, [channel(2, 20, 0)], [Emoji(name='one', id=200), Emoji(name='two', id=201)])]
+        self.client = SimpleNamespace(guilds=self.guilds, emojis=[])
+        self.update_emojis()
+        patcher = mock.patch.object(discord_bot, 'client', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        asyncio.run(discord_bot.on_ready())
+
+    def update_emojis(self):
+        self.client.emojis = [emoji for guild in self.client.guilds for emoji in guild.emojis]
+
+    def test_guild_join_and_remove(self):
+        assert discord_bot.get_roll_channel('3', roll_details()) is None
+        guild = Guild(3, [channel(3, 30, 0)])
+        self.client.guilds = self.guilds + [guild]
+        asyncio.run(discord_bot.on_guild_join(guild))
+        assert discord_bot.get_roll_channel('3', roll_details()).id == 30
+
+        self.client.guilds = self.guilds[1:] + [guild]
+        asyncio.run(discord_bot.on_guild_remove(self.guilds[0]))
+        assert discord_bot.get_roll_channel('1', roll_details()) is None
+        assert discord_bot.get_roll_channel('3', roll_details()).id == 30
+
+    def test_channels(self):
+        assert discord_bot.get_roll_channel('1', roll_details(10)).id == 10
+        # The first text channel when the channel of the campaign is not set or no longer exists
+        assert discord_bot.get_roll_channel('1', roll_details()).id == 11
+        assert discord_bot.get_roll_channel('1', roll_details(12)).id == 11
+
+        created = channel(1, 12, -1)
+        self.guilds[0].channels.append(created)
+        asyncio.run(discord_bot.on_guild_channel_create(created))
+        assert discord_bot.get_roll_channel('1', roll_details()).id == 12
+        assert discord_bot.get_roll_channel('1', roll_details(12)).id == 12
+
+        self.guilds[0].channels.remove(created)
+        asyncio.run(discord_bot.on_guild_channel_delete(created))
+        assert discord_bot.get_roll_channel('1', roll_details()).id == 11
+
+    def test_emojis(self):
+        # The first emoji of a name wins, a missing emoji is written by name
+        assert format_dices((1, 2, 7), discord_bot.emojis_by_name) == '<:one:100> <:two:201> 7'
+        self.guilds[0].emojis = [Emoji(name='one', id=101), Emoji(name='three', id=102)]
+        self.guilds[1].emojis = []
+        self.update_emojis()
+        asyncio.run(discord_bot.on_guild_emojis_update(self.guilds[1], [], []))
+        assert format_dices((1, 2, 3), discord_bot.emojis_by_name) == '<:one:101> two <:three:102>'
@@ -0,0 +1,81 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from db import get_crawl_checkpoint
+from discord_crawl import crawl_channel, parse_roll_message
+from roll_render import parse_roll_details, build_roll_data
+from tests.fixtures import random_rolls, FORMULA_ELEMENTS
+from tests.test_db import DbTest, CAMPAIGN
+
+emojis = {name: f'<:{name}:{i}>' for i, name in enumerate(FORMULA_ELEMENTS + ['one', 'two', 'three', 'four',
+                                                                              'five', 'six'])}
+start_date = datetime(2021, 6, 26)
+
+
+def roll_message(message_id, post_data):
+    """A message of the bot, as crawled"""
+    embed = build_roll_data(parse_roll_details(post_data['name'], post_data), 'embed', emojis)
+    return SimpleNamespace(id=message_id, embeds=[embed], created_at=start_date + timedelta(seconds=message_id))
+
+
+class Channel:
+    """The history of a channel, newest messages first, optionally failing after max_messages messages"""
+
+    def __init__(self, messages, max_messages=None):
+        self.id = 42
+        self.messages = sorted(messages, key=lambda message: -message.id)
+        self.max_messages = max_messages
+
+    async def history(self, limit=None, before=None, after=None, oldest_first=None):
+        messages = self.messages
+        if before is not None:
+            messages = [message for message in messages if message.id < before.id]
+        if after is not None:
+            messages = [message for message in reversed(messages) if message.id > after.id]
+        for i, message in enumerate(messages):
+            if self.max_messages is not None and i == self.max_messages:
+                raise ConnectionError("Interrupted")
+            yield message
+
+
+class CrawlTest(DbTest):
+
+    def count_rolls(self):
+        return self.db.execute("select count(*) from rolls").fetchone()[0]
+
+    def test_parse_roll_message(self):
+        for post_data in random_rolls(100):
+            roll = parse_roll_message(roll_message(1, post_data))
+            if post_data['critical_failure'] == 'true':  # Only critical successes have critical dices
+                assert roll is None
+                continue
+            assert roll['name'] == post_data['name']
+            assert roll['base_dices'] == post_data['base_dices']
+            if 'margin' in post_data:
+                assert roll['margin'] == int(post_data['margin'])
+                assert roll['formula_elements'] == post_data['formula_elements']
+
+    def test_resume(self):
+        messages = [roll_message(i, roll) for i, roll in enumerate(random_rolls(25), start=1)]
+        with self.assertRaises(ConnectionError):
+            asyncio.run(crawl_channel(self.db, Channel(messages, max_messages=15), CAMPAIGN, batch_size=10))
+        assert get_crawl_checkpoint(self.db, 42) == (16, 25, False)
+        saved = self.count_rolls()
+
+        # The crawl starts again from the last saved batch
+        assert asyncio.run(crawl_channel(self.db, Channel(messages), CAMPAIGN, batch_size=10)) \
+            == self.count_rolls() - saved
+        assert get_crawl_checkpoint(self.db, 42) == (1, 25, True)
+        total = self.count_rolls()
+
+        # Only the new messages are crawled
+        new_messages = [roll_message(i, roll) for i, roll in enumerate(random_rolls(5, seed=1), start=26)]
+        assert asyncio.run(crawl_channel(self.db, Channel(messages + new_messages), CAMPAIGN, batch_size=10)) \
+            == self.count_rolls() - total
+        assert get_crawl_checkpoint(self.db, 42) == (1, 30, True)
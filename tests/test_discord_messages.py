@@ -0,0 +1,50 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import os.path
+import tempfile
+import unittest
+
+from db import create_db, init_db_connection
+from discord_messages import MessageCache
+
+
+class MessageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.root_dir.name, 'roll.sqlite3')
+        create_db(self.db_path)
+        self.db = init_db_connection(self.db_path)
+
+    def tearDown(self):
+        self.db.close()
+        self.root_dir.cleanup()
+
+    def test_lru(self):
+        cache = MessageCache(self.db, max_messages=3)
+        for i in range(3):
+            cache.put('server', f'roll-{i}', 1, 100 + i)
+        cache.put('other', 'roll-0', 2, 200)
+        assert cache.get('server', 'roll-0') == (1, 100)  # roll-1 is now the least recently used
+        cache.put('server', 'roll-3', 1, 103)
+        assert cache.get('server', 'roll-1') is None
+        assert [cache.get('server', f'roll-{i}') for i in (0, 2, 3)] == [(1, 100), (1, 102), (1, 103)]
+        assert cache.get('other', 'roll-0') == (2, 200)
+        assert self.db.execute("select count(*) from discord_messages").fetchone()[0] == 4
+
+    def test_persistence(self):
+        cache = MessageCache(self.db, max_messages=3)
+        for i in range(4):
+            cache.put('server', f'roll-{i}', 1, 100 + i)
+        cache.get('server', 'roll-1')
+
+        db = init_db_connection(self.db_path)
+        cache = MessageCache(db, max_messages=2)
+        assert cache.get('server', 'roll-2') is None  # Evicted by the lower limit
+        assert cache.get('server', 'roll-1') == (1, 101)
+        assert cache.get('server', 'roll-3') == (1, 103)
+        db.close()
+        assert self.db.execute("select count(*) from discord_messages").fetchone()[0] == 2
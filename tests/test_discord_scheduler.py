@@ -0,0 +1,113 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+
+import discord
+
+from discord_scheduler import RateBucket, ChannelScheduler, is_transient
+
+
+class RateBucketTest(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        bucket = RateBucket(rate=2, per=1.0)
+        assert bucket.acquire() == 0
+        assert bucket.acquire() == 0
+        assert 0.45 < bucket.acquire() <= 0.5
+        assert 0.95 < bucket.acquire() <= 1.0
+
+
+class ChannelSchedulerTest(unittest.TestCase):
+
+    def run_scheduler(self, bucket, submissions, expected_count):
+        processed = []
+
+        async def process(key, item):
+            processed.append((key, item, time.monotonic()))
+
+        async def main():
+            scheduler = ChannelScheduler(process, bucket)
+            for key, item in submissions:
+                scheduler.submit(key, item)
+            while len(processed) < expected_count:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            scheduler._task.cancel()
+
+        asyncio.run(main())
+        return processed
+
+    def test_coalesce_updates(self):
+        submissions = [('a', 1), ('b', 1), ('a', 2), ('c', 1), ('a', 3), ('b', 2)]
+        processed = self.run_scheduler(RateBucket(rate=1, per=0.05), submissions, 3)
+        assert [(key, item) for key, item, _ in processed] == [('a', 3), ('b', 2), ('c', 1)]
+
+    def test_rate_limited(self):
+        processed = self.run_scheduler(RateBucket(rate=2, per=0.2), [(i, i) for i in range(5)], 5)
+        assert [key for key, _, _ in processed] == list(range(5))
+        # 2 immediately, then one every 0.1s
+        assert processed[-1][2] - processed[0][2] >= 0.29
+
+    def test_retry_failures(self):
+        attempts = []
+        processed = []
+
+        async def process(key, item):
+            attempts.append((key, item))
+            if key == 'a' and attempts.count(('a', 1)) <= 2 or item == 'old':
+                raise ConnectionError("Unavailable")
+            processed.append((key, item))
+
+        async def main():
+            scheduler = ChannelScheduler(process, RateBucket(rate=100, per=1.0), retry_delay=0.02)
+            scheduler.submit('a', 1)
+            scheduler.submit('b', 'old')
+            await asyncio.sleep(0.01)
+            scheduler.submit('b', 'new')  # Replaces the failed item
+            await asyncio.sleep(0.2)
+            scheduler._task.cancel()
+
+        with self.assertLogs('discord_scheduler', level='ERROR'):
+            asyncio.run(main())
+        assert processed == [('b', 'new'), ('a', 1)]
+        assert attempts.count(('a', 1)) == 3 and attempts.count(('b', 'old')) == 1
+
+    def test_drop_failures(self):
+        attempts = []
+        dropped = []
+
+        async def process(key, item):
+            attempts.append(key)
+            raise ConnectionError("Unavailable") if key == 'a' else ValueError("Invalid")
+
+        async def drop(key, item):
+            dropped.append((key, item))
+
+        async def main():
+            scheduler = ChannelScheduler(process, RateBucket(rate=100, per=1.0), retry_delay=0.01, max_attempts=3,
+                                         drop=drop)
+            scheduler.submit('a', 1)
+            scheduler.submit('b', 2)
+            await asyncio.sleep(0.2)
+            scheduler._task.cancel()
+
+        with self.assertLogs('discord_scheduler', level='ERROR'):
+            asyncio.run(main())
+        assert attempts.count('a') == 3 and attempts.count('b') == 1
+        assert dropped == [('b', 2), ('a', 1)]
+
+    def test_transient_errors(self):
+        def http_error(status):
+            return discord.HTTPException(SimpleNamespace(status=status, reason=''), '')
+
+        assert is_transient(http_error(429)) and is_transient(http_error(503))
+        assert not is_transient(http_error(400)) and not is_transient(discord.Forbidden(
+            SimpleNamespace(status=403, reason=''), ''))
+        assert is_transient(ConnectionResetError()) and is_transient(asyncio.TimeoutError())
+        assert not is_transient(ValueError())
@@ -0,0 +1,92 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import math
+import random
+import re
+import unittest
+
+import numpy as np
+
+from effects import base_table, increments, letters, letter_indexes, get_effect, effect_values, build_effect, \
+    compile_effect, effect_distribution, max_throw
+
+
+def reference_effect(letter, throw, modif=None):
+    """The lookup of the effect tables before they were compiled"""
+    if modif is not None:
+        throw += modif
+    if letter in letter_indexes and throw >= 0:
+        column = base_table[letter_indexes[letter]]
+        try:
+            return column[throw]
+        except IndexError:
+            return math.ceil((throw - (len(column) - 1)) / 4) * increments[letter_indexes[letter]] + column[-1]
+    return 0
+
+
+reference_pattern = re.compile(r'\[\s?([ABCDEFGHIJK])\s?([+-]\s?[1-9])?\s?\]')
+
+
+def reference_build_effect(effect_desc, mr, effect_dices):
+    effect_throw = mr + effect_dices
+    effect_desc = effect_desc.replace('MR', str(mr))
+    return reference_pattern.sub(
+        lambda letter: str(reference_effect(letter.group(1), effect_throw,
+                                            None if letter.group(2) is None
+                                            else int(letter.group(2).replace(' ', '')))),
+        effect_desc)
+
+
+class EffectTest(unittest.TestCase):
+
+    def test_get_effect(self):
+        assert get_effect('A', 9) == 0
+        assert get_effect('A', 10) == 1
+        assert get_effect('K', 26) == 12
+        assert get_effect('K', 27) == 18  # Beyond the table, +6 every 4
+        assert get_effect('C', 30, -4) == 5
+        assert get_effect('C', -1) == 0
+        assert get_effect('Z', 10) == 0
+
+    def test_same_as_reference(self):
+        for letter in letters:
+            for throw in range(-5, max_throw + 50):
+                assert get_effect(letter, throw) == reference_effect(letter, throw), (letter, throw)
+
+    def test_effect_values(self):
+        rng = np.random.default_rng(0)
+        indexes = rng.integers(0, len(letters), 1000)
+        throws = rng.integers(-10, max_throw + 100, 1000)
+        assert effect_values(indexes, throws).tolist() \
+            == [reference_effect(letters[i], int(t)) for i, t in zip(indexes, throws)]
+
+    def test_build_effect(self):
+        assert build_effect('Soigne MR + [C+1] PV', 3, 8) == 'Soigne 3 + 2 PV'
+        assert build_effect('Dégâts [ B ] PV', 0, 7) == 'Dégâts 1 PV'
+        rng = random.Random(0)
+        pieces = ['MR', ' PV ', '[A]', '[ K - 2 ]', '[C+1]', '[D+ 3]', 'x', '[', ']', '[Z]']
+        for _ in range(500):
+            desc = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 6)))
+            mr, dices = rng.randint(-10, 30), rng.randint(0, 12)
+            assert build_effect(desc, mr, dices) == reference_build_effect(desc, mr, dices), desc
+
+    def test_template_values(self):
+        template = compile_effect('[A] et [K+2]')
+        margins = np.array([0, 5, 20])
+        dices = np.array([3, 4, 6])
+        assert template.values(margins, dices).tolist() \
+            == [[reference_effect('A', m + d), reference_effect('K', m + d + 2)] for m, d in zip(margins, dices)]
+        assert compile_effect('rien').values(margins, dices).shape == (3, 0)
+
+    def test_effect_distribution(self):
+        distribution = effect_distribution('C', 5)
+        assert math.isclose(sum(distribution.values()), 1)
+        expected = {}
+        for dice in range(1, 7):
+            value = reference_effect('C', 5 + dice)
+            expected[value] = expected.get(value, 0) + 1 / 6
+        assert distribution.keys() == expected.keys()
+        assert all(math.isclose(distribution[value], expected[value]) for value in expected)
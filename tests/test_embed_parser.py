@@ -0,0 +1,130 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import unittest
+
+from discord import Embed
+
+from db import parse_roll
+from embed_parser import parse_embed, color_critical_mapping, emoji_to_db_value, emoji_pattern
+from roll_render import parse_roll_details, build_roll_data
+from tests.fixtures import random_rolls, FORMULA_ELEMENTS
+
+emojis = {name: f'<:{name}:{i}>' for i, name in enumerate(FORMULA_ELEMENTS + list(emoji_to_db_value))}
+
+
+def reference_parse_embed(embed, timestamp):
+    """The parsing of the crawler before the embed parser, without its prints"""
+    def parse_dice_emojis(dice_list):
+        return ",".join(str(emoji_to_db_value.get(dice.split(":")[1], dice.split(":")[1]))
+                        for dice in dice_list.split(" "))
+
+    if not embed.author:
+        return None
+    roll_data = {"name": embed.author.name[1:], "timestamp": timestamp, "recording": 0}
+    _, roll_data["critical_success"], roll_data["critical_failure"] = \
+        color_critical_mapping.get(embed.colour.value, (None, None, None))
+    if roll_data["critical_success"] is None or not roll_data["name"]:
+        return None
+    if " (niveau " in embed.title:
+        split_text = embed.title.split(" (niveau ")
+        roll_data["reason"], roll_data["talent_level"] = split_text[0], int(split_text[-1].split(")")[0])
+    else:
+        roll_data["reason"], roll_data["talent_level"] = None, 0
+    if embed.description:
+        split_text = embed.description.split("(")
+        roll_data["max_value"] = int(split_text[-1].split(")")[0])
+        roll_data["formula_elements"] = ",".join(m.group(1) for m in emoji_pattern.finditer(split_text[0]))
+    else:
+        roll_data["formula_elements"], roll_data["max_value"] = "", 0
+    for field in embed.fields:
+        key, value = field.name, field.value
+        if key == "Lancer":
+            roll_data["base_dices"] = parse_dice_emojis(value)
+            roll_data["number"] = len(roll_data["base_dices"].split(","))
+            roll_data["type"] = 6
+        elif key == "Dés d'Effet":
+            roll_data["effect_dices"] = parse_dice_emojis(value)
+        elif key == "Dés de Puissance":
+            roll_data["power_dices"] = parse_dice_emojis(value)
+            roll_data["optional_power"] = len(roll_data["power_dices"].split(","))
+            roll_data["invested_energies"] = "optional-power"
+        elif key == "Dés Critiques":
+            roll_data["critical_dices"] = parse_dice_emojis(value)
+        elif key == "Modif. effet":
+            roll_data["effect_modifier"] = int(value)
+        elif key == "Résultat":
+            if "sous" in value:
+                split_text = value.split("\nMR : ")
+                roll_data["threshold"], roll_data["margin"] = \
+                    int(split_text[0].split(" sous ")[-1]), int(split_text[-1])
+            else:
+                roll_data["threshold"], roll_data["margin"] = 0, 0
+        elif key == "Effet":
+            roll_data["effect"] = value
+    if "base_dices" not in roll_data:
+        return None
+    if "threshold" in roll_data and roll_data["threshold"] != 0 \
+            and ("effect_dices" not in roll_data or roll_data["critical_success"]
+                 and "critical_dices" not in roll_data or not roll_data["critical_success"]
+                 and "critical_dices" in roll_data):
+        return None
+    for field in ("recording", "critical_success", "critical_failure"):
+        roll_data[field] = "true" if roll_data[field] else "false"
+    return roll_data
+
+
+class EmbedParserTest(unittest.TestCase):
+
+    def test_parse_embed(self):
+        embed = Embed(title="Combat (niveau -2)", description="<:corps:1> <:action:2> (14)", colour=0x00ff11)
+        embed.set_author(name="@Berthe")
+        embed.add_field(name="Lancer", value="<:six:3> <:one:4>")
+        embed.add_field(name="Dés d'Effet", value="<:four:5>")
+        embed.add_field(name="Dés Critiques", value="<:six:3>")
+        embed.add_field(name="Résultat", value="7 sous 14\nMR : 7")
+        roll = parse_embed(embed)
+        assert roll.name == "Berthe" and roll.reason == "Combat" and roll.talent_level == -2
+        assert roll.critical_success and not roll.critical_failure
+        assert roll.formula == ("corps", "action") and roll.max_value == 14
+        assert roll.base_dices == (6, 1) and roll.effect_dices == (4,) and roll.critical_dices == (6,)
+        assert (roll.threshold, roll.margin) == (14, 7)
+        assert roll.power_dices is None
+        assert parse_embed(embed.to_dict()) == roll
+
+    def test_invalid_embeds(self):
+        assert parse_embed(Embed(title="Pas un lancer")) is None
+        assert parse_embed({"title": "Pas un lancer", "color": 0xff0000}) is None
+        embed = Embed(title="Combat (niveau 1)", description="(12)", colour=0x01890a)
+        embed.set_author(name="@Berthe")
+        assert parse_embed(embed) is None  # No dices
+        embed.add_field(name="Lancer", value="<:six:3>")
+        embed.add_field(name="Résultat", value="6 sous 12\nMR : x")
+        assert parse_embed(embed) is None
+
+    def test_round_trip_without_effect_dices(self):
+        post_data = dict(random_rolls(1)[0], threshold='10', margin='3', base_dices='3,4', critical_success='false',
+                         critical_failure='false', critical_dices='', effect_dices='')
+        embed = build_roll_data(parse_roll_details(post_data['name'], post_data), 'embed', emojis)
+        assert [field.value for field in embed.fields if field.name == "Dés d'Effet"] == ['-']
+        for rendered in (embed, build_roll_data(parse_roll_details(post_data['name'], post_data), 'embed')):
+            roll = parse_embed(rendered)
+            assert roll.effect_dices == () and roll.base_dices == (3, 4)
+            parsed = parse_roll('campaign', roll.post_data('now'))
+            assert [dice for dice in parsed.dices if dice[0] == 'effect_dices'] == []
+
+    def test_invalid_dices(self):
+        embed = Embed(title="Combat (niveau 1)", description="(12)", colour=0x01890a)
+        embed.set_author(name="@Berthe")
+        embed.add_field(name="Lancer", value="<:six:3> ?")
+        assert parse_embed(embed) is None
+
+    def test_same_as_reference(self):
+        for post_data in random_rolls(500):
+            embed = build_roll_data(parse_roll_details(post_data['name'], post_data), 'embed', emojis)
+            expected = reference_parse_embed(embed, "now")
+            roll = parse_embed(embed)
+            assert (None if roll is None else roll.post_data("now")) == expected, post_data
+            assert parse_embed(embed.to_dict()) == roll
@@ -0,0 +1,115 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import json
+import threading
+import time
+import unittest
+
+from db import ConnectionPool, store_event
+from events import EventHub, EventRelay
+from tests.test_db import DbTest
+
+
+class EventHubTest(unittest.TestCase):
+
+    def test_wait_returns_new_events(self):
+        hub = EventHub()
+        hub.publish('a', 'roll', {"n": 1})
+        first = hub.publish('b', 'roll', {"n": 2})
+        second = hub.publish('b', 'sheet', {"n": 3})
+        assert hub.wait('b', 0, timeout=0) == [(first, 'roll', {"n": 2}), (second, 'sheet', {"n": 3})]
+        assert hub.wait('b', first, timeout=0) == [(second, 'sheet', {"n": 3})]
+        assert hub.wait('b', second, timeout=0) == []
+        assert hub.last_id() == second
+
+    def test_history(self):
+        hub = EventHub(history=3)
+        for i in range(10):
+            hub.publish('a', 'roll', {"n": i})
+        assert [data["n"] for _, _, data in hub.wait('a', 0, timeout=0)] == [7, 8, 9]
+
+    def test_wakes_up_subscribers(self):
+        hub = EventHub()
+        results = []
+        subscribers = [threading.Thread(target=lambda: results.append(hub.wait('a', 0, timeout=5)))
+                       for _ in range(20)]
+        for subscriber in subscribers:
+            subscriber.start()
+        time.sleep(0.05)
+        hub.publish('other', 'roll', {})
+        event_id = hub.publish('a', 'roll', {"n": 1})
+        for subscriber in subscribers:
+            subscriber.join()
+        assert results == [[(event_id, 'roll', {"n": 1})]] * 20
+
+    def test_stream(self):
+        hub = EventHub()
+        hub.publish('a', 'roll', {"n": 0})  # Published before the subscription
+        stream = hub.stream('a', heartbeat=0.01)
+        assert next(stream).startswith('retry:')
+        assert next(stream) == ': keep-alive\n\n'
+        event_id = hub.publish('a', 'roll', {"n": 1})
+        assert next(stream) == f'id: {event_id}\nevent: roll\ndata: {json.dumps({"n": 1})}\n\n'
+        stream = hub.stream('a', last_id=0)  # Reconnection
+        next(stream)
+        assert '"n": 0' in next(stream)
+
+    def test_ordered_ids(self):
+        hub = EventHub(history=10000)
+        publishers = [threading.Thread(target=lambda: [hub.publish('a', 'roll', {}) for _ in range(500)])
+                      for _ in range(8)]
+        for publisher in publishers:
+            publisher.start()
+        for publisher in publishers:
+            publisher.join()
+        ids = [event_id for event_id, _, _ in hub.wait('a', 0, timeout=0)]
+        assert len(ids) == 4000 and ids == sorted(ids)
+
+    def test_ids_from_another_process(self):
+        previous = EventHub()
+        previous_id = previous.publish('a', 'roll', {"n": 0})
+        time.sleep(0.001)
+        hub = EventHub()
+        assert hub.last_id() > previous_id  # Restarted
+        event_id = hub.publish('a', 'roll', {"n": 1})
+        assert hub.wait('a', event_id + 1000, timeout=0) == [(event_id, 'roll', {"n": 1})]
+
+    def test_idle_channels_dropped(self):
+        hub = EventHub(idle_timeout=0.05)
+        hub.publish('a', 'roll', {})
+        waiter = threading.Thread(target=hub.wait, args=('b', hub.last_id(), 0.3))
+        waiter.start()
+        time.sleep(0.1)
+        hub.publish('c', 'roll', {})  # Sweeps the idle channels
+        assert sorted(hub._channels) == ['b', 'c']
+        waiter.join()
+
+
+class EventRelayTest(DbTest):
+
+    def test_relay_between_processes(self):
+        pools = [ConnectionPool(self.db_path) for _ in range(2)]
+        with pools[0].connection() as db:
+            store_event(db, 'a', 'roll', {"n": 0})
+        hubs = [EventHub(relayed=True) for _ in pools]
+        relays = [EventRelay(hub, pool, poll_interval=0.01) for hub, pool in zip(hubs, pools)]
+        try:
+            for relay in relays:
+                relay.start()
+            first = hubs[0].last_id()
+            assert [hub.wait('a', 0, timeout=0) for hub in hubs] == [[(first, 'roll', {"n": 0})]] * 2
+
+            with pools[1].connection() as db:  # Stored by the second "process"
+                store_event(db, 'a', 'sheet', {"n": 1})
+            for hub in hubs:
+                assert hub.wait('a', first, timeout=5) == [(first + 1, 'sheet', {"n": 1})]
+            # The ids are shared: a client may resume its feed from any process
+            assert hubs[1].wait('a', first + 5, timeout=0) == []
+        finally:
+            for relay in relays:
+                relay.close()
+            for pool in pools:
+                pool.close()
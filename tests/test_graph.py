@@ -0,0 +1,184 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import json
+import math
+import os.path
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from db import create_db, init_db_connection, bulk_insert_rolls
+from graph import _histogram_data, cdf_data, cdf_data_by_group, GraphCache, render_graphs
+from stats import CampaignStats
+from tests.fixtures import random_rolls, PLAYERS
+
+
+def reference_histogram_data(bounded_data):
+    """The histogram of graph.py before it was vectorized"""
+    counts = []
+    bin_edges = []
+    bounded_data = sorted(bounded_data)
+    for i in range(len(bounded_data)):
+        if len(bin_edges) != 0 and bin_edges[-1] == bounded_data[i]:
+            counts[-1] += 1
+        else:
+            counts.append(1)
+            bin_edges.append(bounded_data[i])
+    return counts, bin_edges
+
+
+def reference_cdf_data(cdf_values, shadow_points_from=(), origin=True):
+    """The cdf of graph.py before it was vectorized"""
+    data = sorted(cdf_values)
+    bounded_data = [value for value in data if value != math.inf]
+    if len(bounded_data) == 0:
+        return [], []
+
+    counts, bin_edges = reference_histogram_data(bounded_data)
+    cdf = np.cumsum(counts)
+    cdf = (cdf / cdf[-1]) * (len(bounded_data) / len(data))
+    bin_edges = list(bin_edges)
+    cdf = list(cdf)
+    if origin:
+        bin_edges.insert(0, 0)
+        cdf.insert(0, 0)
+
+    new_bin_edges = []
+    new_cdf = []
+    current_bin_idx = 0
+    for to_add in shadow_points_from:
+        for i in range(current_bin_idx, len(bin_edges)):
+            if to_add == bin_edges[i]:
+                new_bin_edges.append(to_add)
+                new_cdf.append(cdf[i])
+                current_bin_idx = i + 1
+                break
+            elif to_add < bin_edges[i]:
+                new_bin_edges.append(to_add)
+                new_cdf.append(new_cdf[-1] if new_cdf else 0)
+                break
+            else:
+                new_bin_edges.append(bin_edges[i])
+                new_cdf.append(cdf[i])
+        if current_bin_idx == len(bin_edges) and new_bin_edges[-1] != to_add:
+            new_bin_edges.append(to_add)
+            new_cdf.append(new_cdf[-1] if new_cdf else 0)
+
+    return (bin_edges, cdf) if len(shadow_points_from) == 0 else (new_bin_edges, new_cdf)
+
+
+class GraphTest(unittest.TestCase):
+
+    def random_groups(self, rng, low, high, unsolved=False):
+        groups = {}
+        for name in range(rng.randint(1, 6)):
+            values = [rng.randint(low, high) for _ in range(rng.randint(1, 60))]
+            if unsolved:
+                values += [math.inf] * rng.randint(0, 5)
+            rng.shuffle(values)
+            groups[f"Player {name}"] = values
+        return groups
+
+    def test_histogram_data(self):
+        rng = random.Random(0)
+        for _ in range(100):
+            values = [rng.randint(-5, 15) for _ in range(rng.randint(1, 50))]
+            assert _histogram_data(values) == reference_histogram_data(values)
+
+    def test_cdf_data(self):
+        assert cdf_data([math.inf, math.inf]) == ([], [])
+        assert cdf_data([3, 1, 3, math.inf]) == ([0, 1, 3], [0, 0.25, 0.75])
+        assert cdf_data([2, 4], shadow_points_from=[1, 2, 3, 4, 5], origin=False) \
+            == ([1, 2, 3, 4, 5], [0, 0.5, 0.5, 1, 1])
+
+    def test_same_as_reference(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            origin = rng.random() < 0.5
+            groups = self.random_groups(rng, -10, 20, unsolved=True)
+            cdfs = cdf_data_by_group(groups, origin=origin)
+            for name, values in groups.items():
+                assert cdfs[name] == reference_cdf_data(values, origin=origin), values
+
+    def test_shadow_points_same_as_reference(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            # As for the graphs: the shadow points contain every value, and the origin when it is added
+            origin = rng.random() < 0.5
+            groups = self.random_groups(rng, 1 if origin else -10, 20, unsolved=True)
+            shadow_points = {value for values in groups.values() for value in values if value != math.inf}
+            shadow_points |= {rng.randint(-15, 25) for _ in range(rng.randint(0, 5))}
+            if origin:
+                shadow_points.add(0)
+            shadow_points = sorted(shadow_points)
+            cdfs = cdf_data_by_group(groups, shadow_points_from=shadow_points, origin=origin)
+            for name, values in groups.items():
+                assert cdfs[name] == reference_cdf_data(values, shadow_points, origin), (values, shadow_points)
+
+
+class ChartsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.root_dir.name, 'roll.sqlite3')
+        create_db(db_path)
+        self.db = init_db_connection(db_path)
+        bulk_insert_rolls(self.db, 'campaign', random_rolls(200))
+
+    def tearDown(self):
+        self.db.close()
+        self.root_dir.cleanup()
+
+    def test_charts(self):
+        stats = CampaignStats(self.db, 'campaign')
+        graphs = render_graphs(stats)
+        first_names = sorted(player.split(' ')[0] for player in PLAYERS)
+
+        roll_count = json.loads(graphs['roll_count'])
+        assert roll_count['type'] == 'bar'
+        assert dict(zip(roll_count['traces'][0]['x'], roll_count['traces'][0]['y'])) \
+            == {name.split(' ')[0]: count for name, count in stats.count_by_player().items()}
+        success_failure = json.loads(graphs['success_failure_by_player'])
+        assert [trace['name'] for trace in success_failure['traces']] == ['Success Rate', 'Failure Rate']
+        assert success_failure['legend_title'] == 'Rate'
+
+        dices = json.loads(graphs['base_dice_distributions'])
+        assert dices['type'] == 'line'
+        assert sorted(trace['name'] for trace in dices['traces']) == sorted(first_names + ['Reference'])
+        reference = next(trace for trace in dices['traces'] if trace['name'] == 'Reference')
+        assert dices['layout']['yaxis']['tickvals'] == reference['y']
+        margins = json.loads(graphs['magins_distributions'])
+        assert [trace['name'] for trace in margins['traces']] == first_names
+        assert all(trace['y'][-1] == 1 for trace in margins['traces'])
+
+    def test_empty_campaign(self):
+        graphs = render_graphs(CampaignStats(self.db, 'empty-campaign'))
+        assert json.loads(graphs['thresholds_distributions'])['traces'] == []
+        assert [trace['name'] for trace in json.loads(graphs['base_dice_distributions'])['traces']] == ['Reference']
+
+
+class GraphCacheTest(unittest.TestCase):
+
+    def test_versions(self):
+        cache = GraphCache(max_entries=2)
+        key = ('campaign', None, None)
+        cache.put(key, 1, {'players': ['Berthe']})
+        assert cache.get(key, 1) == {'players': ['Berthe']}
+        assert cache.get(key, 2) is None  # New rolls arrived
+        cache.put(key, 2, {'players': ['Berthe', 'Ursule']})
+        cache.put(key, 1, {'players': ['Berthe']})  # Rendered concurrently from older rolls
+        assert cache.get(key, 2) == {'players': ['Berthe', 'Ursule']}
+
+    def test_eviction(self):
+        cache = GraphCache(max_entries=2)
+        for player in ['Berthe', 'Ursule']:
+            cache.put(('campaign', player, None), 1, {})
+        cache.get(('campaign', 'Berthe', None), 1)
+        cache.put(('campaign', None, None), 1, {})
+        assert cache.get(('campaign', 'Ursule', None), 1) is None
+        assert cache.get(('campaign', 'Berthe', None), 1) == {}
@@ -0,0 +1,106 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import os.path
+import threading
+from types import SimpleNamespace
+
+from db import ConnectionPool, get_queued_discord_rolls, get_events
+from ingest import RollWriter
+from tests.fixtures import random_rolls
+from tests.test_db import DbTest, CAMPAIGN
+
+
+class RollWriterTest(DbTest):
+
+    def setUp(self):
+        super().setUp()
+        self.pool = ConnectionPool(self.db_path)
+        self.writer = RollWriter(self.pool, max_batch=16, max_delay=0.05)
+
+    def tearDown(self):
+        self.writer.close()
+        self.pool.close()
+        super().tearDown()
+
+    def count_rolls(self):
+        return self.db.execute("select count(*) from rolls").fetchone()[0]
+
+    def test_submit(self):
+        self.writer.submit(CAMPAIGN, random_rolls(1)[0])
+        assert self.count_rolls() == 1
+
+    def test_concurrent_submits(self):
+        rolls = random_rolls(100)
+        threads = [threading.Thread(target=self.writer.submit, args=(CAMPAIGN, roll)) for roll in rolls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert self.count_rolls() == 100
+        assert self.db.execute("select count(*) from dices").fetchone()[0] \
+            == sum(len(value.split(',')) for roll in rolls for key, value in roll.items()
+                   if key.endswith('_dices') and value)
+
+    def test_invalid_roll_fails_alone(self):
+        rolls = random_rolls(3)
+        rolls[1]['threshold'] = 'not a number'
+        errors = []
+
+        def submit(roll):
+            try:
+                self.writer.submit(CAMPAIGN, roll)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=submit, args=(roll,)) for roll in rolls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(errors) == 1
+        assert self.count_rolls() == 2
+
+    def test_discord_roll_queued_with_roll(self):
+        rolls = random_rolls(2)
+        self.writer.submit(CAMPAIGN, rolls[0], ('server', 'key', rolls[0]))
+        rolls[1]['threshold'] = 'not a number'
+        with self.assertRaises(ValueError):
+            self.writer.submit(CAMPAIGN, rolls[1], ('server', 'other-key', rolls[1]))
+        assert [(server, key, roll) for _, server, key, roll in get_queued_discord_rolls(self.db)] \
+            == [('server', 'key', rolls[0])]
+
+    def test_event_stored_with_roll(self):
+        rolls = random_rolls(2)
+        self.writer.submit(CAMPAIGN, rolls[0], event=(CAMPAIGN, 'roll', rolls[0]))
+        rolls[1]['threshold'] = 'not a number'
+        with self.assertRaises(ValueError):
+            self.writer.submit(CAMPAIGN, rolls[1], event=(CAMPAIGN, 'roll', rolls[1]))
+        assert [(campaign, event_type, data) for _, campaign, event_type, data in get_events(self.db)] \
+            == [(CAMPAIGN, 'roll', rolls[0])]
+
+    def test_connection_failure(self):
+        pool = SimpleNamespace(path=os.path.join(self.root_dir.name, 'missing', 'roll.sqlite3'), busy_timeout=100,
+                               pragmas={})
+        writer = RollWriter(pool)
+        try:
+            errors = []
+
+            def submit(roll):
+                try:
+                    writer.submit(CAMPAIGN, roll, timeout=10)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=submit, args=(roll,)) for roll in random_rolls(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert len(errors) == 5 and not any(isinstance(error, TimeoutError) for error in errors)
+            with self.assertRaises(RuntimeError):
+                writer.submit(CAMPAIGN, random_rolls(1)[0], timeout=10)
+        finally:
+            writer.close()
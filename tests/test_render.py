@@ -0,0 +1,39 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import unittest
+
+from roll_render import parse_roll_details, build_roll_data, format_dices, result_styles
+from tests.fixtures import random_rolls
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_parse_roll_details(self):
+        roll = parse_roll_details('Berthe', {'base_dices': '1,5', 'number': '2', 'type': '6',
+                                             'critical_success': 'false', 'critical_failure': 'true',
+                                             'margin': '-2', 'formula_elements': 'corps,action',
+                                             'effect_dices': '3', 'effect_modifier': '1', 'effect': ''})
+        assert roll.base_dices == (1, 5)
+        assert roll.margin == -2
+        assert roll.formula == ('corps', 'action')
+        assert roll.critical_failure and not roll.critical_success
+        assert roll.effect_dices == (3,) and roll.effect_modifier == 1
+        assert roll.power_dices == ()
+        with self.assertRaises(ValueError):
+            parse_roll_details('Berthe', {'base_dices': '1,x'})
+
+    def test_format_dices(self):
+        assert format_dices((1, 6, 9), {'one': '<:one:1>'}) == '<:one:1> six 9'
+
+    def test_render_rolls(self):
+        for post_data in random_rolls(200):
+            roll = parse_roll_details(post_data['name'], post_data)
+            text = build_roll_data(roll)
+            assert text.startswith(f'**@{roll.character}**')
+            embed = build_roll_data(roll, 'embed')
+            assert embed.author.name == f'@{roll.character}'
+            assert embed.color.value in [style.color for style in result_styles.values()]
+            assert all(field.value for field in embed.fields)
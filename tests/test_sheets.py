@@ -0,0 +1,103 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import os
+import random
+import tempfile
+import unittest
+
+from sheets import SheetCache, StoredSheet, compute_delta, apply_delta, sheet_delta, store_sheet, record_version, \
+    load_history, get_changes
+
+
+class SheetCacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = SheetCache(max_size=30)
+        for digest in 'abc':
+            cache.put(StoredSheet(digest, b'x' * 10, True))
+        assert cache.get('a') is not None  # 'b' is now the least recently used
+        cache.put(StoredSheet('d', b'x' * 10, True))
+        assert cache.get('b') is None
+        assert [cache.get(digest) is not None for digest in 'acd'] == [True, True, True]
+        assert cache.size == 30
+
+    def test_discard(self):
+        cache = SheetCache()
+        cache.put(StoredSheet('a', b'x' * 10, True))
+        cache.discard('a')
+        cache.discard('missing')
+        assert cache.get('a') is None
+        assert cache.size == 0
+
+    def test_too_large(self):
+        cache = SheetCache(max_size=5)
+        cache.put(StoredSheet('a', b'x' * 10, True))
+        assert cache.get('a') is None
+
+
+class DeltaTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            old = [f'<p>{rng.randint(0, 20)}</p>\n' for _ in range(rng.randint(0, 30))]
+            new = list(old)
+            for _ in range(rng.randint(0, 5)):
+                position = rng.randint(0, len(new))
+                new[position:position + rng.randint(0, 2)] = [f'<p>{rng.random()}</p>\n'] * rng.randint(0, 2)
+            old, new = ''.join(old), ''.join(new) + rng.choice(['', 'no final newline'])
+            assert apply_delta(old, compute_delta(old, new)) == new
+
+    def test_lines_split_on_newlines_only(self):
+        old = 'a\rb\x0bc\u2028d\ne\n'
+        new = 'a\rb\x0bc\u2028d\nE\n'
+        assert compute_delta(old, new) == [(1, 2, 'E\n')]
+        assert apply_delta(old, compute_delta(old, new)) == new
+
+    def test_small_change(self):
+        old = ''.join(f'<p>line {i}</p>\n' for i in range(1000))
+        new = old.replace('<p>line 500</p>', '<p>changed</p>')
+        assert compute_delta(old, new) == [(500, 501, '<p>changed</p>\n')]
+
+    def test_large_delta_skipped(self):
+        old = ''.join(f'<p>line {i}</p>\n' for i in range(100))
+        assert sheet_delta(old, old.replace('line 5<', 'changed<')) == [(5, 6, '<p>changed</p>\n')]
+        assert sheet_delta(old, old.replace('line', 'changed')) is None
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.TemporaryDirectory()
+        self.sheet_path = os.path.join(self.root_dir.name, 'sheet')
+        self.objects_path = os.path.join(self.root_dir.name, 'objects')
+        self.lines = [f'<p>line {i}</p>\n' for i in range(100)]
+        self.sheet = store_sheet(self.sheet_path, self.objects_path, ''.join(self.lines))
+
+    def tearDown(self):
+        self.root_dir.cleanup()
+
+    def push(self, content, **kw):
+        old, self.sheet = self.sheet, store_sheet(self.sheet_path, self.objects_path, content)
+        return record_version(self.sheet_path, old, self.sheet, sheet_delta(old.text(), content), **kw)
+
+    def test_size_limit(self):
+        for i in range(10):
+            self.lines[i] = 'x' * 100 + '\n'
+            self.push(''.join(self.lines), max_size=500)
+        deltas = load_history(self.sheet_path)["deltas"]
+        assert len(deltas) == 4
+        assert get_changes(self.sheet_path, 7)["deltas"] == deltas
+        assert "page" in get_changes(self.sheet_path, 6)
+
+    def test_history_restarts_without_delta(self):
+        self.push(''.join(self.lines[:-1]))
+        self.lines = [line.upper() for line in self.lines]
+        assert self.push(''.join(self.lines)) == 3
+        assert load_history(self.sheet_path)["deltas"] == []
+        assert get_changes(self.sheet_path, 2) == {"version": 3, "page": self.sheet.text()}
+        assert self.push(''.join(self.lines[:-1])) == 4
+        assert len(get_changes(self.sheet_path, 3)["deltas"]) == 1
@@ -0,0 +1,93 @@
+#!env python3
+# coding: utf-8
+
+# this code is public domain
+
+import os.path
+import tempfile
+import unittest
+
+from db import create_db, init_db_connection, insert_roll, get_players, get_count_by_player, \
+    get_success_failure_by_player, get_critical_by_player, get_nimdir_index_by_player, get_thresholds_by_player, \
+    get_margins_by_player, get_base_dices, get_formula_usage, get_energy_usage, get_stats_by_test
+from stats import CampaignStats
+from tests.fixtures import random_rolls, PLAYERS, REASONS
+
+CAMPAIGN = 'campaign'
+
+
+class CampaignStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.root_dir.name, 'roll.sqlite3')
+        create_db(self.db_path)
+        self.db = init_db_connection(self.db_path)
+        with self.db:
+            for roll in random_rolls(500):
+                insert_roll(self.db, CAMPAIGN, roll)
+            for roll in random_rolls(50, seed=1):
+                insert_roll(self.db, 'other-campaign', roll)
+
+    def tearDown(self):
+        self.db.close()
+        self.root_dir.cleanup()
+
+    def assert_same_stats(self, player=None, test=None):
+        stats = CampaignStats(self.db, CAMPAIGN, filter_player=player, filter_test=test)
+        args = (self.db, CAMPAIGN, player, test)
+        assert stats.players == get_players(self.db, CAMPAIGN)
+        assert stats.count_by_player() == get_count_by_player(*args)
+        assert stats.success_failure_by_player() == get_success_failure_by_player(*args)
+        assert stats.critical_by_player() == get_critical_by_player(*args)
+        assert stats.nimdir_index_by_player() == get_nimdir_index_by_player(*args)
+        # The order of the values of a player does not matter for the distributions
+        for computed, expected in [(stats.thresholds_by_player(), get_thresholds_by_player(*args)),
+                                   (stats.margins_by_player(), get_margins_by_player(*args)),
+                                   (stats.base_dices(), get_base_dices(*args))]:
+            assert sorted(computed) == sorted(expected)
+            for name, values in computed.items():
+                assert sorted(values) == sorted(expected[name])
+        assert stats.formula_usage() == get_formula_usage(*args)
+        assert stats.energy_usage() == get_energy_usage(*args)
+        assert stats.stats_by_test() == get_stats_by_test(*args)
+        expected = get_stats_by_test(*args, percentiles=[0, 10, 50, 95, 100])
+        computed = stats.stats_by_test([0, 10, 50, 95, 100])
+        assert [stats[:4] for stats in computed] == [stats[:4] for stats in expected]
+        for (*_, percentiles), expected_stats in zip(computed, expected):
+            for percentile, expected_percentile in zip(percentiles, expected_stats[4]):
+                self.assertAlmostEqual(percentile, expected_percentile)
+
+    def test_no_filter(self):
+        self.assert_same_stats()
+
+    def test_filter_player(self):
+        self.assert_same_stats(player=PLAYERS[1])
+
+    def test_filter_test(self):
+        self.assert_same_stats(test=REASONS[0])
+
+    def test_filter_player_and_test(self):
+        self.assert_same_stats(player=PLAYERS[2], test=REASONS[1])
+
+    def test_unknown_filters(self):
+        self.assert_same_stats(player='Nobody', test='Nothing')
+
+    def test_stored_streaks(self):
+        with self.db:
+            self.db.execute("update streaks set completed_successes = 1000 where campaign = ?", [CAMPAIGN])
+        assert all(successes == 1000 for successes, _ in CampaignStats(self.db, CAMPAIGN).nimdir_index_by_player()
+                   .values())
+        # The streaks of a test are computed from the rolls
+        stats = CampaignStats(self.db, CAMPAIGN, filter_test=REASONS[0])
+        assert stats.nimdir_index_by_player() == get_nimdir_index_by_player(self.db, CAMPAIGN, None, REASONS[0])
+        assert all(successes < 1000 for successes, _ in stats.nimdir_index_by_player().values())
+
+    def test_empty_campaign(self):
+        stats = CampaignStats(self.db, 'empty-campaign')
+        assert stats.players == []
+        assert stats.count_by_player() == {}
+        assert stats.nimdir_index_by_player() == {}
+        assert stats.base_dices() == {}
+        assert stats.formula_usage() == {}
+        assert stats.stats_by_test() == []